@@ -18,7 +18,6 @@
 
 from __future__ import print_function
 
-import ssm.agents
 from ssm import __version__, LOG_BREAK
 
 from argparse import ArgumentParser
@@ -76,6 +75,9 @@ def main():
         print('Cannot start SSM.  Pidfile %s already exists.' % pidfile)
         sys.exit(1)
 
+    # Imported here so that --help and --version don't have to wait for it.
+    import ssm.agents
+
     ssm.agents.logging_helper(cp)
 
     log = logging.getLogger('ssmreceive')
@@ -0,0 +1,76 @@
+"""Compare the speed of signing and verifying with different key types.
+
+This isn't run as part of the tests. Run it from the top of the repository
+with:
+
+    PYTHONPATH=. python scripts/benchmark_crypto.py [number of messages]
+"""
+from __future__ import print_function
+
+import os
+import shutil
+from subprocess import call, check_output, PIPE
+import sys
+import tempfile
+import time
+
+from ssm.crypto import sign, verify, CryptoException
+
+
+KEY_TYPES = [
+    ('RSA-2048', ['rsa:2048']),
+    ('RSA-4096', ['rsa:4096']),
+    ('ECDSA P-256', ['ec', '-pkeyopt', 'ec_paramgen_curve:P-256']),
+    ('ECDSA P-384', ['ec', '-pkeyopt', 'ec_paramgen_curve:P-384']),
+    ('Ed25519', ['ed25519']),
+]
+
+MSG = 'APEL-summary-job-message: v0.2\n' + 'Site: TEST\n' * 100
+
+
+def make_credentials(tmp_dir, name, key_args):
+    """Create a self-signed cert and key, and a CA directory holding it."""
+    certpath = os.path.join(tmp_dir, name + '.crt')
+    keypath = os.path.join(tmp_dir, name + '.key')
+    call(['openssl', 'req', '-x509', '-nodes', '-days', '1', '-newkey']
+         + key_args + ['-keyout', keypath, '-out', certpath,
+                       '-subj', '/CN=' + name], stderr=PIPE)
+    ca_dir = os.path.join(tmp_dir, name + '-ca')
+    os.mkdir(ca_dir)
+    hash_name = check_output(['openssl', 'x509', '-subject_hash', '-noout',
+                              '-in', certpath], universal_newlines=True)
+    shutil.copy(certpath, os.path.join(ca_dir, hash_name.strip() + '.0'))
+    return certpath, keypath, ca_dir
+
+
+def main():
+    """Print the time per message to sign and to verify for each key type."""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    tmp_dir = tempfile.mkdtemp(prefix='ssm')
+    try:
+        print('%-12s %12s %12s' % ('key', 'sign (ms)', 'verify (ms)'))
+        for name, key_args in KEY_TYPES:
+            certpath, keypath, ca_dir = make_credentials(
+                tmp_dir, name.replace(' ', '-'), key_args
+            )
+            try:
+                start = time.time()
+                signed = [sign(MSG, certpath, keypath) for _ in range(count)]
+                sign_time = (time.time() - start) / count
+            except CryptoException:
+                print('%-12s %25s' % (name, 'not supported by openssl'))
+                continue
+
+            start = time.time()
+            for message in signed:
+                verify(message, ca_dir, False)
+            verify_time = (time.time() - start) / count
+
+            print('%-12s %12.2f %12.2f' % (name, sign_time * 1000,
+                                           verify_time * 1000))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,16 +16,32 @@
    @author: Will Rogers
 """
 
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 
 __version__ = (4, 0, 0)
 
 LOG_BREAK = '========================================'
 
+# The handler that queues log records and the listener that writes them out,
+# set by set_up_logging.
+_queue_handler = None
+_listener = None
+_listening = False
+
 
 def set_up_logging(logfile, level, console):
-    """Programmatically initialise logging system."""
+    """Programmatically initialise logging system.
+
+    Log records are put on a queue by the root logger, then formatted and
+    written out by a background thread, so that logging doesn't hold up
+    sending or receiving messages.
+    """
+    global _queue_handler, _listener
+
     levels = {'DEBUG': logging.DEBUG,
               'INFO': logging.INFO,
               'WARN': logging.WARN,
@@ -38,12 +54,58 @@ def set_up_logging(logfile, level, console):
     log = logging.getLogger()
     log.setLevel(levels[level])
 
+    handlers = []
     if logfile is not None:
         fh = logging.FileHandler(logfile)
         fh.setFormatter(formatter)
-        log.addHandler(fh)
+        handlers.append(fh)
 
     if console:
         ch = logging.StreamHandler(sys.stdout)
         ch.setFormatter(formatter)
-        log.addHandler(ch)
+        handlers.append(ch)
+
+    # Replace any queue set up before, once its records are written out.
+    stop_logging()
+    if _queue_handler is None:
+        atexit.register(stop_logging)
+    else:
+        log.removeHandler(_queue_handler)
+        for handler in _listener.handlers:
+            handler.close()
+
+    log_queue = queue.Queue()
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    log.addHandler(_queue_handler)
+    _listener = logging.handlers.QueueListener(log_queue, *handlers)
+    start_logging()
+
+
+def start_logging():
+    """Start writing out queued log records in a background thread.
+
+    Records logged while stopped are kept on the queue until then.
+    """
+    global _listening
+    if _listener is not None and not _listening:
+        _listener.start()
+        _listening = True
+
+
+def stop_logging():
+    """Write out any queued log records and stop the background thread.
+
+    The thread doesn't survive a fork, so this must be called before
+    becoming a daemon, and start_logging afterwards.
+    """
+    global _listening
+    if _listener is not None and _listening:
+        _listener.stop()
+        _listening = False
+
+
+def log_streams():
+    """Return the open files and streams that log records are written to."""
+    if _listener is None:
+        return []
+    return [handler.stream for handler in _listener.handlers]
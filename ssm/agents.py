@@ -18,36 +18,26 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import logging
 import sys
 import time
 
 import configparser
 
-try:
-    from daemon import DaemonContext
-except ImportError:
-    # A error is logged and the receiver exits later if DaemonContext is
-    # requested but not installed.
-    DaemonContext = None
-
-from stomp.exception import NotConnectedException
-try:
-    from argo_ams_library import (AmsConnectionException, AmsTimeoutException,
-                                  AmsBalancerException)
-except ImportError:
-    # ImportError is raised when Ssm2 initialised if AMS is requested but lib
-    # not installed.
-    class AmsConnectionException(Exception):
-        """Placeholder exception if argo_ams_library not used."""
-        pass
+# The daemon and messaging libraries are imported by run_receiver, and only
+# for the protocol in use, so that they don't slow down the sender.
 
-from ssm import set_up_logging, LOG_BREAK
+from ssm import (set_up_logging, start_logging, stop_logging, log_streams,
+                 LOG_BREAK)
 from ssm.ssm2 import Ssm2, Ssm2Exception
-from ssm.crypto import CryptoException, get_certificate_subject, _from_file
+from ssm.crypto import CryptoException, Credentials
+from ssm.valid_dns import DnFileMonitor
 
-# How often (in seconds) to read the list of valid DNs.
-REFRESH_DNS = 600
+# How often (in seconds) to check if the list of valid DNs has changed.
+CHECK_DNS = 5
+# How often (in seconds) to send a ping to keep a STOMP connection alive.
+SEND_PING = 600
+# How often (in seconds) a receiver writes out its metrics, if configured.
+WRITE_METRICS = 15
 
 
 def logging_helper(cp):
@@ -159,6 +149,173 @@ def get_ssm_args(protocol, cp, log):
     return brokers, project, token
 
 
+def get_path_type(cp, log, section='messaging'):
+    """Return the type of message store to use, defaulting to dirq.
+
+    For senders this is either 'dirq' or 'directory' (a plain directory) and
+    for receivers either 'dirq' or 'sqlite'.
+    """
+    try:
+        return cp.get(section, 'path_type')
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        log.info('No path type defined, assuming dirq.')
+        return 'dirq'
+
+
+def get_limit(cp, section, option):
+    """Return a non-negative integer option, or None if it's unset or zero.
+
+    Used for limits where zero or leaving the option out means no limit.
+    """
+    try:
+        value = cp.getint(section, option)
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        return None
+
+    if value < 0:
+        raise ValueError('%s must not be negative.' % option)
+
+    return value or None
+
+
+def get_option(cp, section, option, default=None):
+    """Return a string option, or default if it's unset or empty."""
+    try:
+        return cp.get(section, option) or default
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        return default
+
+
+def get_max_msg_size(cp):
+    """Return the maximum message size in bytes, or None if not limited."""
+    return get_limit(cp, 'messaging', 'max_message_size')
+
+
+def get_send_limits(cp):
+    """Return the per-run sending limits as keyword arguments for send_all."""
+    return {'max_msgs': get_limit(cp, 'sender', 'max_messages'),
+            'max_bytes': get_limit(cp, 'sender', 'max_bytes'),
+            'max_time': get_limit(cp, 'sender', 'max_run_time')}
+
+
+def get_purge_limits(cp, section='messaging'):
+    """Return the incremental purge settings as keyword arguments for Ssm2."""
+    return {option: get_limit(cp, section, option)
+            for option in ('purge_max_dirs', 'purge_max_time',
+                           'full_purge_interval')}
+
+
+def get_extra_queues(cp):
+    """Return the names of the sections for a sender's extra queues.
+
+    Each is a section like [messaging] with its own path, path_type and
+    destination, and optionally its own purge settings.
+    """
+    try:
+        sections = cp.get('sender', 'extra_queues').split(',')
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        return []
+    sections = [section.strip() for section in sections if section.strip()]
+    for section in sections:
+        if not cp.has_section(section):
+            raise Ssm2Exception('No [%s] section for extra queue.' % section)
+    return sections
+
+
+def get_metrics_file(cp):
+    """Return the path to write metrics to, or None if not set."""
+    return get_option(cp, 'metrics', 'textfile')
+
+
+def get_summary_interval(cp):
+    """Return how often, in seconds, to log a summary instead of each message.
+
+    Returns None, to log each message at INFO, if it's not set or zero.
+    """
+    return get_limit(cp, 'logging', 'summary_interval')
+
+
+def get_routes(cp):
+    """Return the sender's routes as a list of (pattern, destination) tuples.
+
+    The routes are the options of the [routes] section, in order.
+    """
+    if not cp.has_section('routes'):
+        return None
+    return [(pattern, destination) for pattern, destination
+            in cp.items('routes') if destination]
+
+
+def get_compression(cp):
+    """Return the compression method for a sender, or None if not set."""
+    return get_option(cp, 'sender', 'compression')
+
+
+def get_binary(cp):
+    """Return True if a sender should send binary (DER) messages."""
+    return cp.getboolean('sender', 'binary', fallback=False)
+
+
+def get_cipher(cp):
+    """Return the cipher a sender encrypts messages with."""
+    return get_option(cp, 'certificates', 'cipher', 'aes128')
+
+
+def get_write_batching(cp):
+    """Return the receiver's write batching settings as arguments for Ssm2."""
+    settings = {'write_batch_size': get_limit(cp, 'receiver',
+                                              'write_batch_size')}
+    try:
+        settings['write_batch_delay'] = cp.getfloat('receiver',
+                                                    'write_batch_delay')
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        pass
+    return settings
+
+
+def get_watermarks(cp):
+    """Return the receiver's backpressure settings as arguments for Ssm2."""
+    return {'high_watermark': get_limit(cp, 'receiver', 'high_watermark'),
+            'low_watermark': get_limit(cp, 'receiver', 'low_watermark')}
+
+
+def get_sharding(cp):
+    """Return the receiver's incoming queue sharding as arguments for Ssm2."""
+    settings = {'incoming_shards': get_limit(cp, 'receiver',
+                                             'incoming_shards') or 1}
+    try:
+        settings['shard_key'] = cp.get('receiver', 'shard_key')
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        pass
+    return settings
+
+
+def get_workers(cp):
+    """Return the receiver's worker thread settings as arguments for Ssm2."""
+    settings = {'workers': get_limit(cp, 'receiver', 'workers')}
+    try:
+        settings['signer_rate'] = cp.getfloat('receiver', 'signer_rate')
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        pass
+    return settings
+
+
+def get_status_socket(cp):
+    """Return the path of the receiver's status socket, or None if not set."""
+    return get_option(cp, 'receiver', 'status_socket')
+
+
+def get_destinations(cp):
+    """Return the list of destinations a receiver is to receive from.
+
+    The destination option can hold several destinations, or AMS
+    subscriptions, separated by commas.
+    """
+    destinations = [destination.strip() for destination
+                    in cp.get('messaging', 'destination').split(',')]
+    return [destination for destination in destinations if destination]
+
+
 def run_sender(protocol, brokers, project, token, cp, log):
     """Run Ssm2 as a sender."""
     try:
@@ -166,8 +323,6 @@ def run_sender(protocol, brokers, project, token, cp, log):
         verify_server_cert = True
         try:
             server_cert = cp.get('certificates', 'server_cert')
-            server_dn = get_certificate_subject(_from_file(server_cert))
-            log.info('Messages will be encrypted using %s', server_dn)
             try:
                 verify_server_cert = cp.getboolean('certificates', 'verify_server_cert')
             except configparser.NoOptionError:
@@ -183,17 +338,15 @@ def run_sender(protocol, brokers, project, token, cp, log):
         except configparser.NoOptionError as e:
             raise Ssm2Exception(e)
 
-        # Determine what type of message store we are interacting with,
-        # i.e. a dirq QueueSimple object or a plain MessageDirectory directory.
-        try:
-            path_type = cp.get('messaging', 'path_type')
-        except configparser.NoOptionError:
-            log.info('No path type defined, assuming dirq.')
-            path_type = 'dirq'
-
         host_cert = cp.get('certificates', 'certificate')
-        host_dn = get_certificate_subject(_from_file(host_cert))
-        log.info('Messages will be signed using %s', host_dn)
+        # Each certificate and key file is read once, here, and the parsed
+        # contents used for all of the checks made at startup.
+        credentials = Credentials(host_cert, cp.get('certificates', 'key'),
+                                  server_cert)
+        if server_cert is not None:
+            log.info('Messages will be encrypted using %s',
+                     credentials.enc_subject)
+        log.info('Messages will be signed using %s', credentials.subject)
 
         if server_cert == host_cert:
             raise Ssm2Exception(
@@ -203,7 +356,7 @@ def run_sender(protocol, brokers, project, token, cp, log):
 
         sender = Ssm2(brokers,
                       cp.get('messaging', 'path'),
-                      path_type=path_type,
+                      path_type=get_path_type(cp, log),
                       cert=host_cert,
                       key=cp.get('certificates', 'key'),
                       dest=cp.get('messaging', 'destination'),
@@ -213,11 +366,27 @@ def run_sender(protocol, brokers, project, token, cp, log):
                       verify_enc_cert=verify_server_cert,
                       protocol=protocol,
                       project=project,
-                      token=token)
+                      token=token,
+                      max_msg_size=get_max_msg_size(cp),
+                      purge_limits=get_purge_limits(cp),
+                      routes=get_routes(cp),
+                      compression=get_compression(cp),
+                      binary=get_binary(cp),
+                      cipher=get_cipher(cp),
+                      credentials=credentials,
+                      summary_interval=get_summary_interval(cp))
+
+        for section in get_extra_queues(cp):
+            destination = cp.get(section, 'destination')
+            log.info('Will also send messages from %s to %s.',
+                     cp.get(section, 'path'), destination)
+            sender.add_outgoing(cp.get(section, 'path'), destination,
+                                path_type=get_path_type(cp, log, section),
+                                purge_limits=get_purge_limits(cp, section))
 
         if sender.has_msgs():
             sender.handle_connect()
-            sender.send_all()
+            sender.send_all(**get_send_limits(cp))
             log.info('SSM run has finished.')
         else:
             log.info('No messages found to send.')
@@ -238,6 +407,10 @@ def run_sender(protocol, brokers, project, token, cp, log):
     except UnboundLocalError:
         # SSM not set up.
         pass
+    else:
+        metrics_file = get_metrics_file(cp)
+        if metrics_file is not None:
+            sender.write_metrics(metrics_file)
 
     log.info('SSM has shut down.')
     log.info(LOG_BREAK)
@@ -245,9 +418,34 @@ def run_sender(protocol, brokers, project, token, cp, log):
         sys.exit(1)
 
 
+def _connection_errors(protocol):
+    """Return the exceptions that mean a receiver has lost its connection.
+
+    Only the messaging library for the protocol is imported.
+    """
+    if protocol == Ssm2.AMS_MESSAGING:
+        from argo_ams_library import (AmsConnectionException,
+                                      AmsTimeoutException,
+                                      AmsBalancerException)
+        return (AmsConnectionException, AmsTimeoutException,
+                AmsBalancerException)
+
+    from stomp.exception import NotConnectedException
+    return (NotConnectedException,)
+
+
+def _open_daemon(dc):
+    """Open the daemon context, writing out log records before it forks."""
+    stop_logging()
+    dc.open()
+    start_logging()
+
+
 def run_receiver(protocol, brokers, project, token, cp, log, dn_file):
     """Run Ssm2 as a receiver daemon."""
-    if DaemonContext is None:
+    try:
+        from daemon import DaemonContext
+    except ImportError:
         log.error("Receiving SSMs must use python-daemon, but the "
                   "python-daemon module wasn't found.")
         log.error("System will exit.")
@@ -257,28 +455,42 @@ def run_receiver(protocol, brokers, project, token, cp, log, dn_file):
     log.info('The SSM will run as a daemon.')
 
     # We need to preserve the file descriptor for any log files.
-    rootlog = logging.getLogger()
-    log_files = [x.stream for x in rootlog.handlers]
-    dc = DaemonContext(files_preserve=log_files)
+    dc = DaemonContext(files_preserve=log_streams())
 
     try:
         ssm = Ssm2(brokers,
                    cp.get('messaging', 'path'),
+                   path_type=get_path_type(cp, log),
                    cert=cp.get('certificates', 'certificate'),
                    key=cp.get('certificates', 'key'),
-                   listen=cp.get('messaging', 'destination'),
+                   listen=get_destinations(cp),
                    use_ssl=cp.getboolean('broker', 'use_ssl'),
                    capath=cp.get('certificates', 'capath'),
                    check_crls=cp.getboolean('certificates', 'check_crls'),
                    pidfile=cp.get('daemon', 'pidfile'),
                    protocol=protocol,
                    project=project,
-                   token=token)
+                   token=token,
+                   max_msg_size=get_max_msg_size(cp),
+                   dedup_size=get_limit(cp, 'receiver', 'dedup_size'),
+                   status_socket=get_status_socket(cp),
+                   summary_interval=get_summary_interval(cp),
+                   **get_write_batching(cp),
+                   **get_watermarks(cp),
+                   **get_sharding(cp),
+                   **get_workers(cp))
 
         log.info('Fetching valid DNs.')
+        # The DNs are only reread when the file changes. Check it before
+        # reading so that any change made while reading is picked up later.
+        dn_monitor = DnFileMonitor(dn_file)
+        dn_monitor.changed()
         dns = get_dns(dn_file, log)
         ssm.set_dns(dns)
 
+        connection_errors = _connection_errors(protocol)
+        metrics_file = get_metrics_file(cp)
+
     except Exception as e:
         log.fatal('Failed to initialise SSM: %s', e)
         log.info(LOG_BREAK)
@@ -289,28 +501,41 @@ def run_receiver(protocol, brokers, project, token, cp, log, dn_file):
         # with dc:
         # here - we need to call the open() and close() methods
         # manually.
-        dc.open()
+        _open_daemon(dc)
         ssm.startup()
         i = 0
         # The message listening loop.
         while True:
             try:
                 time.sleep(0.1)
+                # Stop or start consuming depending on the queue depth.
+                ssm.check_backpressure()
                 if protocol == Ssm2.AMS_MESSAGING:
                     # We need to pull down messages as part of
                     # this loop when using AMS.
                     ssm.pull_msg_ams()
+                else:
+                    # Write out any batched messages that have waited long
+                    # enough, in case no more messages arrive to trigger it.
+                    ssm.flush_writes(force=False)
+
+                if i % (CHECK_DNS * 10) == 0 and dn_monitor.changed():
+                    log.info('DN file has changed. Refreshing valid DNs.')
+                    reload_dns(ssm, dn_file, log)
 
-                if i % (REFRESH_DNS * 10) == 0:
-                    log.info('Refreshing valid DNs and then sending ping.')
-                    dns = get_dns(dn_file, log)
-                    ssm.set_dns(dns)
+                if (i % (SEND_PING * 10) == 0 and
+                        protocol == Ssm2.STOMP_MESSAGING):
+                    log.info('Sending ping.')
+                    ssm.send_ping()
 
-                    if protocol == Ssm2.STOMP_MESSAGING:
-                        ssm.send_ping()
+                if (metrics_file is not None and
+                        i % (WRITE_METRICS * 10) == 0):
+                    ssm.write_metrics(metrics_file)
 
-            except (NotConnectedException, AmsConnectionException,
-                    AmsTimeoutException, AmsBalancerException) as error:
+                # Only logs if summary_interval has passed.
+                ssm.log_summary()
+
+            except connection_errors as error:
 
                 log.warning('Connection lost.')
                 log.debug(error)
@@ -319,7 +544,7 @@ def run_receiver(protocol, brokers, project, token, cp, log, dn_file):
                 log.info("Waiting for 10 minutes before restarting...")
                 time.sleep(10 * 60)
                 log.info('Restarting SSM.')
-                dc.open()
+                _open_daemon(dc)
                 ssm.startup()
 
             i += 1
@@ -347,8 +572,28 @@ def run_receiver(protocol, brokers, project, token, cp, log, dn_file):
         sys.exit(1)
 
 
+def reload_dns(ssm, dn_file, log):
+    """Give the SSM the DNs in dn_file, returning True if successful.
+
+    If the file can't be read or has no valid DNs, for example because it is
+    being rewritten, the SSM keeps the DNs it has and False is returned.
+    """
+    try:
+        dns = get_dns(dn_file, log)
+    except (IOError, OSError, Ssm2Exception) as error:
+        log.warning('Failed to reload valid DNs, keeping the current ones: '
+                    '%s', error)
+        return False
+    ssm.set_dns(dns)
+    return True
+
+
 def get_dns(dn_file, log):
-    """Retrieve a list of DNs from a file."""
+    """Retrieve a list of DNs from a file.
+
+    DNs may contain '*' to match any sequence of characters, for example
+    '/C=UK/O=eScience/OU=CLRC/L=RAL/CN=*' to allow any host at that site.
+    """
     dns = []
     f = None
     try:
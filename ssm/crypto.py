@@ -23,16 +23,50 @@
 from __future__ import print_function
 
 import base64
+import datetime
+import email
 import logging
 import OpenSSL
+import os
 import quopri
+import zlib
 from subprocess import Popen, PIPE
 
+try:
+    import zstandard
+except ImportError:
+    # CryptoException is raised later on if zstd is requested but not
+    # installed.
+    zstandard = None
+
 
 # logging configuration
 log = logging.getLogger(__name__)
 # Valid ciphers
-CIPHERS = ['aes128', 'aes192', 'aes256']
+CIPHERS = ['aes128', 'aes192', 'aes256',
+           'aes128-gcm', 'aes192-gcm', 'aes256-gcm']
+# Ciphers that need CMS AuthEnvelopedData, mapped to their openssl names
+_AEAD_CIPHERS = {'aes128-gcm': 'aes-128-gcm',
+                 'aes192-gcm': 'aes-192-gcm',
+                 'aes256-gcm': 'aes-256-gcm'}
+# Valid compression methods
+COMPRESSIONS = ['zlib', 'zstd']
+# The largest message, in bytes, that verify will decompress by default.
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+# Message types returned by get_message_type
+SIGNED = 'signed'
+ENCRYPTED = 'encrypted'
+# The most characters read from the start of a message to find its headers
+MAX_HEADER_SIZE = 4096
+# DER encodings of the content type OIDs that binary messages start with.
+_DER_TYPES = {
+    # PKCS#7 signed data
+    b'\x06\x09\x2a\x86\x48\x86\xf7\x0d\x01\x07\x02': SIGNED,
+    # PKCS#7 enveloped data
+    b'\x06\x09\x2a\x86\x48\x86\xf7\x0d\x01\x07\x03': ENCRYPTED,
+    # CMS authenticated enveloped data
+    b'\x06\x0b\x2a\x86\x48\x86\xf7\x0d\x01\x09\x10\x01\x17': ENCRYPTED,
+}
 
 
 class CryptoException(Exception):
@@ -49,7 +83,10 @@ def _from_file(filename):
 
 
 def check_cert_key(certpath, keypath):
-    """Check that a certificate and a key match."""
+    """Check that a certificate and a key match.
+
+    This works for any key type, including RSA, ECDSA and Ed25519.
+    """
     try:
         cert = _from_file(certpath)
         key = _from_file(keypath)
@@ -88,20 +125,257 @@ def check_cert_key(certpath, keypath):
 
     return certificate_public_key.strip() == private_public_key.strip()
 
-def sign(text, certpath, keypath):
+
+class Credentials(object):
+    """The host certificate and key, and optional encryption certificate.
+
+    Each file is read and parsed at most once, when first needed, and the
+    startup checks are done in process rather than by running openssl. The
+    paths are still used by openssl when signing and encrypting, and for
+    TLS connections.
+    """
+
+    def __init__(self, certpath, keypath, enc_certpath=None):
+        """Set the paths of the files, without reading them yet."""
+        self.certpath = certpath
+        self.keypath = keypath
+        self.enc_certpath = enc_certpath
+        # Maps each path, and how it was parsed, to its parsed contents.
+        self._loaded = {}
+
+    def _load(self, path, loader):
+        """Return the PEM file at path parsed by loader, reading it once."""
+        if (path, loader) not in self._loaded:
+            try:
+                self._loaded[path, loader] = loader(
+                    OpenSSL.crypto.FILETYPE_PEM, _from_file(path)
+                )
+            except OpenSSL.crypto.Error as error:
+                log.error(error)
+                raise CryptoException('Could not load %s: %s'
+                                      % (path, error))
+        return self._loaded[path, loader]
+
+    @property
+    def cert(self):
+        """The host certificate, as an OpenSSL.crypto.X509."""
+        return self._load(self.certpath, OpenSSL.crypto.load_certificate)
+
+    @property
+    def key(self):
+        """The host key, as an OpenSSL.crypto.PKey."""
+        return self._load(self.keypath, OpenSSL.crypto.load_privatekey)
+
+    @property
+    def enc_cert(self):
+        """The encryption certificate, or None if there isn't one."""
+        if self.enc_certpath is None:
+            return None
+        return self._load(self.enc_certpath, OpenSSL.crypto.load_certificate)
+
+    @property
+    def subject(self):
+        """The host certificate subject's DN, in legacy openssl format."""
+        return _get_subject_components(self.cert.get_subject())
+
+    @property
+    def enc_subject(self):
+        """The encryption certificate subject's DN, in legacy format."""
+        return _get_subject_components(self.enc_cert.get_subject())
+
+    def key_matches(self):
+        """Check that the host certificate and key match."""
+        try:
+            cert_public_key = OpenSSL.crypto.dump_publickey(
+                OpenSSL.crypto.FILETYPE_PEM, self.cert.get_pubkey()
+            )
+            key_public_key = OpenSSL.crypto.dump_publickey(
+                OpenSSL.crypto.FILETYPE_PEM, self.key
+            )
+        except IOError as e:
+            log.error('Could not find cert or key file: %s', e)
+            return False
+        except CryptoException:
+            return False
+
+        return cert_public_key == key_public_key
+
+    @staticmethod
+    def in_date(certificate, seconds=86400):
+        """Check that a certificate won't have expired in seconds' time.
+
+        This is the in process equivalent of verify_cert_date.
+        """
+        not_after = datetime.datetime.strptime(
+            certificate.get_notAfter().decode('ascii'), '%Y%m%d%H%M%SZ'
+        ).replace(tzinfo=datetime.timezone.utc)
+        remaining = not_after - datetime.datetime.now(datetime.timezone.utc)
+        return remaining > datetime.timedelta(seconds=seconds)
+
+    def verify_enc_cert(self, capath, check_crls=True):
+        """Verify the encryption certificate against the CAs in capath.
+
+        This is the in process equivalent of verify_cert_path.
+        """
+        if capath is None:
+            raise CryptoException('Invalid None argument to '
+                                  'verify_enc_cert().')
+
+        store = OpenSSL.crypto.X509Store()
+        store.load_locations(None, capath)
+        if check_crls:
+            store.set_flags(OpenSSL.crypto.X509StoreFlags.CRL_CHECK |
+                            OpenSSL.crypto.X509StoreFlags.CRL_CHECK_ALL)
+        try:
+            OpenSSL.crypto.X509StoreContext(
+                store, self.enc_cert
+            ).verify_certificate()
+        except OpenSSL.crypto.X509StoreContextError as error:
+            log.warning('Certificate verification: %s', error)
+            return False
+        return True
+
+
+def _stdin_and_input(data):
+    """Return the stdin and input to use to pass data to a subprocess.
+
+    A file object is used directly as the subprocess's stdin, so that openssl
+    reads the data from disk rather than it first being read into memory.
+    """
+    if hasattr(data, 'fileno'):
+        # A buffered file may have read ahead of its position, so make sure
+        # the subprocess starts reading from the same place.
+        try:
+            os.lseek(data.fileno(), data.tell(), os.SEEK_SET)
+        except OSError:
+            # Pipes can't seek, but are read from wherever they are.
+            pass
+        return data, None
+    return PIPE, data
+
+
+def compress(text, method):
+    """Return a MIME entity holding the message compressed using method.
+
+    The message can be a string, bytes or a file object. The compression
+    method is given in a Content-Encoding header so that verify can undo it.
+    """
+    if hasattr(text, 'read'):
+        text = text.read()
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+
+    if method == 'zlib':
+        compressed = zlib.compress(text)
+    elif method == 'zstd':
+        if zstandard is None:
+            raise CryptoException('zstd compression requested but the '
+                                  'zstandard module wasn\'t found.')
+        compressed = zstandard.ZstdCompressor().compress(text)
+    else:
+        raise CryptoException('Invalid compression method %s.' % method)
+
+    return ('Content-Type: application/octet-stream\n'
+            'Content-Encoding: %s\n'
+            'Content-Transfer-Encoding: base64\n\n%s'
+            % (method, base64.encodebytes(compressed).decode('ascii')))
+
+
+def _decompress(data, method, max_size):
+    """Undo compress, given the compressed bytes and the method used.
+
+    A CryptoException is raised rather than decompressing more than max_size
+    bytes, so that a small message can't expand to fill the memory.
+    """
+    if method == 'zlib':
+        try:
+            decompressor = zlib.decompressobj()
+            text = decompressor.decompress(data, max_size + 1)
+        except zlib.error as e:
+            raise CryptoException('Failed to decompress message: %s' % e)
+        if len(text) > max_size or decompressor.unconsumed_tail:
+            raise CryptoException('Decompressed message is larger than %s '
+                                  'bytes.' % max_size)
+        if not decompressor.eof:
+            raise CryptoException('Failed to decompress message: '
+                                  'incomplete or truncated stream')
+        return text
+    if method == 'zstd' and zstandard is not None:
+        chunks = []
+        size = 0
+        try:
+            # Read at most one byte more than allowed, whatever size the
+            # frame claims to have.
+            with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+                while size <= max_size:
+                    chunk = reader.read(max_size + 1 - size)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                    size += len(chunk)
+        except zstandard.ZstdError as e:
+            raise CryptoException('Failed to decompress message: %s' % e)
+        if size > max_size:
+            raise CryptoException('Decompressed message is larger than %s '
+                                  'bytes.' % max_size)
+        return b''.join(chunks)
+    raise CryptoException('Unsupported content encoding %s.' % method)
+
+
+def is_der(message):
+    """Return True if the message is in binary (DER) rather than SMIME form.
+
+    This only looks at the first byte, which starts an ASN.1 sequence in DER
+    and can't start an SMIME message.
+    """
+    return isinstance(message, bytes) and message[:1] == b'\x30'
+
+
+def sign(text, certpath, keypath, compression=None, der=False):
     """Sign the message using the certificate and key in the files specified.
 
-    Returns the signed message as an SMIME string, suitable for transmission.
+    The message can be a string or a file object opened on a real file. If
+    compression is one of COMPRESSIONS, the message is compressed before it
+    is signed.
+
+    RSA and ECDSA (P-256 or P-384) keys are supported. Ed25519 keys need an
+    openssl that can sign CMS messages with them, which 3.0 can't.
+
+    Returns the signed message as an SMIME string, suitable for transmission,
+    or if der is True as binary DER encoded bytes, which are about half the
+    size as there is no base64 encoding.
     """
+    args = ['openssl', 'smime', '-sign', '-inkey', keypath,
+            '-signer', certpath]
+    if compression is None:
+        # Add a text/plain header to the message.
+        args.append('-text')
+    else:
+        # The compressed message is a MIME entity with its own headers.
+        text = compress(text, compression)
+    if der:
+        # DER output has to include the message rather than have it
+        # alongside the signature.
+        args.extend(['-nodetach', '-outform', 'DER'])
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+
+    stdin, text = _stdin_and_input(text)
     try:
-        p1 = Popen(['openssl', 'smime', '-sign', '-inkey',
-                    keypath, '-signer', certpath, '-text'],
-                   stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                   universal_newlines=True)
+        p1 = Popen(args, stdin=stdin, stdout=PIPE, stderr=PIPE,
+                   universal_newlines=not der)
 
         signed_msg, error = p1.communicate(text)
 
-        if (error != ''):
+        if p1.returncode != 0:
+            # For example, the key type can't be used to sign CMS messages
+            # by this version of openssl.
+            if der:
+                error = error.decode('utf-8', 'replace')
+            log.error(error)
+            raise CryptoException('Message signing failed. Check that the '
+                                  'key type is supported by openssl.')
+        if error:
             log.error(error)
 
         return signed_msg
@@ -111,28 +385,102 @@ def sign(text, certpath, keypath):
         raise CryptoException('Message signing failed. Check cert and key permissions.')
 
 
-def encrypt(text, certpath, cipher='aes128'):
+def encrypt(text, certpath, cipher='aes128', der=False):
     """Encrypt the specified message using the certificate string.
 
-    Returns the encrypted SMIME text suitable for transmission
+    The message can be a string or a file object opened on a real file, or
+    bytes if der is True.
+
+    The GCM ciphers are authenticated, so need no separate integrity check,
+    and are much faster on CPUs with AES instructions, but produce CMS
+    AuthEnvelopedData, which only receivers that decrypt with openssl cms
+    can read.
+
+    Returns the encrypted SMIME text suitable for transmission, or if der is
+    True the encrypted message as binary DER encoded bytes.
     """
     if cipher not in CIPHERS:
         raise CryptoException('Invalid cipher %s.' % cipher)
 
-    cipher = '-' + cipher
+    if cipher in _AEAD_CIPHERS:
+        args = ['openssl', 'cms', '-encrypt', '-' + _AEAD_CIPHERS[cipher]]
+    else:
+        args = ['openssl', 'smime', '-encrypt', '-' + cipher]
+    if der:
+        # Encrypt the bytes as they are, without treating them as text.
+        args.extend(['-binary', '-outform', 'DER'])
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+    args.append(certpath)
+
+    stdin, text = _stdin_and_input(text)
     # encrypt
-    p1 = Popen(['openssl', 'smime', '-encrypt', cipher, certpath],
-               stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    p1 = Popen(args, stdin=stdin, stdout=PIPE, stderr=PIPE,
+               universal_newlines=not der)
 
     enc_txt, error = p1.communicate(text)
 
-    if (error != ''):
+    if error:
         log.error(error)
 
     return enc_txt
 
 
-def verify(signed_text, capath, check_crl):
+def get_message_type(text):
+    """Return the type of an S/MIME message from its headers alone.
+
+    Only the MIME headers at the start of the message are looked at, so this
+    is cheap whatever the size of the message, and can be used to reject
+    junk before any openssl processes are started. For a binary (DER)
+    message, only its content type at the start is looked at.
+
+    Returns SIGNED, ENCRYPTED or None if the message isn't S/MIME.
+    """
+    if is_der(text):
+        # The OID follows the length of the outer sequence.
+        for oid, message_type in _DER_TYPES.items():
+            if text.find(oid, 0, 32) != -1:
+                return message_type
+        return None
+    if isinstance(text, bytes):
+        return None
+
+    head = text[:MAX_HEADER_SIZE].replace('\r\n', '\n')
+    headers, blankline, _ = head.partition('\n\n')
+    if not blankline:
+        # No end to the headers, or too many of them.
+        return None
+
+    content_type = None
+    for line in headers.split('\n'):
+        if line[:1] in (' ', '\t') and content_type is not None:
+            # Continuation of a folded Content-Type header.
+            content_type += line
+            continue
+        name, colon, value = line.partition(':')
+        if not colon:
+            return None
+        if name.strip().lower() == 'content-type':
+            content_type = value
+        elif content_type is not None:
+            break
+
+    if content_type is None:
+        return None
+    content_type = content_type.strip().lower()
+
+    if content_type.startswith('multipart/signed'):
+        return SIGNED
+    if content_type.startswith(('application/pkcs7-mime',
+                                'application/x-pkcs7-mime')):
+        # Signed messages can also be sent in opaque form.
+        if 'signed-data' in content_type:
+            return SIGNED
+        return ENCRYPTED
+    return None
+
+
+def verify(signed_text, capath, check_crl, max_size=None):
     """Verify the signed message has been signed by the certificate.
 
     Verify the signed message has been signed by the certificate (attached to
@@ -142,14 +490,19 @@ def verify(signed_text, capath, check_crl):
     Returns a tuple including the signer's certificate and the plain-text of
     the message if it has been verified. If the content transfer encoding is
     specified as 'quoted-printable' or 'base64', decode the message body
-    accordingly.
+    accordingly. If the message was compressed, as given by its content
+    encoding, it is decompressed once it has been verified, unless it would
+    be larger than max_size bytes (MAX_DECOMPRESSED_SIZE if not given).
     """
     if signed_text is None or capath is None:
         raise CryptoException('Invalid None argument to verify().')
-    # This ensures that openssl knows that the string is finished.
-    # It makes no difference if the signed message is correct, but
-    # prevents it from hanging in the case of an empty string.
-    signed_text += '\n\n'
+
+    der = is_der(signed_text)
+    if not der:
+        # This ensures that openssl knows that the string is finished.
+        # It makes no difference if the signed message is correct, but
+        # prevents it from hanging in the case of an empty string.
+        signed_text += '\n\n'
 
     signer = get_signer_cert(signed_text)
 
@@ -159,30 +512,24 @@ def verify(signed_text, capath, check_crl):
     # The -noverify flag removes the certificate verification.  The certificate
     # is verified above; this check would also check that the certificate
     # is allowed to sign with SMIME, which host certificates sometimes aren't.
-    p1 = Popen(['openssl', 'smime', '-verify', '-CApath', capath, '-noverify'],
-               stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    args = ['openssl', 'smime', '-verify', '-CApath', capath, '-noverify']
+    if der:
+        args.extend(['-inform', 'DER'])
+    p1 = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+               universal_newlines=not der)
 
     message, error = p1.communicate(signed_text)
-
-    # SMIME header and message body are separated by a blank line
-    lines = message.strip().splitlines()
-    try:
-        blankline = lines.index('')
-    except ValueError:
+    if der:
+        # Decode the output as universal_newlines would have.
+        message = message.decode('utf-8', 'replace').replace('\r\n', '\n')
+        error = error.decode('utf-8', 'replace')
+
+    # SMIME header and message body are separated by a blank line. Split on
+    # the first one rather than splitting the whole message into lines, to
+    # avoid making several copies of large messages.
+    headers, blankline, body = message.strip().partition('\n\n')
+    if not blankline:
         raise CryptoException('No blank line between message header and body')
-    headers = '\n'.join(lines[:blankline])
-    body = '\n'.join(lines[blankline + 1:])
-    # two possible encodings
-    if 'quoted-printable' in headers:
-        body = quopri.decodestring(body)
-    elif 'base64' in headers:
-        body = base64.decodestring(body)
-    # otherwise, plain text
-
-    # In Python 3, decodestring() returns bytes so decode to a string while
-    # Python 2 compatability is still required.
-    if not isinstance(body, str):
-        body = body.decode()
 
     # 'openssl smime' returns "Verification successful" to standard error. We
     # don't want to log this as an error each time, but we do want to see if
@@ -194,6 +541,25 @@ def verify(signed_text, capath, check_crl):
             "Possible tampering. See OpenSSL error: %s" % error
         )
 
+    # two possible encodings
+    if 'quoted-printable' in headers:
+        body = quopri.decodestring(body)
+    elif 'base64' in headers:
+        body = base64.decodebytes(body.encode('ascii'))
+    # otherwise, plain text
+
+    # Only decompress the message now that it is known to be genuine.
+    for line in headers.split('\n'):
+        name, _colon, value = line.partition(':')
+        if name.strip().lower() == 'content-encoding':
+            body = _decompress(body, value.strip().lower(),
+                               max_size or MAX_DECOMPRESSED_SIZE)
+
+    # In Python 3, decodestring() returns bytes so decode to a string while
+    # Python 2 compatability is still required.
+    if not isinstance(body, str):
+        body = body.decode()
+
     subj = get_certificate_subject(signer)
     return body, subj
 
@@ -206,22 +572,39 @@ def decrypt(encrypted_text, certpath, keypath):
     CAs that we accept.
 
     This decryption function can be used whether or not OpenSSL is used to
-    encrypt the data.
+    encrypt the data. Both enveloped and authenticated enveloped (AES-GCM)
+    messages are accepted.
+
+    A binary (DER) message is decrypted to bytes, otherwise to a string.
     """
-    # This ensures that openssl knows that the string is finished.
-    # It makes no difference if the signed message is correct, but
-    # prevents it from hanging in the case of an empty string.
-    encrypted_text += '\n\n'
+    args = ['openssl', 'cms', '-decrypt',
+            '-recip', certpath, '-inkey', keypath]
+    der = is_der(encrypted_text)
+    if der:
+        # Output the decrypted bytes as they are.
+        args.extend(['-inform', 'DER', '-binary'])
+    else:
+        # This ensures that openssl knows that the string is finished.
+        # It makes no difference if the signed message is correct, but
+        # prevents it from hanging in the case of an empty string.
+        encrypted_text += '\n\n'
 
     log.info('Decrypting message.')
 
-    p1 = Popen(['openssl', 'smime', '-decrypt',
-                '-recip', certpath, '-inkey', keypath],
-               stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    p1 = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+               universal_newlines=not der)
 
     enc_txt, error = p1.communicate(encrypted_text)
 
-    if (error != ''):
+    if p1.returncode != 0:
+        # openssl writes out what it has decrypted before checking the
+        # authentication tag of AES-GCM messages, so that has to be thrown
+        # away if the check fails.
+        if der:
+            error = error.decode('utf-8', 'replace')
+        raise CryptoException(error.strip() or 'openssl returned %s'
+                              % p1.returncode)
+    if error:
         log.error(error)
 
     return enc_txt
@@ -328,8 +711,54 @@ def get_certificate_subject(certstring):
     return _get_subject_components(subject_x509name)
 
 
+def peek_signer(signed_text):
+    """Return the subject of the certificate a signed message was signed with.
+
+    The certificate is read in process without anything being verified, so
+    the subject must only be used where a forged one does no harm, such as
+    to schedule work. Returns None if no certificate could be found.
+    """
+    if is_der(signed_text):
+        parts = []
+        der_signature = signed_text
+    else:
+        parts = email.message_from_string(signed_text).walk()
+        der_signature = None
+
+    for part in parts:
+        if part.get_content_type() in ('application/pkcs7-signature',
+                                       'application/x-pkcs7-signature',
+                                       'application/pkcs7-mime',
+                                       'application/x-pkcs7-mime'):
+            der_signature = part.get_payload(decode=True)
+            break
+
+    if der_signature is None:
+        return None
+    # Only receivers need this, so it isn't imported with the module.
+    from cryptography.hazmat.primitives.serialization import pkcs7
+    try:
+        certificates = pkcs7.load_der_pkcs7_certificates(der_signature)
+    except (ValueError, TypeError):
+        return None
+    if certificates:
+        return certificates[0].subject.rfc4514_string()
+    return None
+
+
 def get_signer_cert(signed_text):
     """Return the signer's certificate from the signed specified message."""
+    if is_der(signed_text):
+        # The message is already the PKCS7 structure, in DER.
+        p2 = Popen(['openssl', 'pkcs7', '-inform', 'DER', '-print_certs'],
+                   stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        certstring, error = p2.communicate(signed_text)
+
+        if error:
+            log.error(error.decode('utf-8', 'replace'))
+
+        return certstring.decode('ascii', 'replace')
+
     # This ensures that openssl knows that the string is finished.
     # It makes no difference if the signed message is correct, but
     # prevents it from hanging in the case of an empty string.
@@ -0,0 +1,282 @@
+# Copyright 2026 UK Research and Innovation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module contains the DirqQueue and IncomingQueue classes.
+
+It requires the dirq module, so should only be imported if dirq is installed.
+"""
+from __future__ import print_function
+
+import errno
+import json
+import logging
+import os
+import time
+
+from dirq.QueueSimple import QueueSimple, LOCKED_SUFFIX, TEMPORARY_SUFFIX
+from dirq.queue import Queue
+from dirq.QueueBase import (_DIRECTORY_REGEXP, _ELEMENT_REGEXP,
+                            _special_rmdir)
+
+# logging configuration
+log = logging.getLogger(__name__)
+
+
+class DirqQueue(QueueSimple):
+    """A dirq QueueSimple with cached counts and incremental purging.
+
+    The on-disk layout is unchanged, so this can be used on an existing
+    QueueSimple directory and alongside other QueueSimple users.
+    """
+
+    # File in the top level directory used to remember where the last
+    # incremental purge stopped. Its name doesn't match the intermediate
+    # directory pattern, so dirq ignores it.
+    PURGE_STATE_FILE = '.purge_state'
+
+    def __init__(self, path, purge_max_dirs=None, purge_max_time=None,
+                 full_purge_interval=None, **kwargs):
+        """Create a new DirqQueue, passing any other arguments to QueueSimple.
+
+        If purge_max_dirs or purge_max_time is set, purge() only works
+        through that many intermediate directories or seconds per call,
+        carrying on from where the previous call stopped. A full purge is
+        then only done every full_purge_interval seconds, if that is set.
+        """
+        super(DirqQueue, self).__init__(path, **kwargs)
+        # Maps each intermediate directory to a tuple of the mtime it had and
+        # the number of elements it held when last counted.
+        self._dir_counts = {}
+        self.purge_max_dirs = purge_max_dirs
+        self.purge_max_time = purge_max_time
+        self.full_purge_interval = full_purge_interval
+
+    def _intermediate_dirs(self):
+        """Return a sorted list of the intermediate directory names."""
+        return sorted(name for name in os.listdir(self.path)
+                      if _DIRECTORY_REGEXP.match(name))
+
+    def _dir_mtime(self, name):
+        """Return the mtime of an intermediate directory or None if missing."""
+        try:
+            return os.stat('%s/%s' % (self.path, name)).st_mtime_ns
+        except OSError:
+            return None
+
+    def count(self):
+        """Return the number of elements in the queue, locked or not.
+
+        Only intermediate directories that have been modified since they were
+        last counted are listed again, the rest just need a stat call.
+        """
+        dir_counts = {}
+        for name in self._intermediate_dirs():
+            mtime = self._dir_mtime(name)
+            if mtime is None:
+                # Directory was purged after it was listed.
+                continue
+            cached = self._dir_counts.get(name)
+            if cached is not None and cached[0] == mtime:
+                dir_counts[name] = cached
+                continue
+            elements = 0
+            for element in os.listdir('%s/%s' % (self.path, name)):
+                if _ELEMENT_REGEXP.match(element):
+                    elements += 1
+            dir_counts[name] = (mtime, elements)
+        self._dir_counts = dir_counts
+        return sum(elements for _mtime, elements in dir_counts.values())
+
+    def is_empty(self):
+        """Return True if there are no elements in the queue.
+
+        This stops at the first element found, so its cost doesn't depend on
+        the size of the queue.
+        """
+        for name in self._intermediate_dirs():
+            try:
+                for entry in os.scandir('%s/%s' % (self.path, name)):
+                    if _ELEMENT_REGEXP.match(entry.name):
+                        return False
+            except OSError:
+                # Directory was purged after it was listed.
+                continue
+        return True
+
+    def add(self, data):
+        """Add data to the queue and return the element name."""
+        expected_dir = self._add_dir()
+        mtime = self._dir_mtime(expected_dir)
+        name = super(DirqQueue, self).add(data)
+        self._update_dir_count(name, expected_dir, mtime, 1)
+        return name
+
+    def added_time(self, name):
+        """Return when the named element was added, or None if it's gone.
+
+        This is its modification time, so must be read before it is locked,
+        as locking an element updates it. get_path can't be used here, as it
+        returns the path of the lock.
+        """
+        try:
+            return os.stat('%s/%s' % (self.path, name)).st_mtime
+        except OSError:
+            return None
+
+    def remove(self, name):
+        """Remove a locked element from the queue."""
+        dir_name = name.split('/')[0]
+        mtime = self._dir_mtime(dir_name)
+        super(DirqQueue, self).remove(name)
+        self._update_dir_count(name, dir_name, mtime, -1)
+
+    def _update_dir_count(self, name, dir_name, mtime_before, change):
+        """Apply a change made by this object to the cached counts.
+
+        The count for the directory is only adjusted if it was still valid
+        immediately before the change, otherwise it is dropped so that it is
+        recounted next time.
+        """
+        cached = self._dir_counts.get(dir_name)
+        if (name.split('/')[0] == dir_name and cached is not None
+                and mtime_before is not None and cached[0] == mtime_before):
+            self._dir_counts[dir_name] = (self._dir_mtime(dir_name),
+                                          cached[1] + change)
+        else:
+            self._dir_counts.pop(name.split('/')[0], None)
+
+    def purge(self, maxtemp=300, maxlock=600):
+        """Purge the queue, incrementally if purge limits have been set.
+
+        Removes unused intermediate directories, too old temporary elements
+        and unlocks too old locked elements, as QueueSimple.purge does.
+        """
+        if self.purge_max_dirs is None and self.purge_max_time is None:
+            super(DirqQueue, self).purge(maxtemp, maxlock)
+            return
+
+        state = self._read_purge_state()
+        now = time.time()
+        if (self.full_purge_interval is not None and
+                now - state['last_full'] >= self.full_purge_interval):
+            log.info('Doing a full purge of the message queue.')
+            super(DirqQueue, self).purge(maxtemp, maxlock)
+            state = {'cursor': '', 'last_full': now}
+        else:
+            state['cursor'] = self._purge_slice(state['cursor'], maxtemp,
+                                                maxlock)
+        self._write_purge_state(state)
+
+    def _purge_slice(self, cursor, maxtemp, maxlock):
+        """Purge the intermediate directories that come after cursor.
+
+        Stops once the purge limits are reached and returns the name of the
+        last directory purged, or an empty string if the end of the queue was
+        reached so that the next slice starts from the beginning again.
+        """
+        dirs = self._intermediate_dirs()
+        # The newest directory is never removed as it may still be in use.
+        newest = dirs[-1] if dirs else None
+        oldtemp = maxtemp and time.time() - maxtemp
+        oldlock = maxlock and time.time() - maxlock
+        start_time = time.time()
+
+        purged = 0
+        for name in dirs:
+            if name <= cursor:
+                continue
+            if ((self.purge_max_dirs is not None and
+                    purged >= self.purge_max_dirs) or
+                    (self.purge_max_time is not None and
+                     time.time() - start_time >= self.purge_max_time)):
+                log.debug('Purged %s directories, stopping at %s.',
+                          purged, cursor)
+                return cursor
+            self._purge_dir(name, oldtemp, oldlock, name != newest)
+            cursor = name
+            purged += 1
+
+        log.debug('Purged %s directories, reached end of queue.', purged)
+        return ''
+
+    def _purge_dir(self, name, oldtemp, oldlock, removable):
+        """Purge a single intermediate directory.
+
+        Too old temporary and locked elements are removed, which for locked
+        elements means unlocking them. If removable is True, the directory is
+        removed if it is then empty.
+        """
+        path = '%s/%s' % (self.path, name)
+        try:
+            entries = os.listdir(path)
+        except OSError:
+            # Directory was removed after it was listed.
+            return
+
+        for entry in entries:
+            if entry.endswith(TEMPORARY_SUFFIX):
+                oldest = oldtemp
+            elif entry.endswith(LOCKED_SUFFIX):
+                oldest = oldlock
+            else:
+                continue
+            if not oldest:
+                continue
+            try:
+                if os.stat('%s/%s' % (path, entry)).st_mtime >= oldest:
+                    continue
+                log.warning('Removing too old volatile file: %s/%s',
+                            path, entry)
+                os.unlink('%s/%s' % (path, entry))
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+
+        if removable and not os.listdir(path):
+            _special_rmdir(path)
+            self._dir_counts.pop(name, None)
+
+    def _read_purge_state(self):
+        """Return the saved incremental purge state, or a fresh state."""
+        try:
+            with open(os.path.join(self.path, self.PURGE_STATE_FILE)) as f:
+                state = json.load(f)
+            return {'cursor': str(state['cursor']),
+                    'last_full': float(state['last_full'])}
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            # No state saved yet, or it is unreadable, so start from the
+            # beginning. The last full purge is taken to be now so that a
+            # large queue isn't fully purged on the first run.
+            return {'cursor': '', 'last_full': time.time()}
+
+    def _write_purge_state(self, state):
+        """Save the incremental purge state, replacing it atomically."""
+        path = os.path.join(self.path, self.PURGE_STATE_FILE)
+        tmp_path = '%s.%s' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as error:
+            log.warning('Failed to save purge state: %s', error)
+
+
+class IncomingQueue(Queue):
+    """A dirq Queue with the same interface as the other incoming stores."""
+
+    def add_batch(self, data_list):
+        """Add several elements and return their names.
+
+        dirq has no transactions, so this simply adds each element in turn.
+        """
+        return [self.add(data) for data in data_list]
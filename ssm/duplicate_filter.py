@@ -0,0 +1,136 @@
+# Copyright 2026 UK Research and Innovation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module contains the DuplicateFilter class."""
+from __future__ import print_function
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+# logging configuration
+log = logging.getLogger(__name__)
+
+
+class DuplicateFilter(object):
+    """Remembers recently received messages so that duplicates can be dropped.
+
+    A message is identified by a digest of its empa-id, signer and body.
+    Digests are kept in an SQLite database so that they survive restarts,
+    and only the max_entries most recently seen are kept. A message should
+    only be remembered once it has been saved, so that if it is lost before
+    then its redelivery isn't dropped.
+    """
+
+    # How many new digests to add between trimming the oldest ones.
+    TRIM_EVERY = 1000
+
+    def __init__(self, path, max_entries):
+        """Keep the database of digests in the file path."""
+        self.path = path
+        self.max_entries = max_entries
+        self._added = 0
+
+        # Messages may be checked from the STOMP receiver thread, so access
+        # to the connection is serialised with a lock.
+        self._lock = threading.RLock()
+        # The database isn't opened until open is called or it is first
+        # used, so that a receiver can create the filter before becoming a
+        # daemon, which closes any open files.
+        self._connection = None
+
+    @property
+    def _conn(self):
+        """The database connection, opened if it isn't already."""
+        self.open()
+        return self._connection
+
+    def open(self):
+        """Open the database, if it isn't already open."""
+        with self._lock:
+            if self._connection is not None:
+                return
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Losing the last few digests on a power cut only lets a few
+            # duplicates through, so don't wait for each one to reach the
+            # disk.
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS seen ('
+                             'digest TEXT PRIMARY KEY, last_seen REAL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS seen_last_seen '
+                             'ON seen (last_seen)')
+            self._connection = conn
+            self._trim()
+
+    @staticmethod
+    def digest(empaid, signer, body):
+        """Return the digest identifying a message."""
+        sha = hashlib.sha256()
+        for part in (empaid, signer, body):
+            if not isinstance(part, bytes):
+                part = str(part).encode('utf-8')
+            sha.update(part)
+            # Separate the parts so that they can't run into each other.
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    def is_duplicate(self, digest):
+        """Return True if the message with digest has been remembered.
+
+        If so, it becomes the most recently seen.
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'UPDATE seen SET last_seen = ? WHERE digest = ?',
+                (time.time(), digest)
+            )
+        return cursor.rowcount > 0
+
+    def remember(self, digests):
+        """Remember the messages with digests, which have been saved."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO seen VALUES (?, ?)',
+                                   [(digest, now) for digest in digests])
+            self._added += len(digests)
+
+        if self._added >= DuplicateFilter.TRIM_EVERY:
+            self._trim()
+
+    def _trim(self):
+        """Forget the least recently seen digests beyond max_entries."""
+        with self._lock, self._conn:
+            self._added = 0
+            count = self._conn.execute(
+                'SELECT COUNT(*) FROM seen'
+            ).fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM seen WHERE digest IN ('
+                    'SELECT digest FROM seen ORDER BY last_seen LIMIT ?)',
+                    (count - self.max_entries,)
+                )
+                log.debug('Forgot %s old message digests.',
+                          count - self.max_entries)
+
+    def close(self):
+        """Close the database connection, until open is called again."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,170 @@
+# Copyright 2026 UK Research and Innovation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module contains the FairQueue class."""
+from __future__ import print_function
+
+import collections
+import threading
+import time
+
+# Marks that no key is having its turn, as None can be a key.
+_NO_KEY = object()
+
+
+class FairQueue(object):
+    """A thread-safe work queue that is fair between the keys of its items.
+
+    Items are taken from each key in turn by deficit round robin, so a key
+    with a large backlog can't hold up the others. Each turn a key can take
+    items up to a total cost of quantum, plus whatever it didn't use of its
+    previous turn while it had items waiting. Optionally, the items taken
+    for any one key are limited to rate per second, with bursts of up to
+    burst items. Items put with the key None are never rate limited.
+    """
+
+    def __init__(self, quantum=1, rate=None, burst=None):
+        """Create an empty FairQueue."""
+        self.quantum = quantum
+        self.rate = rate
+        # A key must be able to build up at least one token.
+        self.burst = max(burst or rate or 1, 1)
+        # Items waiting for each key, for keys with any waiting, with the
+        # key whose turn it is first.
+        self._queues = collections.OrderedDict()
+        self._deficits = {}
+        # The key that has had its quantum for the current turn.
+        self._current = _NO_KEY
+        # Maps each key to its rate limiting tokens and when they were set.
+        self._tokens = {}
+        self._size = 0
+        # Items put but not yet marked done, as for queue.Queue.
+        self._unfinished = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        """Return the number of items waiting to be taken."""
+        return self._size
+
+    def put(self, key, item, cost=1):
+        """Add an item for key, with the cost it counts for when taken."""
+        with self._cond:
+            if key not in self._queues:
+                self._queues[key] = collections.deque()
+                self._deficits[key] = 0
+            self._queues[key].append((cost, item))
+            self._size += 1
+            self._unfinished += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Take the next item, waiting for one if necessary.
+
+        Returns None if timeout seconds pass without an item being available,
+        or once the queue has been closed and is empty.
+        """
+        if timeout is not None:
+            end_time = time.time() + timeout
+        with self._cond:
+            while True:
+                entry, wait = self._next_entry()
+                if entry is not None:
+                    return entry[1]
+                if self._closed and not self._size:
+                    return None
+                if timeout is not None:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return None
+                    wait = min(wait or remaining, remaining)
+                self._cond.wait(wait)
+
+    def task_done(self):
+        """Mark an item that was taken as finished with, as for queue.Queue."""
+        with self._cond:
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._cond.notify_all()
+
+    def join(self):
+        """Wait until every item that has been put is marked done."""
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+    def close(self):
+        """Stop waiting for items, so get returns None once it is empty."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _next_entry(self):
+        """Remove and return the next (cost, item) tuple.
+
+        Returns None and the seconds until a rate limited key may have an
+        item, or None, if no item can be taken now.
+        """
+        wait = None
+        limited = 0
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            delay = self._rate_delay(key)
+            if delay:
+                # Skip the key's turn, without it building up a deficit.
+                wait = delay if wait is None else min(wait, delay)
+                self._end_turn(key)
+                self._deficits[key] = 0
+                limited += 1
+                if limited >= len(self._queues):
+                    break
+                continue
+            limited = 0
+
+            if key != self._current:
+                self._current = key
+                self._deficits[key] += self.quantum
+            cost = queue[0][0]
+            if cost > self._deficits[key]:
+                self._end_turn(key)
+                continue
+
+            self._deficits[key] -= cost
+            self._size -= 1
+            if self.rate and key is not None:
+                self._tokens[key][0] -= 1
+            entry = queue.popleft()
+            if not queue:
+                # A key doesn't keep its deficit while it has nothing waiting.
+                del self._queues[key]
+                del self._deficits[key]
+                self._current = _NO_KEY
+            return entry, None
+        return None, wait
+
+    def _end_turn(self, key):
+        """Move key to the back of the round."""
+        self._queues.move_to_end(key)
+        self._current = _NO_KEY
+
+    def _rate_delay(self, key):
+        """Return the seconds until key may have an item, or 0 if now."""
+        if not self.rate or key is None:
+            return 0
+        now = time.time()
+        tokens = self._tokens.setdefault(key, [self.burst, now])
+        tokens[0] = min(self.burst, tokens[0] + (now - tokens[1]) * self.rate)
+        tokens[1] = now
+        if tokens[0] >= 1:
+            return 0
+        return (1 - tokens[0]) / self.rate
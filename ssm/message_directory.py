@@ -14,6 +14,7 @@
 """This module contains the MessageDirectory class."""
 from __future__ import print_function
 
+import heapq
 import logging
 import os
 import uuid
@@ -28,6 +29,11 @@ class MessageDirectory(object):
     def __init__(self, path):
         """Create a new directory structure for holding Accounting messages."""
         self.directory_path = path
+        # The result of the last full count, along with the mtime of the
+        # directory at that point. Adding or removing a file changes the
+        # directory mtime, so a matching mtime means the count still holds.
+        self._cached_count = None
+        self._cached_mtime = None
 
     def add(self, data):
         """Add the passed data to a new file and return it's name."""
@@ -36,9 +42,11 @@ class MessageDirectory(object):
         # logs as the message ID).
         name = uuid.uuid4()
 
+        mtime = self._get_mtime()
         # Open the file and write the provided data into the file.
         with open("%s/%s" % (self.directory_path, name), 'w') as message:
             message.write(data)
+        self._update_cached_count(mtime, 1)
 
         # Return the name of the created file as a string,
         # to keep the dirq like interface.
@@ -48,9 +56,28 @@ class MessageDirectory(object):
         """
         Return the number of elements in the queue.
 
-        Regardless of their state.
+        Regardless of their state. The count is cached and only recalculated
+        if the directory has been modified since it was last calculated.
         """
-        return len(self._get_messages())
+        mtime = self._get_mtime()
+        if self._cached_count is None or mtime != self._cached_mtime:
+            self._cached_count = len(self._get_messages())
+            self._cached_mtime = mtime
+        return self._cached_count
+
+    def is_empty(self):
+        """Return True if there are no messages in the directory.
+
+        This stops at the first file found rather than listing the whole
+        directory, so is much cheaper than count() on a large directory.
+        """
+        try:
+            for entry in os.scandir(self.directory_path):
+                if entry.is_file():
+                    return False
+        except (IOError, OSError) as error:
+            log.error(error)
+        return True
 
     def get(self, name):
         """Return the content of the named message."""
@@ -58,10 +85,25 @@ class MessageDirectory(object):
             content = message.read()
         return content
 
+    def get_path(self, name):
+        """Return the path of the named message."""
+        return "%s/%s" % (self.directory_path, name)
+
+    def added_time(self, name):
+        """Return when the named message was added, or None if it's gone."""
+        try:
+            return os.stat(self.get_path(name)).st_mtime
+        except OSError:
+            return None
+
     def lock(self, _name):
         """Return True to simulate a successful lock. Does nothing else."""
         return True
 
+    def unlock(self, _name):
+        """Return True to simulate a successful unlock. Does nothing else."""
+        return True
+
     def purge(self):
         """
         Do nothing, as there are no old/intermediate directories to purge.
@@ -72,58 +114,71 @@ class MessageDirectory(object):
 
     def remove(self, name):
         """Remove the named message."""
+        mtime = self._get_mtime()
         os.unlink("%s/%s" % (self.directory_path, name))
+        self._update_cached_count(mtime, -1)
 
-    def _get_messages(self, sort_by_mtime=False):
-        """
-        Get the messages stored in this MessageDirectory.
+    def _get_mtime(self):
+        """Return the mtime of the directory, or None if it can't be read."""
+        try:
+            return os.stat(self.directory_path).st_mtime_ns
+        except (IOError, OSError):
+            return None
 
-        if sort_by_mtime is set to True, the returned list is guaranteed to be
-        in increasing order of modification time.
+    def _update_cached_count(self, mtime_before, change):
+        """
+        Apply a change made by this object to the cached count.
 
-        mtime is used because (apparently) there is not way to find the
-        original date of file creation due to a limitation
-        of the underlying filesystem
+        The cached count is only adjusted if it was still valid immediately
+        before the change, otherwise it is dropped so that the next call to
+        count() recalculates it.
         """
+        if self._cached_count is not None and mtime_before is not None \
+                and mtime_before == self._cached_mtime:
+            self._cached_count += change
+            self._cached_mtime = self._get_mtime()
+        else:
+            self._cached_count = None
+
+    def _get_messages(self):
+        """Get the messages stored in this MessageDirectory, in any order."""
         try:
             # Get a list of files under self.directory_path
             # in an arbitrary order (ignoring directories).
-            file_name_list = [file for file in os.listdir(self.directory_path)
-                              if os.path.isfile(os.path.join(self.directory_path, file))]
-
-            if sort_by_mtime:
-                # Working space to hold the unsorted messages
-                # as file paths and mtimes.
-                unsorted_messages = []
-                # Working space to hold the sorted messages as file names.
-                sorted_messages = []
-
-                # Work out the mtime of each file.
-                for file_name in file_name_list:
-                    file_path = os.path.join(self.directory_path, file_name)
-                    # Store the file path and the time
-                    # the file was last modified.
-                    unsorted_messages.append((file_name,
-                                              os.path.getmtime(file_path)))
-
-                # Sort the file paths by mtime and
-                # then only store the file name.
-                for (file_name, _mtime) in sorted(unsorted_messages,
-                                                  key=lambda tup: tup[1]):
-                    # Store the sorted file paths in a class element.
-                    sorted_messages.append(file_name)
-
-                # Return the sorted list.
-                return sorted_messages
-
-            # If we get here, just return the arbitrarily ordered list.
-            return file_name_list
+            return [file for file in os.listdir(self.directory_path)
+                    if os.path.isfile(os.path.join(self.directory_path, file))]
 
         except (IOError, OSError) as error:
             log.error(error)
             # Return an empty file list.
             return []
 
+    def _iter_messages_by_mtime(self):
+        """
+        Yield the messages stored in this MessageDirectory by mtime.
+
+        The messages are yielded in increasing order of modification time.
+        mtime is used because (apparently) there is not way to find the
+        original date of file creation due to a limitation
+        of the underlying filesystem.
+
+        Rather than sorting every message up front, the messages are put in a
+        heap and popped off one at a time, so a caller that stops early only
+        pays for ordering the messages it actually used.
+        """
+        try:
+            # Store the mtime and name of each file (ignoring directories).
+            messages = [(entry.stat().st_mtime, entry.name)
+                        for entry in os.scandir(self.directory_path)
+                        if entry.is_file()]
+        except (IOError, OSError) as error:
+            log.error(error)
+            return
+
+        heapq.heapify(messages)
+        while messages:
+            yield heapq.heappop(messages)[1]
+
     def __iter__(self):
-        """Return an iterable of files currently in the MessageDirectory."""
-        return self._get_messages(sort_by_mtime=True).__iter__()
+        """Return an iterator of files currently in the MessageDirectory."""
+        return self._iter_messages_by_mtime()
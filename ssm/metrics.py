@@ -0,0 +1,146 @@
+# Copyright 2026 UK Research and Innovation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module contains the Metrics class."""
+from __future__ import print_function
+
+import bisect
+import contextlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# logging configuration
+log = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """Counters, gauges and latency histograms for an SSM.
+
+    The latency of each stage of handling a message, such as signing or
+    verifying it, is recorded in one histogram labelled by stage. Everything
+    can be written out in the Prometheus text format, for the textfile
+    collector of node_exporter. A Metrics object can be shared between
+    threads.
+    """
+
+    # Upper bounds, in seconds, of the histogram buckets.
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0)
+    # Prefix of the names of the exported metrics.
+    PREFIX = 'ssm_'
+
+    def __init__(self):
+        """Create a Metrics object with nothing recorded."""
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        # Maps each stage to its count in each bucket (and one more for
+        # +Inf), total seconds and number of observations.
+        self._stages = {}
+
+    def inc(self, name, amount=1):
+        """Add amount to the counter name."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        """Set the gauge name to value."""
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, stage, seconds):
+        """Record that a stage took seconds."""
+        with self._lock:
+            if stage not in self._stages:
+                self._stages[stage] = [[0] * (len(Metrics.BUCKETS) + 1),
+                                       0.0, 0]
+            entry = self._stages[stage]
+            entry[0][bisect.bisect_left(Metrics.BUCKETS, seconds)] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Return a context manager that records how long it takes."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - start)
+
+    def counter(self, name):
+        """Return the value of the counter name."""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def stage_count(self, stage):
+        """Return the number of times stage has been recorded."""
+        with self._lock:
+            return self._stages.get(stage, [None, 0.0, 0])[2]
+
+    def stage_seconds(self, stage):
+        """Return the total seconds recorded for stage."""
+        with self._lock:
+            return self._stages.get(stage, [None, 0.0, 0])[1]
+
+    def render(self):
+        """Return everything recorded, in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                metric = '%s%s_total' % (Metrics.PREFIX, name)
+                lines.append('# TYPE %s counter' % metric)
+                lines.append('%s %s' % (metric, self._counters[name]))
+
+            for name in sorted(self._gauges):
+                metric = Metrics.PREFIX + name
+                lines.append('# TYPE %s gauge' % metric)
+                lines.append('%s %s' % (metric, self._gauges[name]))
+
+            if self._stages:
+                metric = Metrics.PREFIX + 'stage_duration_seconds'
+                lines.append('# TYPE %s histogram' % metric)
+            for stage in sorted(self._stages):
+                buckets, total, count = self._stages[stage]
+                cumulative = 0
+                bounds = ['%g' % bound for bound in Metrics.BUCKETS]
+                for bound, in_bucket in zip(bounds + ['+Inf'], buckets):
+                    cumulative += in_bucket
+                    lines.append('%s_bucket{stage="%s",le="%s"} %s'
+                                 % (metric, stage, bound, cumulative))
+                lines.append('%s_sum{stage="%s"} %r' % (metric, stage, total))
+                lines.append('%s_count{stage="%s"} %s'
+                             % (metric, stage, count))
+        return ''.join(line + '\n' for line in lines)
+
+    def write_textfile(self, path):
+        """Write everything recorded to the file path.
+
+        The file is replaced in one step, so that node_exporter never reads
+        a partly written file.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix='.ssm', dir=directory)
+            with os.fdopen(fd, 'w') as tmp_file:
+                tmp_file.write(self.render())
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as error:
+            log.warning('Failed to write metrics to %s: %s', path, error)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,228 @@
+# Copyright 2026 UK Research and Innovation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module contains the SqliteQueue class."""
+from __future__ import print_function
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# logging configuration
+log = logging.getLogger(__name__)
+
+
+class SqliteQueue(object):
+    """A message queue stored in a single SQLite database.
+
+    This has the same interface as the dirq Queue class used for incoming
+    messages, so can be used in its place by the receiver and by whatever
+    reads the messages afterwards. Messages are rows rather than directories
+    of files, and several messages can be added in one transaction with
+    add_batch, which greatly reduces the filesystem work per message.
+
+    The database is kept in write-ahead logging mode, so one process can add
+    messages while others read them. Within a process, a SqliteQueue can be
+    shared between threads.
+    """
+
+    # Name of the database file created inside the queue directory.
+    DB_NAME = 'queue.db'
+    # Number of element names fetched at a time when iterating.
+    ITER_CHUNK = 1000
+
+    def __init__(self, path, schema, timeout=30):
+        """Open or create a queue in the directory path.
+
+        schema is a dirq style schema, a dict of field names to 'string',
+        where a trailing '?' marks the field as optional. timeout is how long
+        to wait, in seconds, for another process to release the database.
+        """
+        self.path = path
+        self.fields = sorted(schema)
+        self.mandatory = [name for name in self.fields
+                          if not schema[name].endswith('?')]
+        self.timeout = timeout
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # The STOMP receiver thread may use the connection as well as the
+        # thread that created it, so access to it is serialised with a lock.
+        self._lock = threading.RLock()
+        # The database is only opened when it is first used, so that a
+        # receiver can create its queues before becoming a daemon, which
+        # closes any open files.
+        self._connection = None
+
+    @property
+    def _conn(self):
+        """The database connection, opened if it isn't already."""
+        with self._lock:
+            if self._connection is None:
+                self._connection = self._open()
+            return self._connection
+
+    def _open(self):
+        """Open the database, creating or updating the table if need be."""
+        conn = sqlite3.connect(os.path.join(self.path, SqliteQueue.DB_NAME),
+                               timeout=self.timeout, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # Make sure each commit is on disk before it returns, as messages may
+        # be acknowledged to the broker once they have been added.
+        conn.execute('PRAGMA synchronous=FULL')
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, locked REAL, %s)'
+                % ', '.join('%s TEXT' % name for name in self.fields)
+            )
+            # Add any fields that were added to the schema after the
+            # database was created.
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(messages)')]
+            for name in self.fields:
+                if name not in columns:
+                    conn.execute(
+                        'ALTER TABLE messages ADD COLUMN %s TEXT' % name
+                    )
+        return conn
+
+    def _check(self, data):
+        """Raise a ValueError if data doesn't match the schema."""
+        for name in data:
+            if name not in self.fields:
+                raise ValueError('unexpected data: %s' % name)
+        for name in self.mandatory:
+            if data.get(name) is None:
+                raise ValueError('missing mandatory data: %s' % name)
+
+    def add(self, data):
+        """Add a message, given as a dict, and return its name."""
+        return self.add_batch([data])[0]
+
+    def add_batch(self, data_list):
+        """Add several messages in one transaction and return their names.
+
+        Either all of the messages are added or, if there is an error, none
+        of them are.
+        """
+        for data in data_list:
+            self._check(data)
+
+        sql = 'INSERT INTO messages (%s) VALUES (%s)' % (
+            ', '.join(self.fields), ', '.join('?' * len(self.fields))
+        )
+        names = []
+        with self._lock, self._conn:
+            for data in data_list:
+                cursor = self._conn.execute(
+                    sql, [data.get(name) for name in self.fields]
+                )
+                names.append('%d' % cursor.lastrowid)
+        return names
+
+    def count(self):
+        """Return the number of messages in the queue, locked or not."""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM messages'
+            ).fetchone()[0]
+
+    def get(self, name):
+        """Return the named message as a dict."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT %s FROM messages WHERE id = ?'
+                % ', '.join(self.fields), (int(name),)
+            ).fetchone()
+        if row is None:
+            raise KeyError('no such message: %s' % name)
+        return dict((field, value) for field, value in zip(self.fields, row)
+                    if value is not None)
+
+    def lock(self, name, permissive=True):
+        """Lock the named message, returning True on success.
+
+        Returns False if the message is already locked or has been removed,
+        unless permissive is False in which case an OSError is raised.
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'UPDATE messages SET locked = ? '
+                'WHERE id = ? AND locked IS NULL', (time.time(), int(name))
+            )
+        if cursor.rowcount == 1:
+            return True
+        if permissive:
+            return False
+        raise OSError('cannot lock message %s' % name)
+
+    def unlock(self, name, permissive=False):
+        """Unlock the named message, returning True on success."""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'UPDATE messages SET locked = NULL '
+                'WHERE id = ? AND locked IS NOT NULL', (int(name),)
+            )
+        if cursor.rowcount == 1:
+            return True
+        if permissive:
+            return False
+        raise OSError('cannot unlock message %s' % name)
+
+    def remove(self, name):
+        """Remove the named message."""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM messages WHERE id = ?',
+                               (int(name),))
+
+    def purge(self, maxtemp=300, maxlock=600):
+        """Unlock messages that have been locked for longer than maxlock.
+
+        maxtemp is only accepted for compatibility with dirq, as there are no
+        temporary files to remove.
+        """
+        if maxlock:
+            with self._lock, self._conn:
+                cursor = self._conn.execute(
+                    'UPDATE messages SET locked = NULL WHERE locked < ?',
+                    (time.time() - maxlock,)
+                )
+            if cursor.rowcount:
+                log.warning('Unlocked %s messages with stale locks in %s.',
+                            cursor.rowcount, self.path)
+
+    def __iter__(self):
+        """Return an iterator of message names, oldest first."""
+        last_id = 0
+        while True:
+            with self._lock:
+                ids = [row[0] for row in self._conn.execute(
+                    'SELECT id FROM messages WHERE id > ? ORDER BY id LIMIT ?',
+                    (last_id, SqliteQueue.ITER_CHUNK)
+                )]
+            for message_id in ids:
+                yield '%d' % message_id
+            if len(ids) < SqliteQueue.ITER_CHUNK:
+                return
+            last_id = ids[-1]
+
+    def close(self):
+        """Close the database connection, until the queue is used again."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
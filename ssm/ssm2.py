@@ -15,52 +15,105 @@
 """
 from __future__ import print_function
 
-import pkg_resources
-
 from ssm import crypto
+from ssm.duplicate_filter import DuplicateFilter
+from ssm.fair_queue import FairQueue
 from ssm.message_directory import MessageDirectory
-
-try:
-    from dirq.QueueSimple import QueueSimple
-    from dirq.queue import Queue
-except ImportError:
-    # ImportError is raised later on if dirq is requested but not installed.
-    QueueSimple = None
-    Queue = None
-
-import stomp
-from stomp.exception import ConnectFailedException
-
+from ssm.metrics import Metrics
+from ssm.sqlite_queue import SqliteQueue
+from ssm.status_server import StatusServer
+from ssm.valid_dns import ValidDns
+
+import base64
+import fnmatch
+import json
 import os
 import socket
+import sqlite3
+import threading
 import time
+import zlib
 from logging import getLogger, INFO, WARNING, DEBUG
 
-try:
-    from argo_ams_library import ArgoMessagingService, AmsMessage
-except ImportError:
-    # ImportError is raised later on if AMS is requested but lib not installed.
-    ArgoMessagingService = None
-    AmsMessage = None
+# The messaging and queue libraries are only imported when the protocol or
+# path type that needs them is used, so that a one-shot sender doesn't spend
+# time importing libraries that it won't use. stomp is imported where it's
+# used, as it's cheap to import again once it has been imported once.
+# The AMS classes, set by _import_ams.
+ArgoMessagingService = None
+AmsMessage = None
 
 # Set up logging
 log = getLogger(__name__)
 
 
+def _import_ams():
+    """Import the AMS classes, unless they have already been imported."""
+    global ArgoMessagingService, AmsMessage
+    if ArgoMessagingService is None or AmsMessage is None:
+        try:
+            import argo_ams_library
+        except ImportError:
+            raise ImportError(
+                "The Python package argo_ams_library must be installed to "
+                "use AMS. Please install or use STOMP."
+            )
+        ArgoMessagingService = (ArgoMessagingService or
+                                argo_ams_library.ArgoMessagingService)
+        AmsMessage = AmsMessage or argo_ams_library.AmsMessage
+
+
+def _import_dirq():
+    """Import and return the dirq queue classes."""
+    try:
+        from ssm.dirq_queue import DirqQueue, IncomingQueue
+    except ImportError:
+        raise ImportError("dirq path_type requested but the dirq "
+                          "module wasn't found.")
+    return DirqQueue, IncomingQueue
+
+
+def _package_version(name):
+    """Return the installed version of the named distribution."""
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        # Python 3.7 and earlier.
+        import pkg_resources
+        return pkg_resources.get_distribution(name).version
+    return version(name)
+
+
 class Ssm2Exception(Exception):
     """Exception for use by SSM2."""
 
     pass
 
 
-class Ssm2(stomp.ConnectionListener):
-    """Minimal SSM implementation."""
+class Ssm2(object):
+    """Minimal SSM implementation.
+
+    For STOMP, this is the stomp.py connection listener. stomp.py calls the
+    on_* methods by name, so it doesn't need to be a ConnectionListener.
+    """
 
     # Schema for the dirq message queue.
-    QSCHEMA = {'body': 'string', 'signer': 'string', 'empaid': 'string?'}
+    QSCHEMA = {'body': 'string', 'signer': 'string', 'empaid': 'string?',
+               'timestamps': 'string?'}
     REJECT_SCHEMA = {'body': 'string', 'signer': 'string?',
-                     'empaid': 'string?', 'error': 'string'}
+                     'empaid': 'string?', 'error': 'string',
+                     'timestamps': 'string?'}
+    # Headers (STOMP) or attributes (AMS) a sender sets to the times, in
+    # seconds since the epoch, that a message was added to its outgoing
+    # queue and sent.
+    ENQUEUED_HEADER = 'ssm-enqueued'
+    SENT_HEADER = 'ssm-sent'
     CONNECTION_TIMEOUT = 10
+    # How often, in seconds, to recount the incoming queue while paused.
+    RECOUNT_INTERVAL = 5
+    # The number of message bytes each signer may have verified per turn
+    # when verification is shared out between signers.
+    FAIR_QUANTUM = 65536
 
     # Messaging protocols
     STOMP_MESSAGING = 'STOMP'
@@ -69,13 +122,92 @@ class Ssm2(stomp.ConnectionListener):
     def __init__(self, hosts_and_ports, qpath, cert, key, dest=None, listen=None,
                  capath=None, check_crls=False, use_ssl=True, enc_cert=None,
                  verify_enc_cert=True, pidfile=None, path_type='dirq',
-                 protocol=STOMP_MESSAGING, project=None, token=''):
+                 protocol=STOMP_MESSAGING, project=None, token='',
+                 max_msg_size=None, purge_limits=None, write_batch_size=None,
+                 write_batch_delay=0.05, dedup_size=None,
+                 high_watermark=None, low_watermark=None, incoming_shards=1,
+                 shard_key='signer', workers=None, signer_rate=None,
+                 routes=None, compression=None, binary=False,
+                 cipher='aes128', credentials=None, status_socket=None,
+                 summary_interval=None):
         """Create an SSM2 object.
 
-        If a listen value is supplied, this SSM2 will be a receiver.
+        If a listen value is supplied, this SSM2 will be a receiver. It can
+        be a destination or AMS subscription, or a list of them to receive
+        from all at once. Each is consumed by its own subscription over the
+        one connection.
+
+        If max_msg_size is set, messages larger than that many bytes will not
+        be sent, or will be rejected without being processed if received.
+
+        purge_limits is a dict of keyword arguments for DirqQueue that
+        control incremental purging of a dirq outgoing queue.
+
+        If write_batch_size is set, a receiver holds verified messages back
+        and writes them to its queues together, once write_batch_size
+        messages are waiting or the oldest has waited write_batch_delay
+        seconds. Messages are only acknowledged once they have been written.
+
+        If dedup_size is set, a receiver remembers that many of the most
+        recently accepted messages and drops any that arrive again.
+
+        If high_watermark is set, a receiver stops consuming messages once
+        its incoming queues hold that many messages in total, and starts
+        again once they are down to low_watermark, which defaults to half of
+        high_watermark. See check_backpressure.
+
+        If incoming_shards is more than 1, accepted messages are spread
+        across that many incoming queues, named incoming-0, incoming-1 and so
+        on, by a hash of their shard_key field ('signer' or 'empaid'). All
+        messages with the same key go to the same queue, so they can be
+        loaded in order by one of several parallel loaders.
+
+        If workers is set, a receiver verifies and saves messages in that
+        many worker threads. Messages are shared out between the workers
+        fairly by signer, so a signer with a large backlog doesn't hold up
+        the others, and if signer_rate is set no signer has more than that
+        many messages verified per second.
+
+        routes is a list of (pattern, destination) tuples for a sender. Each
+        message is sent to the destination of the first pattern that matches
+        its type, the part of its first line before any colon, such as
+        APEL-summary-job-message. Patterns are case-insensitive and can use
+        shell-style wildcards. Messages that match no pattern are sent to the
+        destination of their queue.
+
+        If compression is one of crypto.COMPRESSIONS, a sender compresses
+        messages with it before signing them. Receivers decompress such
+        messages automatically.
+
+        If binary is True, a sender signs and encrypts messages in binary
+        (DER) form rather than as SMIME text, and sends the raw bytes, which
+        avoids the base64 encoding. Receivers accept both forms.
+
+        cipher is the one of crypto.CIPHERS that a sender encrypts messages
+        with, if it has an enc_cert.
+
+        credentials is a crypto.Credentials for cert, key and enc_cert that
+        has already been used, so that the files aren't read again. If it
+        isn't given, one is created.
+
+        If status_socket is set, a receiver serves its status, as returned by
+        status, on a Unix socket at that path while it is running.
+
+        If summary_interval is set, the lines logged for each message are
+        logged at DEBUG rather than INFO, and log_summary logs the number of
+        messages handled at most every summary_interval seconds instead.
         """
         self._conn = None
         self._last_msg = None
+        # Counters and stage latencies, for write_metrics.
+        self.metrics = Metrics()
+        self._summary_interval = summary_interval
+        if summary_interval is None:
+            self._msg_log_level = INFO
+        else:
+            self._msg_log_level = DEBUG
+        # The time and counters at the last summary.
+        self._last_summary = (time.time(), {})
 
         self._brokers = hosts_and_ports
         self._cert = cert
@@ -87,10 +219,75 @@ class Ssm2(stomp.ConnectionListener):
         self.connected = False
 
         self._listen = listen
+        self._routes = [(pattern.lower(), route_dest)
+                        for pattern, route_dest in routes or []]
+        # Maps each message type seen to the destination it's routed to.
+        self._route_cache = {}
+        if listen is None or isinstance(listen, str):
+            self._listens = [listen]
+        else:
+            self._listens = list(listen)
+            if not self._listens:
+                raise Ssm2Exception('No destinations to receive from.')
         self._dest = dest
 
-        self._valid_dns = []
+        self._valid_dns = ValidDns()
+        # When the valid DNs were last set.
+        self._dns_loaded = None
+        # The broker connected to, as host:port, or the AMS endpoint.
+        self._broker = None
+        # The time, messages received and worker seconds at the last status.
+        self._last_status = (time.time(), 0, 0.0)
+        if status_socket is not None:
+            self._status_server = StatusServer(status_socket, self.status)
+        else:
+            self._status_server = None
         self._pidfile = pidfile
+        self._max_msg_size = max_msg_size
+        if compression is not None and compression not in crypto.COMPRESSIONS:
+            raise Ssm2Exception('Unsupported compression variable.')
+        self._compression = compression
+        self._binary = binary
+        if cipher not in crypto.CIPHERS:
+            raise Ssm2Exception('Unsupported cipher: %s' % cipher)
+        self._cipher = cipher
+
+        # Messages waiting to be written to the receiver's queues, as tuples
+        # of queue, queue name, message data and STOMP headers for acking.
+        self._write_batch_size = write_batch_size
+        self._write_batch_delay = write_batch_delay
+        self._pending_writes = []
+        self._pending_since = None
+        self._pending_lock = threading.RLock()
+
+        # Messages waiting to be verified by worker threads, if any, as
+        # tuples of raw message, decrypted message, empa-id and STOMP headers.
+        self._num_workers = workers
+        if workers:
+            self._work_queue = FairQueue(quantum=Ssm2.FAIR_QUANTUM,
+                                         rate=signer_rate)
+        else:
+            self._work_queue = None
+        self._workers = []
+        # Messages are acknowledged individually once written, rather than
+        # as they are delivered, if they aren't written straight away.
+        self._ack_individually = bool(write_batch_size or workers)
+
+        if low_watermark is None and high_watermark:
+            low_watermark = high_watermark // 2
+        if high_watermark and low_watermark > high_watermark:
+            raise Ssm2Exception('The low watermark must not be above the '
+                                'high watermark.')
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+        # An estimate of the number of messages in the incoming queue. It is
+        # the last count plus the messages added since, so it never
+        # underestimates and the queue only needs recounting when it reaches
+        # the high watermark.
+        self._queue_depth = None
+        self._next_recount = 0
+        # Set while consuming messages is paused because of backpressure.
+        self.paused = False
 
         # Used to differentiate between STOMP and AMS methods
         self._protocol = protocol
@@ -100,11 +297,7 @@ class Ssm2(stomp.ConnectionListener):
         self._token = token
 
         if self._protocol == Ssm2.AMS_MESSAGING:
-            if ArgoMessagingService is None:
-                raise ImportError(
-                    "The Python package argo_ams_library must be installed to "
-                    "use AMS. Please install or use STOMP."
-                )
+            _import_ams()
             self._ams = ArgoMessagingService(endpoint=self._brokers[0],
                                              token=self._token,
                                              cert=self._cert,
@@ -113,39 +306,57 @@ class Ssm2(stomp.ConnectionListener):
 
         # create the filesystem queues for accepted and rejected messages
         if dest is not None and listen is None:
-            # Determine what sort of outgoing structure to make
-            if path_type == 'dirq':
-                if QueueSimple is None:
-                    raise ImportError("dirq path_type requested but the dirq "
-                                      "module wasn't found.")
+            self._outq = self._make_outq(qpath, path_type, purge_limits)
+            # Each outgoing queue with the destination to send it to. More
+            # can be added with add_outgoing.
+            self._outqs = [(self._outq, dest)]
 
-                self._outq = QueueSimple(qpath)
+        elif listen is not None:
+            if incoming_shards == 1:
+                inqpaths = [os.path.join(qpath, 'incoming')]
+            elif incoming_shards > 1:
+                inqpaths = [os.path.join(qpath, 'incoming-%d' % shard)
+                            for shard in range(incoming_shards)]
+            else:
+                raise Ssm2Exception('There must be at least one incoming '
+                                    'queue.')
+            if shard_key not in ('signer', 'empaid'):
+                raise Ssm2Exception('Unsupported shard_key variable.')
+            self._shard_key = shard_key
+            rejectqpath = os.path.join(qpath, 'reject')
+
+            # Determine what sort of incoming store to make.
+            if path_type == 'dirq':
+                queue_class = _import_dirq()[1]
 
-            elif path_type == 'directory':
-                self._outq = MessageDirectory(qpath)
+            elif path_type == 'sqlite':
+                queue_class = SqliteQueue
             else:
                 raise Ssm2Exception('Unsupported path_type variable.')
 
-        elif listen is not None:
-            inqpath = os.path.join(qpath, 'incoming')
-            rejectqpath = os.path.join(qpath, 'reject')
-
-            # Receivers must use the dirq module, so make a quick sanity check
-            # that dirq is installed.
-            if Queue is None:
-                raise ImportError("Receiving SSMs must use dirq, but the dirq "
-                                  "module wasn't found.")
+            self._inqs = [queue_class(inqpath, schema=Ssm2.QSCHEMA)
+                          for inqpath in inqpaths]
+            self._rejectq = queue_class(rejectqpath,
+                                        schema=Ssm2.REJECT_SCHEMA)
 
-            self._inq = Queue(inqpath, schema=Ssm2.QSCHEMA)
-            self._rejectq = Queue(rejectqpath, schema=Ssm2.REJECT_SCHEMA)
+            if dedup_size:
+                self._dedup = DuplicateFilter(
+                    os.path.join(qpath, 'dedup.db'), dedup_size
+                )
+            else:
+                self._dedup = None
         else:
             raise Ssm2Exception('SSM must be either producer or consumer.')
+        if credentials is None:
+            credentials = crypto.Credentials(cert, key, enc_cert)
+        self._credentials = credentials
+
         # check that the cert and key match
-        if not crypto.check_cert_key(self._cert, self._key):
+        if not credentials.key_matches():
             raise Ssm2Exception('Cert and key don\'t match.')
 
         # Check that the certificate has not expired.
-        if not crypto.verify_cert_date(self._cert):
+        if not credentials.in_date(credentials.cert):
             raise Ssm2Exception('Certificate %s has expired or will expire '
                                 'within a day.' % self._cert)
 
@@ -155,19 +366,41 @@ class Ssm2(stomp.ConnectionListener):
             if not os.path.isfile(self._enc_cert):
                 raise Ssm2Exception('Specified certificate file does not exist: %s.' % self._enc_cert)
             # Check that the encyption certificate has not expired.
-            if not crypto.verify_cert_date(enc_cert):
+            if not credentials.in_date(credentials.enc_cert):
                 raise Ssm2Exception(
                     'Encryption certificate %s has expired or will expire '
                     'within a day. Please obtain the new one from the final '
                     'server receiving your messages.' % enc_cert
                 )
             if verify_enc_cert:
-                if not crypto.verify_cert_path(self._enc_cert, self._capath, self._check_crls):
+                if not credentials.verify_enc_cert(self._capath, self._check_crls):
                     raise Ssm2Exception('Failed to verify server certificate %s against CA path %s.'
                                         % (self._enc_cert, self._capath))
 
         self._set_external_logging_levels()
 
+    def _make_outq(self, qpath, path_type, purge_limits):
+        """Return an outgoing queue of the given type."""
+        # Determine what sort of outgoing structure to make
+        if path_type == 'dirq':
+            return _import_dirq()[0](qpath, **(purge_limits or {}))
+
+        elif path_type == 'directory':
+            return MessageDirectory(qpath)
+        else:
+            raise Ssm2Exception('Unsupported path_type variable.')
+
+    def add_outgoing(self, qpath, dest, path_type='dirq', purge_limits=None):
+        """Add another outgoing queue for a sender, to send to dest.
+
+        send_all sends the messages in each outgoing queue in turn, over the
+        one connection.
+        """
+        if self._listen is not None:
+            raise Ssm2Exception('Only a sender can have outgoing queues.')
+        self._outqs.append((self._make_outq(qpath, path_type, purge_limits),
+                            dest))
+
     def _set_external_logging_levels(self):
         """Tweak the logging of dependencies to better match SSM verbosity."""
         # If the overall SSM log level is INFO, we want to only
@@ -186,8 +419,14 @@ class Ssm2(stomp.ConnectionListener):
             getLogger("urllib3.connectionpool").setLevel(INFO)
 
     def set_dns(self, dn_list):
-        """Set the list of DNs which are allowed to sign incoming messages."""
-        self._valid_dns = dn_list
+        """Set the list of DNs which are allowed to sign incoming messages.
+
+        Entries containing '*' are patterns, see ValidDns. The new set is
+        built before being swapped in, so messages being handled in another
+        thread see either the old or the new set in full.
+        """
+        self._valid_dns = ValidDns(dn_list)
+        self._dns_loaded = time.time()
 
     ##########################################################################
     # Methods called by stomppy
@@ -218,17 +457,25 @@ class Ssm2(stomp.ConnectionListener):
 
         Called by stomppy when a message is received.
         """
+        # When writes are batched or done by workers, messages are
+        # acknowledged individually once they have been written, so pass on
+        # the headers to ack with.
+        ack_headers = headers if self._ack_individually else None
+
         try:
             empaid = headers['empa-id']
             if empaid == 'ping':  # ignore ping message
                 log.info('Received ping message.')
+                if ack_headers is not None:
+                    self._ack_stomp_msg(ack_headers)
                 return
         except KeyError:
             empaid = 'noid'
 
-        log.info("Received message. ID = %s", empaid)
+        log.log(self._msg_log_level, "Received message. ID = %s", empaid)
+        timestamps = self._read_timestamps(headers)
         # Save the message to either accept or reject queue.
-        self._save_msg_to_queue(body, empaid)
+        self._receive_msg(body, empaid, ack_headers, timestamps)
 
     def on_error(self, headers, body):
         """Log error messages.
@@ -262,7 +509,8 @@ class Ssm2(stomp.ConnectionListener):
 
         Called by stomppy when the broker acknowledges receipt of a message.
         """
-        log.info('Broker received message: %s', headers['receipt-id'])
+        log.log(self._msg_log_level, 'Broker received message: %s',
+                headers['receipt-id'])
         self._last_msg = headers['receipt-id']
 
     def on_receiver_loop_completed(self, _unused_headers, _unused_body):
@@ -285,43 +533,142 @@ class Ssm2(stomp.ConnectionListener):
         - verify signature
         - Return plain-text message, signer's DN and an error/None.
         """
-        if text is None or text == '':
+        text, error = self._decrypt_msg(text)
+        if error is not None:
+            return None, None, error
+        return self._verify_msg(text)
+
+    def _decrypt_msg(self, text):
+        """Check the raw message and decrypt it if necessary.
+
+        Returns the signed message and None, or None and an error.
+        """
+        if not text:
             warning = 'Empty text passed to _handle_msg.'
             log.warning(warning)
-            return None, None, warning
+            return None, warning
+
+        # Check the headers first so that junk is rejected cheaply.
+        message_type = crypto.get_message_type(text)
+        if message_type is None:
+            warning = 'Message is not signed or encrypted.'
+            log.warning(warning)
+            return None, warning
 
-        # encrypted - this could be nicer
-        if 'application/pkcs7-mime' in text or 'application/x-pkcs7-mime' in text:
+        if message_type == crypto.ENCRYPTED:
             try:
-                text = crypto.decrypt(text, self._cert, self._key)
+                with self.metrics.timer('decrypt'):
+                    text = crypto.decrypt(text, self._cert, self._key)
             except crypto.CryptoException as e:
                 error = 'Failed to decrypt message: %s' % e
                 log.error(error)
-                return None, None, error
+                return None, error
+
+            # Encrypted messages should contain signed ones.
+            if crypto.get_message_type(text) != crypto.SIGNED:
+                error = 'Failed to decrypt message to a signed message.'
+                log.error(error)
+                return None, error
 
-        # always signed
+        return text, None
+
+    def _verify_msg(self, text):
+        """Verify a signed message and check its signer.
+
+        Returns the plain-text message, signer's DN and an error/None.
+        """
         try:
-            message, signer = crypto.verify(text, self._capath, self._check_crls)
+            with self.metrics.timer('verify'):
+                message, signer = crypto.verify(
+                    text, self._capath, self._check_crls,
+                    max_size=self._max_msg_size
+                )
         except crypto.CryptoException as e:
             error = 'Failed to verify message: %s' % e
             log.error(error)
             return None, None, error
 
-        if signer not in self._valid_dns:
+        with self.metrics.timer('dn_check'):
+            valid = signer in self._valid_dns
+        if not valid:
             warning = 'Signer not in valid DNs list: %s' % signer
             log.warning(warning)
             return None, signer, warning
         else:
-            log.info('Valid signer: %s', signer)
+            log.log(self._msg_log_level, 'Valid signer: %s', signer)
 
         return message, signer, None
 
-    def _save_msg_to_queue(self, body, empaid):
-        """Extract message contents and add to the accept or reject queue."""
-        if isinstance(body, bytes):
-            body = body.decode('ascii')
+    def _save_msg_to_queue(self, body, empaid, ack_headers=None,
+                           timestamps=None):
+        """Extract message contents and add to the accept or reject queue.
+
+        If ack_headers are given, the STOMP message they came with will be
+        acknowledged once it has been written. timestamps is a dict of
+        the times the message was sent and received, from _read_timestamps.
+        """
+        body, err_msg = self._check_msg(body)
+        if err_msg is None:
+            extracted_msg, signer, err_msg = self._handle_msg(body)
+        else:
+            extracted_msg, signer = None, None
+        self._store_msg(body, extracted_msg, signer, err_msg, empaid,
+                        ack_headers, timestamps)
+
+    def _read_timestamps(self, headers):
+        """Return the times a message was enqueued, sent and received.
+
+        headers are the STOMP headers or AMS attributes of the message. The
+        times are returned as a dict, or None if the sender didn't set a sent
+        time. The time in transit between sending and receiving is recorded
+        in the metrics, so the clocks of the sender and receiver need to be
+        in sync.
+        """
+        received = time.time()
+        try:
+            sent = float(headers[Ssm2.SENT_HEADER])
+        except (KeyError, TypeError, ValueError):
+            return None
+        timestamps = {'sent': sent, 'received': received}
+        try:
+            timestamps['enqueued'] = float(headers[Ssm2.ENQUEUED_HEADER])
+        except (KeyError, TypeError, ValueError):
+            pass
+        # Clocks out of sync can make this negative.
+        self.metrics.observe('transit', max(received - sent, 0))
+        return timestamps
+
+    def _check_msg(self, body):
+        """Return the message as a string and an error if it is junk.
+
+        Binary (DER) messages are returned as they are, as bytes.
+        """
+        err_msg = None
+        if self._max_msg_size and len(body) > self._max_msg_size:
+            # Reject oversized messages before doing any work on them.
+            err_msg = ('Message size of %s bytes exceeds the maximum of %s '
+                       'bytes.' % (len(body), self._max_msg_size))
+
+        if isinstance(body, bytes) and not crypto.is_der(body):
+            try:
+                body = body.decode('ascii')
+            except UnicodeDecodeError:
+                # S/MIME messages are always ASCII, so this is junk.
+                body = body.decode('ascii', 'replace')
+                if err_msg is None:
+                    err_msg = 'Message is not ASCII text.'
+
+        return body, err_msg
+
+    def _store_msg(self, body, extracted_msg, signer, err_msg, empaid,
+                   ack_headers, timestamps=None):
+        """Add a handled message to the accept or reject queue.
 
-        extracted_msg, signer, err_msg = self._handle_msg(body)
+        If timestamps are given, they are saved with the message, along with
+        the time it was saved.
+        """
+        if timestamps is not None:
+            timestamps = dict(timestamps, saved=time.time())
         try:
             # If the message is empty or the error message is not empty
             # then reject the message.
@@ -334,65 +681,480 @@ class Ssm2(stomp.ConnectionListener):
                     # allows the msg to be reloaded if needed.
                     body = extracted_msg
 
+                if isinstance(body, bytes):
+                    # Queues only hold text, so keep binary messages in a
+                    # form they can be recovered from.
+                    body = base64.b64encode(body).decode('ascii')
+
                 log.warning("Message rejected: %s", err_msg)
-                name = self._rejectq.add({'body': body,
-                                          'signer': signer,
-                                          'empaid': empaid,
-                                          'error': err_msg})
-                log.info("Message saved to reject queue as %s", name)
+                data = {'body': body,
+                        'signer': signer,
+                        'empaid': empaid,
+                        'error': err_msg}
+                if timestamps is not None:
+                    data['timestamps'] = json.dumps(timestamps,
+                                                    sort_keys=True)
+                self._write_to_queue(self._rejectq, 'reject', data,
+                                     ack_headers)
+                return
 
-            else:  # message verified ok
-                name = self._inq.add({'body': extracted_msg,
-                                      'signer': signer,
-                                      'empaid': empaid})
-                log.info("Message saved to incoming queue as %s", name)
+            # Redelivered by the broker or resent by the sender. The verified
+            # content is compared, as encryption differs each time a message
+            # is sent. The message is only remembered once it has been saved.
+            digest = None
+            if self._dedup is not None:
+                digest = DuplicateFilter.digest(empaid, signer, extracted_msg)
+            if digest is not None and self._dedup.is_duplicate(digest):
+                log.log(self._msg_log_level,
+                        'Duplicate message suppressed. ID = %s', empaid)
+                self.metrics.inc('messages_duplicate')
+                if ack_headers is not None:
+                    self._ack_stomp_msg(ack_headers)
 
-        except (IOError, OSError) as error:
+            else:  # message verified ok
+                data = {'body': extracted_msg,
+                        'signer': signer,
+                        'empaid': empaid}
+                if timestamps is not None:
+                    data['timestamps'] = json.dumps(timestamps,
+                                                    sort_keys=True)
+                    if 'enqueued' in timestamps:
+                        self.metrics.observe(
+                            'end_to_end', max(timestamps['saved'] -
+                                              timestamps['enqueued'], 0)
+                        )
+                self._write_to_queue(self._get_incoming_queue(data),
+                                     'incoming', data, ack_headers, digest)
+
+        except (IOError, OSError, sqlite3.Error) as error:
             log.error('Failed to read or write file: %s', error)
+            if ack_headers is not None:
+                # Have the broker deliver it again rather than lose it.
+                self._ack_stomp_msg(ack_headers, nack=True)
 
-    def _send_msg(self, message, msgid):
+    def _receive_msg(self, body, empaid, ack_headers=None, timestamps=None):
+        """Save a received message, or pass it on to the worker threads.
+
+        The workers decrypt messages before scheduling them by the signer of
+        the message inside, so until then they wait under the key None.
+        """
+        self.metrics.inc('messages_received')
+        if self._work_queue is None:
+            self._save_msg_to_queue(body, empaid, ack_headers, timestamps)
+            return
+
+        self._work_queue.put(None,
+                             (body, None, empaid, ack_headers, timestamps),
+                             len(body))
+
+    def _schedule_msg(self, body, empaid, ack_headers, timestamps):
+        """Decrypt a message and queue it by its signer to be verified."""
+        body, err_msg = self._check_msg(body)
+        if err_msg is None:
+            text, err_msg = self._decrypt_msg(body)
+        if err_msg is not None:
+            self._store_msg(body, None, None, err_msg, empaid, ack_headers,
+                            timestamps)
+            return
+
+        self._work_queue.put(crypto.peek_signer(text),
+                             (body, text, empaid, ack_headers, timestamps),
+                             len(text))
+
+    def _work(self):
+        """Decrypt, verify and save messages until the queue is closed."""
+        while True:
+            work = self._work_queue.get()
+            if work is None:
+                return
+            body, text, empaid, ack_headers, timestamps = work
+            try:
+                with self.metrics.timer('work'):
+                    if text is None:
+                        # Queued again before this one is marked done, so
+                        # that joining the queue waits for it.
+                        self._schedule_msg(body, empaid, ack_headers,
+                                           timestamps)
+                    else:
+                        extracted_msg, signer, err_msg = self._verify_msg(
+                            text
+                        )
+                        self._store_msg(body, extracted_msg, signer,
+                                        err_msg, empaid, ack_headers,
+                                        timestamps)
+            except Exception:
+                log.exception('Unexpected error handling message %s.', empaid)
+            finally:
+                self._work_queue.task_done()
+
+    def start_workers(self):
+        """Start the worker threads, if there are to be any."""
+        if self._work_queue is None or self._workers:
+            return
+        for i in range(self._num_workers):
+            worker = threading.Thread(target=self._work,
+                                      name='ssm-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop_workers(self):
+        """Let the worker threads finish the messages they have, then stop."""
+        if not self._workers:
+            return
+        self._work_queue.close()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        # Start afresh if the workers are started again.
+        self._work_queue = FairQueue(quantum=self._work_queue.quantum,
+                                     rate=self._work_queue.rate)
+
+    def _get_incoming_queue(self, data):
+        """Return the incoming queue for an accepted message."""
+        if len(self._inqs) == 1:
+            return self._inqs[0]
+        # crc32 is used rather than hash() as it is the same in every process.
+        key = (data[self._shard_key] or '').encode('utf-8')
+        return self._inqs[zlib.crc32(key) % len(self._inqs)]
+
+    def _write_to_queue(self, queue, queue_name, data, ack_headers,
+                        digest=None):
+        """Write a message to a queue, or hold it back for a batched write.
+
+        If digest is given, the message is remembered by the duplicate filter
+        once it has been written.
+        """
+        if not self._write_batch_size:
+            with self.metrics.timer('queue_write'):
+                name = queue.add(data)
+            log.log(self._msg_log_level, "Message saved to %s queue as %s",
+                    queue_name, name)
+            self._count_added(queue, 1)
+            if digest is not None:
+                self._dedup.remember([digest])
+            if ack_headers is not None:
+                self._ack_stomp_msg(ack_headers)
+            return
+
+        with self._pending_lock:
+            if not self._pending_writes:
+                self._pending_since = time.time()
+            self._pending_writes.append((queue, queue_name, data,
+                                         ack_headers, digest))
+            if len(self._pending_writes) >= self._write_batch_size:
+                self.flush_writes()
+            else:
+                self.flush_writes(force=False)
+
+    def flush_writes(self, force=True):
+        """Write any messages held back for a batched write to their queues.
+
+        Unless force is True, nothing is written until the oldest message has
+        waited for the batch delay. Each queue is written to in one batch and
+        the messages are then acknowledged.
+        """
+        with self._pending_lock:
+            if not self._pending_writes:
+                return
+            if (not force and time.time() - self._pending_since
+                    < self._write_batch_delay):
+                return
+
+            # Group the messages by queue, keeping them in order.
+            batches = []
+            for (queue, queue_name, data, ack_headers,
+                    digest) in self._pending_writes:
+                for batch in batches:
+                    if batch[0] is queue:
+                        batch[2].append((data, ack_headers, digest))
+                        break
+                else:
+                    batches.append((queue, queue_name,
+                                    [(data, ack_headers, digest)]))
+            self._pending_writes = []
+
+            for queue, queue_name, messages in batches:
+                written = False
+                try:
+                    with self.metrics.timer('queue_write'):
+                        names = queue.add_batch([data for data, _, _
+                                                 in messages])
+                    for name in names:
+                        log.log(self._msg_log_level,
+                                "Message saved to %s queue as %s",
+                                queue_name, name)
+                    self._count_added(queue, len(names))
+                    written = True
+                    digests = [digest for _, _, digest in messages
+                               if digest is not None]
+                    if digests:
+                        self._dedup.remember(digests)
+                except (IOError, OSError, sqlite3.Error) as error:
+                    log.error('Failed to write %s messages to %s queue: %s',
+                              len(messages), queue_name, error)
+
+                # Messages that weren't written are left for the broker to
+                # deliver again.
+                for _, ack_headers, _ in messages:
+                    if ack_headers is not None:
+                        self._ack_stomp_msg(ack_headers, nack=not written)
+
+    def _count_added(self, queue, added):
+        """Add messages written to an incoming queue to the depth estimate."""
+        if queue is self._rejectq:
+            self.metrics.inc('messages_rejected', added)
+        else:
+            self.metrics.inc('messages_accepted', added)
+        if self._queue_depth is not None and queue is not self._rejectq:
+            self._queue_depth += added
+
+    def status(self):
+        """Return a dict describing the state and throughput of a receiver.
+
+        Rates are averages since status was last called, so this is cheap
+        enough to call every few seconds. Queue depths are the estimates
+        kept for backpressure, or None if there aren't any.
+        """
+        now = time.time()
+        received = self.metrics.counter('messages_received')
+        accepted = self.metrics.counter('messages_accepted')
+        duplicates = self.metrics.counter('messages_duplicate')
+        work_seconds = self.metrics.stage_seconds('work')
+        last_time, last_received, last_work_seconds = self._last_status
+        self._last_status = (now, received, work_seconds)
+        elapsed = max(now - last_time, 1e-6)
+
+        status = {
+            'protocol': self._protocol,
+            'connected': bool(self.connected),
+            'broker': self._broker,
+            'destinations': self._listens,
+            'paused': self.paused,
+            'messages': {
+                'received': received,
+                'accepted': accepted,
+                'rejected': self.metrics.counter('messages_rejected'),
+                'duplicate': duplicates,
+                'per_second': round((received - last_received) / elapsed, 2),
+            },
+            'queues': {
+                'incoming': self._queue_depth,
+                'pending_writes': len(self._pending_writes),
+                'work': (len(self._work_queue)
+                         if self._work_queue is not None else None),
+            },
+            'valid_dns': {
+                'count': len(self._valid_dns),
+                'loaded': self._dns_loaded,
+            },
+        }
+        if self._dedup is not None:
+            # The proportion of verified messages found in the filter.
+            checked = accepted + duplicates
+            status['dedup_hit_rate'] = (round(duplicates / checked, 4)
+                                        if checked else None)
+        if self._work_queue is not None:
+            status['workers'] = {
+                'count': self._num_workers,
+                'running': len(self._workers),
+                'utilisation': round((work_seconds - last_work_seconds)
+                                     / (elapsed * self._num_workers), 4),
+            }
+        return status
+
+    def log_summary(self, force=False):
+        """Log the number of messages handled since the last summary.
+
+        Unless force is set, nothing is logged if summary_interval isn't set
+        or hasn't passed since the last summary, so this can be called after
+        every message.
+        """
+        now = time.time()
+        last_time, last_counts = self._last_summary
+        if not force and (self._summary_interval is None or
+                          now - last_time < self._summary_interval):
+            return
+
+        names = ('messages_received', 'messages_accepted',
+                 'messages_rejected', 'messages_duplicate', 'messages_sent',
+                 'bytes_sent')
+        counts = dict((name, self.metrics.counter(name)) for name in names)
+        self._last_summary = (now, counts)
+        new = dict((name, counts[name] - last_counts.get(name, 0))
+                   for name in names)
+
+        if self._listen is not None:
+            log.info('Received %s messages in %.1f seconds: %s accepted, '
+                     '%s rejected, %s duplicates.', new['messages_received'],
+                     now - last_time, new['messages_accepted'],
+                     new['messages_rejected'], new['messages_duplicate'])
+        else:
+            log.info('Sent %s messages (%s bytes) in %.1f seconds.',
+                     new['messages_sent'], new['bytes_sent'], now - last_time)
+
+    def write_metrics(self, path):
+        """Write the metrics to path for the node_exporter textfile collector.
+
+        The current state of a receiver is included as gauges.
+        """
+        self.metrics.set_gauge('connected', int(bool(self.connected)))
+        if self._listen is not None:
+            self.metrics.set_gauge('paused', int(self.paused))
+            with self._pending_lock:
+                self.metrics.set_gauge('pending_writes',
+                                       len(self._pending_writes))
+            if self._queue_depth is not None:
+                self.metrics.set_gauge('incoming_depth', self._queue_depth)
+            if self._work_queue is not None:
+                self.metrics.set_gauge('work_queue_depth',
+                                       len(self._work_queue))
+        self.metrics.write_textfile(path)
+
+    def _count_incoming(self):
+        """Return the number of messages in all the incoming queues."""
+        return sum(queue.count() for queue in self._inqs)
+
+    def check_backpressure(self):
+        """Pause or resume consuming messages depending on the queue depth.
+
+        This should be called regularly by the receiving process. Once the
+        incoming queue reaches the high watermark, the STOMP subscription is
+        dropped or, for AMS, pull_msg_ams does nothing, so that the backlog
+        is left with the broker. Consuming resumes once whatever reads the
+        queue has brought it down to the low watermark.
+
+        The queue is only counted when the depth estimate reaches the high
+        watermark, or every RECOUNT_INTERVAL seconds while paused.
+        """
+        if not self._high_watermark:
+            return
+
+        if self.paused:
+            if time.time() < self._next_recount:
+                return
+            self._next_recount = time.time() + Ssm2.RECOUNT_INTERVAL
+            self._queue_depth = self._count_incoming()
+            if self._queue_depth <= self._low_watermark:
+                log.info('Incoming queue is down to %s messages. Resuming.',
+                         self._queue_depth)
+                self.paused = False
+                if self._protocol == Ssm2.STOMP_MESSAGING:
+                    self._subscribe()
+
+        elif (self._queue_depth is None or
+              self._queue_depth >= self._high_watermark):
+            self._queue_depth = self._count_incoming()
+            if self._queue_depth >= self._high_watermark:
+                log.warning('Incoming queue has %s messages. Pausing until '
+                            'it is down to %s.', self._queue_depth,
+                            self._low_watermark)
+                self.paused = True
+                self._next_recount = time.time() + Ssm2.RECOUNT_INTERVAL
+                if self._protocol == Ssm2.STOMP_MESSAGING:
+                    # Acknowledge what has been received before unsubscribing,
+                    # as acks can't be sent for a subscription that's gone.
+                    if self._work_queue is not None:
+                        self._work_queue.join()
+                    self.flush_writes()
+                    for sub_id in range(1, len(self._listens) + 1):
+                        self._conn.unsubscribe(id=sub_id)
+
+    def _ack_stomp_msg(self, headers, nack=False):
+        """Acknowledge a STOMP message received with the given headers.
+
+        If nack is True, the broker is told that the message wasn't handled
+        instead, so that it is delivered again.
+        """
+        import stomp.exception
+
+        send = self._conn.nack if nack else self._conn.ack
+        try:
+            if 'ack' in headers:
+                # STOMP 1.2 uses a separate ack ID.
+                send(headers['ack'])
+            else:
+                send(headers['message-id'], headers['subscription'])
+        except (KeyError, stomp.exception.NotConnectedException,
+                socket.error) as error:
+            # The broker will redeliver the message later.
+            log.warning('Failed to acknowledge message: %s', error)
+
+    def _send_msg(self, message, msgid, dest=None, enqueued=None):
         """Send one message using stomppy.
 
         The message will be signed using the host cert and key. If an
         encryption certificate has been supplied, it will also be encrypted.
+        The message can be a string or a file object to read it from. It is
+        sent to dest, or to the SSM's destination if that isn't given.
+        enqueued is the time the message was added to the outgoing queue, if
+        known, which is sent with the time it was sent for receivers to
+        measure latency.
         """
-        log.info('Sending message: %s', msgid)
-        headers = {'destination': self._dest, 'receipt': msgid,
+        log.log(self._msg_log_level, 'Sending message: %s', msgid)
+        if dest is None:
+            dest = self._dest
+        headers = {'destination': dest, 'receipt': msgid,
                    'empa-id': msgid}
+        if enqueued is not None:
+            headers[Ssm2.ENQUEUED_HEADER] = repr(enqueued)
 
         if message is not None:
-            to_send = crypto.sign(message, self._cert, self._key)
+            with self.metrics.timer('sign'):
+                to_send = crypto.sign(message, self._cert, self._key,
+                                      compression=self._compression,
+                                      der=self._binary)
             if self._enc_cert is not None:
-                to_send = crypto.encrypt(to_send, self._enc_cert)
+                with self.metrics.timer('encrypt'):
+                    to_send = crypto.encrypt(to_send, self._enc_cert,
+                                             cipher=self._cipher,
+                                             der=self._binary)
         else:
             to_send = ''
 
-        try:
-            # Try using the v4 method signiture
-            self._conn.send(self._dest, to_send, headers=headers)
-        except TypeError:
-            # If it fails, use the v3 metod signiture
-            self._conn.send(to_send, headers=headers)
+        headers[Ssm2.SENT_HEADER] = repr(time.time())
+        with self.metrics.timer('publish'):
+            try:
+                # Try using the v4 method signiture
+                self._conn.send(dest, to_send, headers=headers)
+            except TypeError:
+                # If it fails, use the v3 metod signiture
+                self._conn.send(to_send, headers=headers)
 
-    def _send_msg_ams(self, text, msgid):
+    def _send_msg_ams(self, text, msgid, dest=None, enqueued=None):
         """Send one message using AMS, returning the AMS ID of the mesage.
 
         The message will be signed using the host cert and key. If an
         encryption certificate has been supplied, the message will also be
-        encrypted.
+        encrypted. The message can be a string or a file object to read it
+        from. It is published to the topic dest, or to the SSM's destination
+        if that isn't given. enqueued is as for _send_msg.
         """
-        log.info('Sending message: %s', msgid)
+        log.log(self._msg_log_level, 'Sending message: %s', msgid)
+        if dest is None:
+            dest = self._dest
         if text is not None:
             # First we sign the message
-            to_send = crypto.sign(text, self._cert, self._key)
+            with self.metrics.timer('sign'):
+                to_send = crypto.sign(text, self._cert, self._key,
+                                      compression=self._compression,
+                                      der=self._binary)
             # Possibly encrypt the message.
             if self._enc_cert is not None:
-                to_send = crypto.encrypt(to_send, self._enc_cert)
+                with self.metrics.timer('encrypt'):
+                    to_send = crypto.encrypt(to_send, self._enc_cert,
+                                             cipher=self._cipher,
+                                             der=self._binary)
             # Then we need to wrap text up as an AMS Message.
-            message = AmsMessage(data=to_send,
-                                 attributes={'empaid': msgid}).dict()
-
-            argo_response = self._ams.publish(self._dest, message, retry=3, timeout=10)
+            attributes = {'empaid': msgid,
+                          Ssm2.SENT_HEADER: repr(time.time())}
+            if enqueued is not None:
+                attributes[Ssm2.ENQUEUED_HEADER] = repr(enqueued)
+            message = AmsMessage(data=to_send, attributes=attributes).dict()
+
+            with self.metrics.timer('publish'):
+                argo_response = self._ams.publish(dest, message, retry=3,
+                                                  timeout=10)
             return argo_response['messageIds'][0]
         else:
             # We ignore empty messages as there is no point sending them.
@@ -400,7 +1162,14 @@ class Ssm2(stomp.ConnectionListener):
             return None
 
     def pull_msg_ams(self):
-        """Pull 1 message from the AMS and acknowledge it."""
+        """Pull messages from each AMS subscription and acknowledge them.
+
+        Acknowledging a message moves its subscription past everything
+        pulled before it, so each round of messages is written before any of
+        it is acknowledged and the next round pulled. With workers, this
+        means messages are only shared fairly between signers within a
+        round, and a signer held back by signer_rate holds up the round.
+        """
         if self._protocol != Ssm2.AMS_MESSAGING:
             # Then this method should not be called,
             # raise an exception if it is.
@@ -408,14 +1177,44 @@ class Ssm2(stomp.ConnectionListener):
                                 'but protocol not set to AMS. '
                                 'Protocol: %s' % self._protocol)
 
-        # This method is setup so that you could pull down and
-        # acknowledge more than one message at a time, but
-        # currently there is no use case for it.
-        messages_to_pull = 1
-        # ack id's will be stored in this list and then acknowledged
-        ackids = []
+        if self.paused:
+            # Leave messages with the AMS until the incoming queue drains.
+            return
+
+        # Pull down and acknowledge one message at a time from each
+        # subscription, unless writes are being batched or there are workers,
+        # in which case enough are pulled at once to fill a batch or give
+        # each worker one.
+        messages_to_pull = max(self._write_batch_size or 1,
+                               self._num_workers or 1)
+        # Each subscription's ack id's will be stored and then acknowledged.
+        pulled = []
+        for subscription in self._listens:
+            pulled.append((subscription,
+                           self._pull_sub_ams(subscription,
+                                              messages_to_pull)))
+
+        # Make sure any messages given to workers or batched have been
+        # written before they are acknowledged.
+        if self._work_queue is not None:
+            self._work_queue.join()
+        self.flush_writes()
+
+        # pass list of extracted ackIds to AMS Service so that
+        # it can move the offset for the next subscription pull
+        # (basically acknowledging pulled messages)
+        for subscription, ackids in pulled:
+            if ackids:
+                self._ams.ack_sub(subscription, ackids, retry=3, timeout=10)
 
-        for msg_ack_id, msg in self._ams.pull_sub(self._listen,
+    def _pull_sub_ams(self, subscription, messages_to_pull):
+        """Pull and save messages from one AMS subscription.
+
+        Returns the ack ids of the messages, which are left to the caller to
+        acknowledge.
+        """
+        ackids = []
+        for msg_ack_id, msg in self._ams.pull_sub(subscription,
                                                   messages_to_pull,
                                                   retry=3,
                                                   timeout=10):
@@ -423,31 +1222,33 @@ class Ssm2(stomp.ConnectionListener):
             msgid = msg.get_msgid()
             # Get the SSM dirq id
             try:
-                empaid = msg.get_attr().get('empaid')
+                attributes = msg.get_attr()
+                empaid = attributes.get('empaid')
             except AttributeError:
                 # A message without an empaid could be received if it wasn't
                 # sent via the SSM, we need to pull down that message
                 # to prevent it blocking the message queue.
                 log.debug("Message %s has no empaid.", msgid)
+                attributes = {}
                 empaid = "N/A"
             # get the message body
             body = msg.get_data()
 
-            log.info('Received message. ID = %s, Argo ID = %s', empaid, msgid)
+            log.log(self._msg_log_level,
+                    'Received message. ID = %s, Argo ID = %s', empaid, msgid)
+            timestamps = self._read_timestamps(attributes)
             # Save the message to either accept or reject queue.
-            self._save_msg_to_queue(body, empaid)
+            self._receive_msg(body, empaid, timestamps=timestamps)
 
             # The message has either been saved or there's been a problem with
             # writing it out, but either way we add the ack ID to the list
-            # of those to be acknowledged so that we don't get stuck reading
-            # the same message.
+            # of those to be acknowledged. The AMS has no way to refuse a
+            # message, and acknowledging a later one moves the subscription
+            # past this one anyway, so leaving it unacknowledged would only
+            # get us stuck reading it again.
             ackids.append(msg_ack_id)
 
-        # pass list of extracted ackIds to AMS Service so that
-        # it can move the offset for the next subscription pull
-        # (basically acknowledging pulled messages)
-        if ackids:
-            self._ams.ack_sub(self._listen, ackids, retry=3, timeout=10)
+        return ackids
 
     def send_ping(self):
         """Perform connection stay-alive steps.
@@ -465,61 +1266,164 @@ class Ssm2(stomp.ConnectionListener):
         self._conn.abort({'transaction': transaction_id})
 
     def has_msgs(self):
-        """Return True if there are any messages in the outgoing queue."""
-        return self._outq.count() > 0
+        """Return True if there are any messages in the outgoing queues."""
+        return any(not outq.is_empty() for outq, _dest in self._outqs)
 
-    def send_all(self):
+    def send_all(self, max_msgs=None, max_bytes=None, max_time=None):
         """
-        Send all the messages in the outgoing queue.
+        Send all the messages in the outgoing queues.
+
+        Either via STOMP or HTTPS (to an Argo Message Broker). If there are
+        several outgoing queues, each is sent to its destination in turn.
 
-        Either via STOMP or HTTPS (to an Argo Message Broker).
+        The run can be limited to a maximum number of messages, a maximum
+        number of bytes (of unsigned messages) or a maximum number of seconds,
+        across all the queues. Sending stops once any limit is reached,
+        leaving the remaining messages for the next run. At least one message
+        is always sent, so a message larger than max_bytes can't block the
+        queue.
         """
-        log.info('Found %s messages.', self._outq.count())
-        for msgid in self._outq:
-            if not self._outq.lock(msgid):
-                log.warning('Message was locked. %s will not be sent.', msgid)
-                continue
+        start_time = time.time()
+        sent_msgs = 0
+        sent_bytes = 0
+        limit_reached = False
+        for outq, dest in self._outqs:
+            if limit_reached:
+                break
+            for msgid in outq:
+                if max_msgs is not None and sent_msgs >= max_msgs:
+                    log.info('Reached the limit of %s messages for this run.',
+                             max_msgs)
+                    limit_reached = True
+                    break
+                if (max_time is not None and
+                        time.time() - start_time >= max_time):
+                    log.info('Reached the time limit of %s seconds for this '
+                             'run.', max_time)
+                    limit_reached = True
+                    break
+
+                queue_read_start = time.time()
+                # Read when the message was added before locking it, as
+                # locking a dirq message updates its modification time.
+                enqueued = outq.added_time(msgid)
+                if not outq.lock(msgid):
+                    log.warning('Message was locked. %s will not be sent.',
+                                msgid)
+                    continue
+
+                # Messages are passed on as open files rather than strings so
+                # that they are streamed from disk into openssl.
+                path = outq.get_path(msgid)
+                size = os.path.getsize(path)
+                self.metrics.observe('queue_read',
+                                     time.time() - queue_read_start)
+                if self._max_msg_size and size > self._max_msg_size:
+                    log.error('Message %s is %s bytes, which exceeds the '
+                              'maximum of %s bytes. It will not be sent.',
+                              msgid, size, self._max_msg_size)
+                    outq.unlock(msgid)
+                    continue
+
+                if (max_bytes is not None and sent_msgs > 0
+                        and sent_bytes + size > max_bytes):
+                    log.info('Reached the limit of %s bytes for this run.',
+                             max_bytes)
+                    outq.unlock(msgid)
+                    limit_reached = True
+                    break
+
+                with open(path, 'rb') as msg_file:
+                    log_string = self._send_file(
+                        msg_file, msgid, self._route(msg_file, dest),
+                        enqueued
+                    )
+
+                # log that the message was sent
+                log.log(self._msg_log_level, log_string)
+
+                self._last_msg = None
+                outq.remove(msgid)
+                sent_msgs += 1
+                sent_bytes += size
+                self.metrics.inc('messages_sent')
+                self.metrics.inc('bytes_sent', size)
+                self.log_summary()
+
+        # Counting a dirq means listing all of it, so only count what's left
+        # when a limit stopped sending before the queues were drained.
+        if limit_reached:
+            log.info('Sent %s messages (%s bytes) in %.1f seconds. '
+                     '%s messages remain in the queue.', sent_msgs,
+                     sent_bytes, time.time() - start_time,
+                     sum(outq.count() for outq, _dest in self._outqs))
+        else:
+            log.info('Sent %s messages (%s bytes) in %.1f seconds.',
+                     sent_msgs, sent_bytes, time.time() - start_time)
 
-            text = self._outq.get(msgid)
-            if isinstance(text, bytes):
-                text = text.decode('ascii')
+        log.info('Tidying message directory.')
+        for outq, _dest in self._outqs:
+            try:
+                # Remove empty dirs and unlock msgs older than 5 min (default)
+                outq.purge()
+            except OSError as e:
+                log.warning('OSError raised while purging message queue: %s',
+                            e)
 
-            if self._protocol == Ssm2.STOMP_MESSAGING:
-                # Then we are sending to a STOMP message broker.
-                self._send_msg(text, msgid)
+    def _route(self, msg_file, dest):
+        """Return the destination for a message, or dest if not routed.
 
-                log.info('Waiting for broker to accept message.')
+        Only the first line of the message is read, and the file is left
+        at the start of the message.
+        """
+        if not self._routes:
+            return dest
+
+        header = msg_file.readline(256)
+        msg_file.seek(0)
+        msg_type = header.decode('ascii', 'replace').split(':')[0]
+        msg_type = msg_type.strip().lower()
+        try:
+            route = self._route_cache[msg_type]
+        except KeyError:
+            route = None
+            for pattern, route_dest in self._routes:
+                if fnmatch.fnmatchcase(msg_type, pattern):
+                    route = route_dest
+                    break
+            self._route_cache[msg_type] = route
+            log.info('Messages of type %s will be sent to %s.', msg_type,
+                     route or 'the queue destination')
+        return route or dest
+
+    def _send_file(self, msg_file, msgid, dest, enqueued=None):
+        """Send one message from an open file and return a line to log."""
+        if self._protocol == Ssm2.STOMP_MESSAGING:
+            # Then we are sending to a STOMP message broker.
+            self._send_msg(msg_file, msgid, dest=dest, enqueued=enqueued)
+
+            log.log(self._msg_log_level,
+                    'Waiting for broker to accept message.')
+            with self.metrics.timer('receipt_wait'):
                 while self._last_msg is None:
                     if not self.connected:
                         raise Ssm2Exception('Lost connection.')
                     # Small sleep to avoid hammering the CPU
                     time.sleep(0.01)
 
-                log_string = "Sent %s" % msgid
-
-            elif self._protocol == Ssm2.AMS_MESSAGING:
-                # Then we are sending to an Argo Messaging Service instance.
-                argo_id = self._send_msg_ams(text, msgid)
-
-                log_string = "Sent %s, Argo ID: %s" % (msgid, argo_id)
-
-            else:
-                # The SSM has been improperly configured
-                raise Ssm2Exception('Unknown messaging protocol: %s' %
-                                    self._protocol)
+            return "Sent %s" % msgid
 
-            # log that the message was sent
-            log.info(log_string)
+        elif self._protocol == Ssm2.AMS_MESSAGING:
+            # Then we are sending to an Argo Messaging Service.
+            argo_id = self._send_msg_ams(msg_file, msgid, dest=dest,
+                                         enqueued=enqueued)
 
-            self._last_msg = None
-            self._outq.remove(msgid)
+            return "Sent %s, Argo ID: %s" % (msgid, argo_id)
 
-        log.info('Tidying message directory.')
-        try:
-            # Remove empty dirs and unlock msgs older than 5 min (default)
-            self._outq.purge()
-        except OSError as e:
-            log.warning('OSError raised while purging message queue: %s', e)
+        else:
+            # The SSM has been improperly configured
+            raise Ssm2Exception('Unknown messaging protocol: %s' %
+                                self._protocol)
 
     ###########################################################################
     # Connection handling methods
@@ -530,6 +1434,8 @@ class Ssm2(stomp.ConnectionListener):
 
         This doesn't start the connection.
         """
+        import stomp
+
         log.info("Established connection to %s, port %i", host, port)
         if self._use_ssl:
             log.info('Connecting using SSL...')
@@ -537,12 +1443,14 @@ class Ssm2(stomp.ConnectionListener):
             log.warning("SSL connection not requested, your messages may be "
                         "intercepted.")
 
-        # _conn will use the default SSL version specified by stomp.py
+        # _conn will use the default SSL version specified by stomp.py.
+        # Receivers leave message bodies as bytes, as they may be binary.
         self._conn = stomp.Connection([(host, port)],
                                       use_ssl=self._use_ssl,
                                       ssl_key_file=self._key,
                                       ssl_cert_file=self._cert,
-                                      timeout=Ssm2.CONNECTION_TIMEOUT)
+                                      timeout=Ssm2.CONNECTION_TIMEOUT,
+                                      auto_decode=self._listen is None)
 
         self._conn.set_listener('SSM', self)
 
@@ -557,23 +1465,28 @@ class Ssm2(stomp.ConnectionListener):
         """
         if self._protocol == Ssm2.AMS_MESSAGING:
             log.info("Using AMS version %s",
-                        pkg_resources.get_distribution('argo_ams_library').version)
+                     _package_version('argo-ams-library'))
 
             log.info("Will connect to %s", self._brokers[0])
+            self._broker = self._brokers[0]
 
             if self._dest is not None:
                 log.info('Will send messages to: %s', self._dest)
 
             if self._listen is not None:
-                log.info('Will subscribe to: %s', self._listen)
+                log.info('Will subscribe to: %s', ', '.join(self._listens))
             return
 
+        import stomp
+        from stomp.exception import ConnectFailedException
+
         log.info("Using stomp.py version %s.%s.%s.", *stomp.__version__)
 
         for host, port in self._brokers:
             self._initialise_connection(host, port)
             try:
                 self.start_connection()
+                self._broker = '%s:%s' % (host, port)
                 break
             except ConnectFailedException as e:
                 # ConnectFailedException doesn't provide a message.
@@ -637,12 +1550,20 @@ class Ssm2(stomp.ConnectionListener):
         if self._dest is not None:
             log.info('Will send messages to: %s', self._dest)
 
-        if self._listen is not None:
-            # Use a static ID for the subscription ID because we only ever have
-            # one subscription within a connection and ID is only considered
-            # to differentiate subscriptions within a connection.
-            self._conn.subscribe(destination=self._listen, id=1, ack='auto')
-            log.info('Subscribing to: %s', self._listen)
+        if self._listen is not None and not self.paused:
+            self._subscribe()
+
+    def _subscribe(self):
+        """Subscribe to the destinations to receive messages from."""
+        # Use static IDs for the subscription IDs, numbering the destinations
+        # from 1, as ID is only considered to differentiate subscriptions
+        # within a connection.
+        # If writes are batched or done by workers, messages are acknowledged
+        # individually once written rather than as soon as they are delivered.
+        ack = 'client-individual' if self._ack_individually else 'auto'
+        for sub_id, destination in enumerate(self._listens, 1):
+            self._conn.subscribe(destination=destination, id=sub_id, ack=ack)
+            log.info('Subscribing to: %s', destination)
 
     def close_connection(self):
         """Close the connection.
@@ -654,6 +1575,8 @@ class Ssm2(stomp.ConnectionListener):
             log.debug('close_connection called for AMS, doing nothing.')
             return
 
+        import stomp.exception
+
         try:
             self._conn.disconnect()
         except (stomp.exception.NotConnectedException, socket.error):
@@ -665,7 +1588,7 @@ class Ssm2(stomp.ConnectionListener):
         log.info('SSM connection ended.')
 
     def startup(self):
-        """Create the pidfile then start the connection."""
+        """Create the pidfile, start any workers then start the connection."""
         if self._pidfile is not None:
             try:
                 with open(self._pidfile, 'w') as f:
@@ -674,11 +1597,27 @@ class Ssm2(stomp.ConnectionListener):
             except IOError as e:
                 log.warning('Failed to create pidfile %s: %s', self._pidfile, e)
 
+        if self._dedup is not None:
+            self._dedup.open()
+        self.start_workers()
+        if self._status_server is not None:
+            self._status_server.start()
         self.handle_connect()
 
     def shutdown(self):
-        """Close the connection then remove the pidfile."""
+        """Finish writes, close the connection then remove the pidfile."""
+        self.stop_workers()
+        self.flush_writes()
         self.close_connection()
+        if self._listen is not None:
+            # SQLite queues reopen themselves when next used.
+            for queue in self._inqs + [self._rejectq]:
+                if isinstance(queue, SqliteQueue):
+                    queue.close()
+        if self._dedup is not None:
+            self._dedup.close()
+        if self._status_server is not None:
+            self._status_server.close()
         if self._pidfile is not None:
             try:
                 if os.path.exists(self._pidfile):
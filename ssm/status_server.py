@@ -0,0 +1,93 @@
+# Copyright 2026 UK Research and Innovation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module contains the StatusServer class."""
+from __future__ import print_function
+
+import json
+import logging
+import os
+import socketserver
+import stat
+import threading
+
+# logging configuration
+log = logging.getLogger(__name__)
+
+
+class _StatusHandler(socketserver.BaseRequestHandler):
+    """Writes the status to a client, then closes the connection."""
+
+    def handle(self):
+        """Send the status as one line of JSON."""
+        try:
+            status = json.dumps(self.server.get_status(), sort_keys=True)
+        except Exception:
+            log.exception('Failed to get the SSM status.')
+            status = json.dumps({'error': 'Failed to get the SSM status.'})
+        self.request.sendall(status.encode('utf-8') + b'\n')
+
+
+class StatusServer(object):
+    """Serves the status of an SSM on a Unix socket.
+
+    Each client that connects is sent the result of get_status, a dict, as
+    one line of JSON, for example with 'socat - UNIX-CONNECT:<path>'. Clients
+    are served by a separate thread, so they don't hold up messages, and
+    get_status is only called when a client connects.
+    """
+
+    def __init__(self, path, get_status):
+        """Set up a server for the socket path, without starting it."""
+        self.path = path
+        self._get_status = get_status
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Create the socket and start serving clients."""
+        if self._server is not None:
+            return
+        # Remove a socket left behind by an SSM that didn't shut down
+        # cleanly, but nothing else.
+        if os.path.exists(self.path):
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                raise OSError('%s exists and is not a socket.' % self.path)
+            os.remove(self.path)
+
+        self._server = socketserver.UnixStreamServer(self.path,
+                                                     _StatusHandler)
+        # The daemon runs with a umask of 0, so the socket would otherwise
+        # let anyone connect.
+        os.chmod(self.path, 0o600)
+        self._server.get_status = self._get_status
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='ssm-status')
+        self._thread.daemon = True
+        self._thread.start()
+        log.info('Serving status on %s', self.path)
+
+    def close(self):
+        """Stop serving clients and remove the socket."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
+        try:
+            os.remove(self.path)
+        except OSError as error:
+            log.warning('Failed to remove status socket %s: %s', self.path,
+                        error)
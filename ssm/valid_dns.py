@@ -0,0 +1,102 @@
+# Copyright 2026 UK Research and Innovation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module contains the ValidDns and DnFileMonitor classes."""
+from __future__ import print_function
+
+import os
+import re
+import time
+
+
+class ValidDns(object):
+    """A set of DNs that are allowed to sign messages.
+
+    Entries containing '*' are treated as patterns, where '*' matches any
+    sequence of characters. All other entries must match exactly. Checking
+    a DN with 'in' takes a set lookup for exact entries, and patterns are
+    precompiled so no per-check parsing is done.
+    """
+
+    def __init__(self, dn_list=()):
+        """Build the set from a list of DNs and DN patterns."""
+        self._exact = set()
+        prefixes = []
+        patterns = []
+        for dn in dn_list:
+            if '*' not in dn:
+                self._exact.add(dn)
+            elif dn.index('*') == len(dn) - 1:
+                # Patterns with a single trailing '*' are just prefixes.
+                prefixes.append(dn[:-1])
+            else:
+                patterns.append('.*'.join(re.escape(part)
+                                          for part in dn.split('*')))
+
+        self._prefixes = tuple(prefixes)
+        self._num_patterns = len(patterns)
+        if patterns:
+            self._pattern = re.compile('(?:%s)\\Z' % '|'.join(patterns),
+                                       re.DOTALL)
+        else:
+            self._pattern = None
+
+    def __contains__(self, dn):
+        """Return True if dn is one of the DNs or matches a pattern."""
+        if dn in self._exact:
+            return True
+        if self._prefixes and dn.startswith(self._prefixes):
+            return True
+        return self._pattern is not None and bool(self._pattern.match(dn))
+
+    def __len__(self):
+        """Return the number of entries, counting each pattern as one."""
+        return len(self._exact) + len(self._prefixes) + self._num_patterns
+
+
+class DnFileMonitor(object):
+    """Tracks whether a file of DNs has changed, so it's only reread if so."""
+
+    # A file modified less than this many seconds ago may change again
+    # without its mtime changing, so isn't trusted to be unchanged.
+    RACY_SECONDS = 2
+
+    def __init__(self, path):
+        """Monitor the file at path. It counts as changed until first read."""
+        self.path = path
+        self._last_stat = None
+
+    def changed(self):
+        """Return True if the file has changed since this last returned True.
+
+        A change is detected by the file's inode, size or mtime changing, so
+        editing the file in place and replacing it are both picked up.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            # Let the caller report the missing file when it tries to read it.
+            self._last_stat = None
+            return True
+
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if key == self._last_stat:
+            return False
+
+        if time.time() - stat.st_mtime < DnFileMonitor.RACY_SECONDS:
+            # Check again next time in case of a further change within the
+            # mtime resolution of the filesystem.
+            self._last_stat = None
+        else:
+            self._last_stat = key
+        return True
@@ -1,6 +1,9 @@
 from __future__ import print_function
 
+import configparser
 import os
+import subprocess
+import sys
 import tempfile
 from textwrap import dedent
 import unittest
@@ -8,6 +11,7 @@ import unittest.mock as mock
 
 import ssm.agents
 from ssm.ssm2 import Ssm2Exception
+from ssm.valid_dns import ValidDns
 
 
 class getDNsTest(unittest.TestCase):
@@ -57,10 +61,264 @@ class getDNsTest(unittest.TestCase):
         ssm.agents.get_dns(self.tf_path, self.mock_log)
         self.assertEqual(self.mock_log.warning.call_count, 2)
 
+    def test_reload_bad_dns_file(self):
+        """Check that a bad or missing file doesn't replace good DNs."""
+        receiver = mock.Mock()
+        receiver.set_dns.side_effect = (
+            lambda dns: setattr(receiver, 'valid_dns', ValidDns(dns))
+        )
+        with open(self.tf_path, 'w') as f:
+            f.write('/CN=old\n')
+        self.assertTrue(ssm.agents.reload_dns(receiver, self.tf_path,
+                                              self.mock_log))
+
+        # The file is truncated while being rewritten, then goes missing.
+        open(self.tf_path, 'w').close()
+        self.assertFalse(ssm.agents.reload_dns(receiver, self.tf_path,
+                                               self.mock_log))
+        self.assertFalse(ssm.agents.reload_dns(receiver, self.tf_path + '.x',
+                                               self.mock_log))
+        self.assertEqual(receiver.set_dns.call_count, 1)
+        self.assertTrue('/CN=old' in receiver.valid_dns)
+        self.assertEqual(self.mock_log.warning.call_count, 2)
+
     def tearDown(self):
         os.remove(self.tf_path)
         self.patcher.stop()
 
 
+class GetMaxMsgSizeTest(unittest.TestCase):
+    """Tests for the get_max_msg_size function."""
+
+    def setUp(self):
+        self.cp = configparser.ConfigParser()
+        self.cp.add_section('messaging')
+
+    def test_unset(self):
+        """Check that no limit is returned if the option isn't set."""
+        self.assertIsNone(ssm.agents.get_max_msg_size(self.cp))
+        self.cp.remove_section('messaging')
+        self.assertIsNone(ssm.agents.get_max_msg_size(self.cp))
+
+    def test_values(self):
+        """Check that sizes are returned and zero means no limit."""
+        self.cp.set('messaging', 'max_message_size', '1048576')
+        self.assertEqual(ssm.agents.get_max_msg_size(self.cp), 1048576)
+        self.cp.set('messaging', 'max_message_size', '0')
+        self.assertIsNone(ssm.agents.get_max_msg_size(self.cp))
+        self.cp.set('messaging', 'max_message_size', '-1')
+        self.assertRaises(ValueError, ssm.agents.get_max_msg_size, self.cp)
+
+
+class GetSendLimitsTest(unittest.TestCase):
+    """Tests for the get_send_limits function."""
+
+    def test_limits(self):
+        """Check that set limits are returned and others are None."""
+        cp = configparser.ConfigParser()
+        self.assertEqual(ssm.agents.get_send_limits(cp),
+                         {'max_msgs': None, 'max_bytes': None,
+                          'max_time': None})
+
+        cp.add_section('sender')
+        cp.set('sender', 'max_messages', '100')
+        cp.set('sender', 'max_bytes', '0')
+        cp.set('sender', 'max_run_time', '600')
+        self.assertEqual(ssm.agents.get_send_limits(cp),
+                         {'max_msgs': 100, 'max_bytes': None,
+                          'max_time': 600})
+
+        cp.set('sender', 'max_bytes', '-1')
+        self.assertRaises(ValueError, ssm.agents.get_send_limits, cp)
+
+
+class GetPurgeLimitsTest(unittest.TestCase):
+    """Tests for the get_purge_limits function."""
+
+    def test_limits(self):
+        """Check that set values are returned and others are None."""
+        cp = configparser.ConfigParser()
+        cp.add_section('messaging')
+        cp.set('messaging', 'purge_max_dirs', '100')
+        self.assertEqual(ssm.agents.get_purge_limits(cp),
+                         {'purge_max_dirs': 100, 'purge_max_time': None,
+                          'full_purge_interval': None})
+
+
+class GetWriteBatchingTest(unittest.TestCase):
+    """Tests for the get_write_batching function."""
+
+    def test_settings(self):
+        """Check that batching is off by default and can be configured."""
+        cp = configparser.ConfigParser()
+        cp.add_section('receiver')
+        self.assertEqual(ssm.agents.get_write_batching(cp),
+                         {'write_batch_size': None})
+
+        cp.set('receiver', 'write_batch_size', '50')
+        cp.set('receiver', 'write_batch_delay', '0.01')
+        self.assertEqual(ssm.agents.get_write_batching(cp),
+                         {'write_batch_size': 50, 'write_batch_delay': 0.01})
+
+
+class GetWatermarksTest(unittest.TestCase):
+    """Tests for the get_watermarks function."""
+
+    def test_settings(self):
+        """Check that backpressure is off by default and can be configured."""
+        cp = configparser.ConfigParser()
+        cp.add_section('receiver')
+        self.assertEqual(ssm.agents.get_watermarks(cp),
+                         {'high_watermark': None, 'low_watermark': None})
+
+        cp.set('receiver', 'high_watermark', '1000')
+        self.assertEqual(ssm.agents.get_watermarks(cp),
+                         {'high_watermark': 1000, 'low_watermark': None})
+
+
+class GetShardingTest(unittest.TestCase):
+    """Tests for the get_sharding function."""
+
+    def test_settings(self):
+        """Check that there is one incoming queue by default."""
+        cp = configparser.ConfigParser()
+        cp.add_section('receiver')
+        self.assertEqual(ssm.agents.get_sharding(cp), {'incoming_shards': 1})
+
+        cp.set('receiver', 'incoming_shards', '4')
+        cp.set('receiver', 'shard_key', 'empaid')
+        self.assertEqual(ssm.agents.get_sharding(cp),
+                         {'incoming_shards': 4, 'shard_key': 'empaid'})
+
+
+class GetWorkersTest(unittest.TestCase):
+    """Tests for the get_workers function."""
+
+    def test_settings(self):
+        """Check that there are no workers by default."""
+        cp = configparser.ConfigParser()
+        cp.add_section('receiver')
+        self.assertEqual(ssm.agents.get_workers(cp), {'workers': None})
+
+        cp.set('receiver', 'workers', '4')
+        cp.set('receiver', 'signer_rate', '2.5')
+        self.assertEqual(ssm.agents.get_workers(cp),
+                         {'workers': 4, 'signer_rate': 2.5})
+
+
+class GetDestinationsTest(unittest.TestCase):
+    """Tests for the get_destinations function."""
+
+    def test_settings(self):
+        """Check that one or several destinations can be given."""
+        cp = configparser.ConfigParser()
+        cp.add_section('messaging')
+        cp.set('messaging', 'destination', '/queue/a')
+        self.assertEqual(ssm.agents.get_destinations(cp), ['/queue/a'])
+
+        cp.set('messaging', 'destination', '/queue/a, /queue/b,')
+        self.assertEqual(ssm.agents.get_destinations(cp),
+                         ['/queue/a', '/queue/b'])
+
+
+class GetExtraQueuesTest(unittest.TestCase):
+    """Tests for the get_extra_queues function."""
+
+    def test_settings(self):
+        """Check that extra queues must have their own sections."""
+        cp = configparser.ConfigParser()
+        cp.add_section('sender')
+        self.assertEqual(ssm.agents.get_extra_queues(cp), [])
+
+        cp.set('sender', 'extra_queues', 'cloud, grid')
+        cp.add_section('cloud')
+        self.assertRaises(Ssm2Exception, ssm.agents.get_extra_queues, cp)
+        cp.add_section('grid')
+        self.assertEqual(ssm.agents.get_extra_queues(cp), ['cloud', 'grid'])
+
+
+class GetOptionTest(unittest.TestCase):
+    """Tests for the functions that return a single string option."""
+
+    # Each function, the option it reads, its default, and a setting with
+    # the value it gives.
+    OPTIONS = [
+        (ssm.agents.get_compression, 'sender', 'compression', None,
+         'zlib', 'zlib'),
+        (ssm.agents.get_binary, 'sender', 'binary', False, 'true', True),
+        (ssm.agents.get_cipher, 'certificates', 'cipher', 'aes128',
+         'aes256-gcm', 'aes256-gcm'),
+        (ssm.agents.get_metrics_file, 'metrics', 'textfile', None,
+         '/tmp/ssm.prom', '/tmp/ssm.prom'),
+        (ssm.agents.get_status_socket, 'receiver', 'status_socket', None,
+         '/tmp/ssm.sock', '/tmp/ssm.sock'),
+    ]
+
+    def test_settings(self):
+        """Check that each option has its default unless set."""
+        for (function, section, option, default, setting,
+                value) in self.OPTIONS:
+            cp = configparser.ConfigParser()
+            self.assertEqual(function(cp), default, option)
+            cp.add_section(section)
+            self.assertEqual(function(cp), default, option)
+            if default is None:
+                # Setting an option to nothing is the same as leaving it out.
+                cp.set(section, option, '')
+                self.assertEqual(function(cp), default, option)
+            cp.set(section, option, setting)
+            self.assertEqual(function(cp), value, option)
+
+
+class GetSummaryIntervalTest(unittest.TestCase):
+    """Tests for the get_summary_interval function."""
+
+    def test_settings(self):
+        """Check that each message is logged unless an interval is set."""
+        cp = configparser.ConfigParser()
+        cp.add_section('logging')
+        self.assertEqual(ssm.agents.get_summary_interval(cp), None)
+        cp.set('logging', 'summary_interval', '0')
+        self.assertEqual(ssm.agents.get_summary_interval(cp), None)
+        cp.set('logging', 'summary_interval', '60')
+        self.assertEqual(ssm.agents.get_summary_interval(cp), 60)
+
+
+class GetRoutesTest(unittest.TestCase):
+    """Tests for the get_routes function."""
+
+    def test_settings(self):
+        """Check that routes are read in order."""
+        cp = configparser.ConfigParser()
+        self.assertEqual(ssm.agents.get_routes(cp), None)
+
+        cp.add_section('routes')
+        cp.set('routes', 'APEL-cloud-message', '/queue/cloud')
+        cp.set('routes', 'APEL-*', '/queue/apel')
+        self.assertEqual(ssm.agents.get_routes(cp),
+                         [('apel-cloud-message', '/queue/cloud'),
+                          ('apel-*', '/queue/apel')])
+
+
+class ImportTest(unittest.TestCase):
+    """Tests for what importing the agents module imports."""
+
+    def test_lazy_imports(self):
+        """Check that libraries for unused protocols aren't imported."""
+        # A new interpreter is used as these tests have imported everything.
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__)
+        ))
+        imported = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, ssm.agents; print(" ".join(sorted(name for name in '
+             '("stomp", "argo_ams_library", "dirq", "daemon", '
+             '"pkg_resources") if name in sys.modules)))'],
+            env=env, universal_newlines=True
+        )
+        self.assertEqual(imported.strip(), '')
+
+
 if __name__ == '__main__':
     unittest.main()
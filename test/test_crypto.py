@@ -4,20 +4,32 @@ import logging
 import OpenSSL
 import os
 import quopri
-from subprocess import call, Popen, PIPE
+import shutil
+from subprocess import call, check_output, Popen, PIPE
 import tempfile
 import unittest
+import unittest.mock as mock
+import zlib
 
+import ssm.crypto
 from ssm.crypto import (check_cert_key,
+    compress,
     get_certificate_subject,
+    get_message_type,
     get_signer_cert,
+    is_der,
+    peek_signer,
     sign,
     encrypt,
     decrypt,
     verify,
     verify_cert,
+    verify_cert_path,
     _get_subject_components,
-    CryptoException
+    Credentials,
+    CryptoException,
+    ENCRYPTED,
+    SIGNED
 )
 
 
@@ -115,6 +127,104 @@ class TestEncryptUtils(unittest.TestCase):
         self.assertEqual(retrieved_msg, MSG,
                          "The verified message didn't match the original.")
 
+    def test_sign_file(self):
+        """Check that a message can be signed straight from a file."""
+        with tempfile.TemporaryFile() as msg_file:
+            msg_file.write(MSG.encode())
+            msg_file.seek(0)
+            signed = sign(msg_file, TEST_CERT_FILE, TEST_KEY_FILE)
+
+        retrieved_msg, retrieved_dn = verify(signed, TEST_CA_DIR, False)
+
+        self.assertEqual(retrieved_dn, TEST_CERT_DN)
+        self.assertEqual(retrieved_msg, MSG)
+
+    def test_sign_compressed(self):
+        """Check that compressed messages are decompressed by verify."""
+        long_msg = MSG * 1000
+        with tempfile.TemporaryFile() as msg_file:
+            msg_file.write(long_msg.encode())
+            msg_file.seek(0)
+            signed = sign(msg_file, TEST_CERT_FILE, TEST_KEY_FILE,
+                          compression='zlib')
+
+        self.assertTrue('Content-Encoding: zlib' in signed)
+        self.assertTrue(len(signed) < len(long_msg))
+        self.assertEqual(get_message_type(signed), SIGNED)
+
+        encrypted = encrypt(signed, TEST_CERT_FILE)
+        decrypted = decrypt(encrypted, TEST_CERT_FILE, TEST_KEY_FILE)
+        retrieved_msg, retrieved_dn = verify(decrypted, TEST_CA_DIR, False)
+        self.assertEqual(retrieved_dn, TEST_CERT_DN)
+        self.assertEqual(retrieved_msg, long_msg)
+
+        self.assertRaises(CryptoException, sign, MSG, TEST_CERT_FILE,
+                          TEST_KEY_FILE, compression='lzma')
+
+    def test_verify_compressed_too_large(self):
+        """Check that a message isn't decompressed beyond the size limit."""
+        signed = sign('A' * 1000000, TEST_CERT_FILE, TEST_KEY_FILE,
+                      compression='zlib')
+        self.assertTrue(len(signed) < 10000)
+        self.assertRaises(CryptoException, verify, signed, TEST_CA_DIR, False,
+                          max_size=999999)
+        self.assertEqual(len(verify(signed, TEST_CA_DIR, False,
+                                    max_size=1000000)[0]), 1000000)
+
+        # The default limit applies if none is given.
+        with mock.patch('ssm.crypto.MAX_DECOMPRESSED_SIZE', 1000):
+            self.assertRaises(CryptoException, verify, signed, TEST_CA_DIR,
+                              False)
+
+        # A truncated stream isn't passed off as the whole message.
+        self.assertRaises(CryptoException, ssm.crypto._decompress,
+                          zlib.compress(b'A' * 1000)[:-4], 'zlib', 1000)
+
+    @unittest.skipIf(ssm.crypto.zstandard is None, 'zstandard not installed')
+    def test_sign_zstd(self):
+        """Check that zstd compressed messages can be verified."""
+        signed = sign(MSG, TEST_CERT_FILE, TEST_KEY_FILE, compression='zstd')
+        self.assertEqual(verify(signed, TEST_CA_DIR, False)[0], MSG)
+
+    def test_sign_der(self):
+        """Check that binary (DER) messages round trip like SMIME ones."""
+        signed = sign(MSG, TEST_CERT_FILE, TEST_KEY_FILE, der=True)
+        self.assertTrue(isinstance(signed, bytes))
+        self.assertTrue(is_der(signed))
+        self.assertEqual(get_message_type(signed), SIGNED)
+        self.assertEqual(peek_signer(signed),
+                         'CN=Test Cert,OU=SC,O=STFC,C=UK')
+
+        encrypted = encrypt(signed, TEST_CERT_FILE, der=True)
+        self.assertTrue(is_der(encrypted))
+        self.assertEqual(get_message_type(encrypted), ENCRYPTED)
+
+        decrypted = decrypt(encrypted, TEST_CERT_FILE, TEST_KEY_FILE)
+        self.assertEqual(decrypted, signed)
+        retrieved_msg, retrieved_dn = verify(decrypted, TEST_CA_DIR, False)
+        self.assertEqual(retrieved_dn, TEST_CERT_DN)
+        self.assertEqual(retrieved_msg, MSG)
+
+        # Compression also works in binary mode.
+        signed = sign(MSG * 100, TEST_CERT_FILE, TEST_KEY_FILE,
+                      compression='zlib', der=True)
+        self.assertEqual(verify(signed, TEST_CA_DIR, False)[0], MSG * 100)
+
+        # Bytes that aren't DER aren't taken for a message.
+        self.assertFalse(is_der(MSG))
+        self.assertFalse(is_der(MSG.encode()))
+        self.assertEqual(get_message_type(b'0junk'), None)
+
+    def test_verify_bad_compression(self):
+        """Check that an unknown content encoding isn't passed through."""
+        entity = compress(MSG, 'zlib').replace('zlib', 'rot13')
+        p1 = Popen(['openssl', 'smime', '-sign', '-inkey', TEST_KEY_FILE,
+                    '-signer', TEST_CERT_FILE],
+                   stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                   universal_newlines=True)
+        signed, _error = p1.communicate(entity)
+        self.assertRaises(CryptoException, verify, signed, TEST_CA_DIR, False)
+
     def test_verify(self):
 
         signed_msg = sign(MSG, TEST_CERT_FILE, TEST_KEY_FILE)
@@ -176,6 +286,89 @@ class TestEncryptUtils(unittest.TestCase):
         self.assertRaises(CryptoException, verify, 'Bibbly bobbly', None, False)
         self.assertRaises(CryptoException, verify, None, 'not a path', False)
 
+    def test_credentials(self):
+        """Check the in process startup checks of Credentials."""
+        with mock.patch('ssm.crypto._from_file',
+                        side_effect=ssm.crypto._from_file) as mock_read:
+            credentials = Credentials(TEST_CERT_FILE, TEST_KEY_FILE,
+                                      TEST_CERT_FILE)
+            self.assertTrue(credentials.key_matches())
+            # The certificate is valid for one day.
+            self.assertTrue(credentials.in_date(credentials.cert, 3600))
+            self.assertTrue(credentials.verify_enc_cert(TEST_CA_DIR, False))
+            self.assertEqual(credentials.subject, TEST_CERT_DN)
+            self.assertEqual(credentials.enc_subject, TEST_CERT_DN)
+            # Each file is only read once.
+            self.assertEqual(mock_read.call_count, 2)
+
+        self.assertFalse(credentials.in_date(credentials.cert))
+
+        empty_dir = tempfile.mkdtemp(prefix='ssm')
+        self.addCleanup(shutil.rmtree, empty_dir)
+        self.assertFalse(credentials.verify_enc_cert(empty_dir, False))
+
+        self.assertFalse(Credentials(TEST_CERT_FILE, 'k').key_matches())
+        self.assertFalse(
+            Credentials(TEST_CERT_FILE, TEST_CERT_FILE).key_matches()
+        )
+        self.assertEqual(Credentials(TEST_CERT_FILE, TEST_KEY_FILE).enc_cert,
+                         None)
+
+    def _make_credentials(self, key_args):
+        """Return a new cert, key and CA directory of the given key type."""
+        tmp_dir = tempfile.mkdtemp(prefix='ssm')
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        certpath = os.path.join(tmp_dir, 'cert.pem')
+        keypath = os.path.join(tmp_dir, 'key.pem')
+        call(['openssl', 'req', '-x509', '-nodes', '-days', '1', '-newkey']
+             + key_args + ['-keyout', keypath, '-out', certpath,
+                           '-subj', TEST_CERT_DN], stderr=PIPE)
+
+        ca_dir = os.path.join(tmp_dir, 'ca')
+        os.mkdir(ca_dir)
+        hash_name = check_output(['openssl', 'x509', '-subject_hash',
+                                  '-noout', '-in', certpath],
+                                 universal_newlines=True)
+        shutil.copy(certpath, os.path.join(ca_dir, hash_name.strip() + '.0'))
+        return certpath, keypath, ca_dir
+
+    def test_ec_credentials(self):
+        """Check that ECDSA certificates work like RSA ones."""
+        for curve in ('P-256', 'P-384'):
+            certpath, keypath, ca_dir = self._make_credentials(
+                ['ec', '-pkeyopt', 'ec_paramgen_curve:' + curve]
+            )
+            self.assertTrue(check_cert_key(certpath, keypath), curve)
+            self.assertFalse(check_cert_key(certpath, TEST_KEY_FILE), curve)
+            with open(certpath) as cert:
+                self.assertEqual(get_certificate_subject(cert.read()),
+                                 TEST_CERT_DN)
+            self.assertTrue(verify_cert_path(certpath, ca_dir, False))
+
+            for der in (False, True):
+                signed = sign(MSG, certpath, keypath, der=der)
+                self.assertEqual(peek_signer(signed),
+                                 'CN=Test Cert,OU=SC,O=STFC,C=UK')
+                self.assertEqual(verify(signed, ca_dir, False),
+                                 (MSG, TEST_CERT_DN))
+
+    def test_ed25519_credentials(self):
+        """Check that Ed25519 certificates can be used where openssl can."""
+        certpath, keypath, ca_dir = self._make_credentials(['ed25519'])
+        self.assertTrue(check_cert_key(certpath, keypath))
+        self.assertFalse(check_cert_key(certpath, TEST_KEY_FILE))
+        with open(certpath) as cert:
+            self.assertEqual(get_certificate_subject(cert.read()),
+                             TEST_CERT_DN)
+        self.assertTrue(verify_cert_path(certpath, ca_dir, False))
+
+        try:
+            signed = sign(MSG, certpath, keypath)
+        except CryptoException:
+            # Signing fails cleanly rather than producing an empty message.
+            self.skipTest('openssl cannot sign CMS messages with Ed25519')
+        self.assertEqual(verify(signed, ca_dir, False), (MSG, TEST_CERT_DN))
+
     def test_get_subject_components(self):
         """Check that the correct DN is extracted from the certstring."""
         # Still a valid certificate
@@ -242,6 +435,25 @@ class TestEncryptUtils(unittest.TestCase):
         # invalid cipher
         self.assertRaises(CryptoException, encrypt, MSG, TEST_CERT_FILE, 'aes1024')
 
+    def test_encrypt_gcm(self):
+        """Check that AES-GCM encrypted messages can be decrypted."""
+        for der in (False, True):
+            msg = MSG.encode() if der else MSG
+            encrypted = encrypt(msg, TEST_CERT_FILE, 'aes256-gcm', der=der)
+            self.assertEqual(get_message_type(encrypted), ENCRYPTED)
+            if not der:
+                self.assertTrue('authEnveloped-data' in encrypted)
+            self.assertEqual(decrypt(encrypted, TEST_CERT_FILE,
+                                     TEST_KEY_FILE).strip(), msg.strip())
+
+        # Tampering is detected rather than producing a corrupt message.
+        encrypted = encrypt(MSG.encode(), TEST_CERT_FILE, 'aes128-gcm',
+                            der=True)
+        tampered = encrypted[:-20] + bytes([encrypted[-20] ^ 1]) + \
+            encrypted[-19:]
+        self.assertRaises(CryptoException, decrypt, tampered, TEST_CERT_FILE,
+                          TEST_KEY_FILE)
+
 
     def test_decrypt(self):
         '''
@@ -255,6 +467,35 @@ class TestEncryptUtils(unittest.TestCase):
             self.fail('Failed to decrypt message.')
 
 
+    def test_get_message_type(self):
+        """Check that messages are classified from their headers."""
+        signed = sign(MSG, TEST_CERT_FILE, TEST_KEY_FILE)
+        self.assertEqual(get_message_type(signed), SIGNED)
+        self.assertEqual(get_message_type(signed.replace('\n', '\r\n')),
+                         SIGNED)
+
+        encrypted = encrypt(signed, TEST_CERT_FILE)
+        self.assertEqual(get_message_type(encrypted), ENCRYPTED)
+
+        opaque = ('MIME-Version: 1.0\nContent-Type: application/pkcs7-mime;\n'
+                  ' smime-type=signed-data; name="smime.p7m"\n\nMIIB')
+        self.assertEqual(get_message_type(opaque), SIGNED)
+
+        for junk in ('', MSG, 'Content-Type: text/plain\n\n' + MSG,
+                     'Not a header\nContent-Type: multipart/signed\n\n',
+                     # Headers that don't end within the size limit.
+                     'Content-Type: multipart/signed\n' + 'X: y\n' * 1000,
+                     # Encryption only mentioned in the body.
+                     'MIME-Version: 1.0\n\napplication/pkcs7-mime\n'):
+            self.assertEqual(get_message_type(junk), None, junk[:50])
+
+    def test_peek_signer(self):
+        """Check that the signer can be read without verifying anything."""
+        signed = sign(MSG, TEST_CERT_FILE, TEST_KEY_FILE)
+        self.assertEqual(peek_signer(signed),
+                         'CN=Test Cert,OU=SC,O=STFC,C=UK')
+        self.assertEqual(peek_signer(MSG), None)
+
     def test_verify_cert(self):
         '''
         Check that the test certificate is verified against itself, and that
@@ -0,0 +1,146 @@
+"""This module contains test cases for the DirqQueue class."""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from dirq.QueueSimple import QueueSimple
+
+from ssm.dirq_queue import DirqQueue
+
+
+class TestDirqQueue(unittest.TestCase):
+    """Class used for testing the DirqQueue class."""
+
+    def setUp(self):
+        """Create a DirqQueue on top of a temporary directory."""
+        self.tmp_dir = tempfile.mkdtemp(prefix='dirq_queue_')
+        self.queue = DirqQueue(self.tmp_dir)
+
+    def tearDown(self):
+        """Remove test directory and all contents."""
+        try:
+            shutil.rmtree(self.tmp_dir)
+        except OSError as error:
+            print('Error removing temporary directory %s' % self.tmp_dir)
+            print(error)
+
+    def test_is_empty(self):
+        """Check is_empty follows elements being added and removed."""
+        self.assertTrue(self.queue.is_empty())
+
+        name = self.queue.add('FOO')
+        self.assertFalse(self.queue.is_empty())
+
+        self.assertTrue(self.queue.lock(name))
+        # Locked elements are still in the queue.
+        self.assertFalse(self.queue.is_empty())
+
+        self.queue.remove(name)
+        self.assertTrue(self.queue.is_empty())
+
+    def test_count(self):
+        """Check count follows elements being added and removed."""
+        self.assertEqual(self.queue.count(), 0)
+        names = [self.queue.add(data) for data in ('FOO', 'BAR', 'BAZ')]
+        self.assertEqual(self.queue.count(), 3)
+
+        self.queue.lock(names[0])
+        self.queue.remove(names[0])
+        self.assertEqual(self.queue.count(), 2)
+
+    def test_count_external_changes(self):
+        """Check the cached count notices changes made by other processes."""
+        self.queue.add('FOO')
+        self.assertEqual(self.queue.count(), 1)
+
+        # Use a separate plain QueueSimple to simulate another process.
+        other = QueueSimple(self.tmp_dir)
+        name = other.add('BAR')
+        self.assertEqual(self.queue.count(), 2)
+
+        other.lock(name)
+        other.remove(name)
+        self.assertEqual(self.queue.count(), 1)
+
+    def test_count_ignores_purged_dirs(self):
+        """Check that removed intermediate directories are not counted."""
+        name = self.queue.add('FOO')
+        self.assertEqual(self.queue.count(), 1)
+
+        shutil.rmtree(os.path.join(self.tmp_dir, name.split('/')[0]))
+        self.assertEqual(self.queue.count(), 0)
+        self.assertTrue(self.queue.is_empty())
+
+
+class TestDirqQueuePurge(unittest.TestCase):
+    """Class used for testing incremental purging of the DirqQueue class."""
+
+    def setUp(self):
+        """Create a temporary queue with three empty directories."""
+        self.tmp_dir = tempfile.mkdtemp(prefix='dirq_queue_')
+        self.dirs = ['00000001', '00000002', '00000003']
+        for name in self.dirs:
+            os.mkdir(os.path.join(self.tmp_dir, name))
+
+    def tearDown(self):
+        """Remove test directory and all contents."""
+        try:
+            shutil.rmtree(self.tmp_dir)
+        except OSError as error:
+            print('Error removing temporary directory %s' % self.tmp_dir)
+            print(error)
+
+    def _remaining_dirs(self):
+        """Return the intermediate directories left in the queue."""
+        return sorted(name for name in os.listdir(self.tmp_dir)
+                      if not name.startswith('.'))
+
+    def test_purge_without_limits(self):
+        """Check that a full purge is done if no limits are set."""
+        DirqQueue(self.tmp_dir).purge()
+        # The newest directory is always kept.
+        self.assertEqual(self._remaining_dirs(), ['00000003'])
+
+    def test_purge_incremental(self):
+        """Check that each purge carries on where the last one stopped."""
+        queue = DirqQueue(self.tmp_dir, purge_max_dirs=1)
+        queue.purge()
+        self.assertEqual(self._remaining_dirs(), self.dirs[1:])
+
+        # A new object should pick up the saved state.
+        queue = DirqQueue(self.tmp_dir, purge_max_dirs=1)
+        queue.purge()
+        self.assertEqual(self._remaining_dirs(), self.dirs[2:])
+
+        # Reaching the end of the queue starts again from the beginning.
+        queue.purge()
+        queue.purge()
+        self.assertEqual(self._remaining_dirs(), self.dirs[2:])
+
+    def test_purge_stale_files(self):
+        """Check that old temporary and locked files are removed."""
+        path = os.path.join(self.tmp_dir, self.dirs[-1])
+        old_tmp = os.path.join(path, '0000000100000.tmp')
+        new_tmp = os.path.join(path, '0000000200000.tmp')
+        old_lock = os.path.join(path, '0000000300000.lck')
+        for file_path in (old_tmp, new_tmp, old_lock):
+            open(file_path, 'w').close()
+        os.utime(old_tmp, (0, 0))
+        os.utime(old_lock, (0, 0))
+
+        DirqQueue(self.tmp_dir, purge_max_dirs=10).purge()
+        self.assertEqual(os.listdir(path), ['0000000200000.tmp'])
+
+    def test_full_purge_interval(self):
+        """Check that a full purge is done when the interval has passed."""
+        queue = DirqQueue(self.tmp_dir, purge_max_dirs=1,
+                          full_purge_interval=0)
+        queue.purge()
+        self.assertEqual(self._remaining_dirs(), ['00000003'])
+
+
+if __name__ == '__main__':
+    unittest.main()
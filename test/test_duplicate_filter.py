@@ -0,0 +1,77 @@
+"""This module contains test cases for the DuplicateFilter class."""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from ssm.duplicate_filter import DuplicateFilter
+
+
+class TestDuplicateFilter(unittest.TestCase):
+    """Class used for testing the DuplicateFilter class."""
+
+    def setUp(self):
+        """Create a DuplicateFilter in a temporary directory."""
+        self.tmp_dir = tempfile.mkdtemp(prefix='duplicate_filter_')
+        self.path = os.path.join(self.tmp_dir, 'dedup.db')
+        self.dedup = DuplicateFilter(self.path, 3)
+
+    def tearDown(self):
+        """Close the filter and remove test directory and all contents."""
+        self.dedup.close()
+        try:
+            shutil.rmtree(self.tmp_dir)
+        except OSError as error:
+            print('Error removing temporary directory %s' % self.tmp_dir)
+            print(error)
+
+    def _remember(self, *empaids):
+        """Remember a message from /CN=a for each of empaids."""
+        self.dedup.remember([DuplicateFilter.digest(empaid, '/CN=a', 'FOO')
+                             for empaid in empaids])
+
+    def _is_duplicate(self, empaid, signer='/CN=a', body='FOO'):
+        """Return whether the filter has a message with these parts."""
+        return self.dedup.is_duplicate(
+            DuplicateFilter.digest(empaid, signer, body)
+        )
+
+    def test_is_duplicate(self):
+        """Check that a message is only a duplicate if all its parts match."""
+        self.assertFalse(self._is_duplicate('1'))
+        # Messages are only remembered once they have been saved.
+        self.assertFalse(self._is_duplicate('1'))
+        self._remember('1')
+        self.assertTrue(self._is_duplicate('1'))
+        self.assertFalse(self._is_duplicate('2'))
+        self.assertFalse(self._is_duplicate('1', signer='/CN=b'))
+        self.assertFalse(self._is_duplicate('1', body='BAR'))
+        # Parts shouldn't be able to run into each other.
+        self.assertFalse(self._is_duplicate('1/', signer='CN=a'))
+
+    def test_persistence_and_bound(self):
+        """Check that digests survive reopening and only the newest are kept."""
+        self._remember('1', '2', '3', '4')
+        # Seeing a message again makes it the most recently seen.
+        self._is_duplicate('1')
+        self.dedup.close()
+
+        # The oldest digests are forgotten when the filter is reopened.
+        self.dedup.open()
+        self.assertTrue(self._is_duplicate('1'))
+        self.assertTrue(self._is_duplicate('4'))
+        self.assertFalse(self._is_duplicate('2'))
+
+    @mock.patch.object(DuplicateFilter, 'TRIM_EVERY', 2)
+    def test_trim_while_running(self):
+        """Check that old digests are forgotten without reopening."""
+        for empaid in ('1', '2', '3', '4'):
+            self._remember(empaid)
+        self.assertFalse(self._is_duplicate('1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
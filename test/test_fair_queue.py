@@ -0,0 +1,92 @@
+"""This module contains test cases for the FairQueue class."""
+from __future__ import print_function
+
+import threading
+import unittest
+
+from ssm.fair_queue import FairQueue
+
+
+class TestFairQueue(unittest.TestCase):
+    """Class used for testing the FairQueue class."""
+
+    def test_round_robin(self):
+        """Check that keys take turns regardless of their backlog."""
+        queue = FairQueue()
+        for i in range(5):
+            queue.put('big', 'big%s' % i)
+        queue.put('small', 'small0')
+        queue.put('other', 'other0')
+        self.assertEqual(len(queue), 7)
+
+        order = [queue.get() for _ in range(7)]
+        self.assertEqual(order[:3], ['big0', 'small0', 'other0'])
+        self.assertEqual(order[3:], ['big1', 'big2', 'big3', 'big4'])
+        self.assertEqual(queue.get(timeout=0), None)
+
+    def test_costs(self):
+        """Check that keys share by cost rather than by number of items."""
+        queue = FairQueue(quantum=10)
+        for i in range(4):
+            queue.put('heavy', 'heavy%s' % i, cost=20)
+            queue.put('light', 'light%s' % i, cost=5)
+
+        order = [queue.get() for _ in range(8)]
+        # The light key gets two items per turn, the heavy one every other
+        # turn, once it has built up enough of a deficit.
+        self.assertEqual(order[:4], ['light0', 'light1', 'heavy0', 'light2'])
+        self.assertEqual(sorted(order), sorted(['heavy0', 'heavy1', 'heavy2',
+                                                'heavy3', 'light0', 'light1',
+                                                'light2', 'light3']))
+
+    def test_rate(self):
+        """Check that a rate limited key doesn't hold up the others."""
+        queue = FairQueue(rate=0.01, burst=2)
+        for i in range(4):
+            queue.put('noisy', 'noisy%s' % i)
+        queue.put('quiet', 'quiet0')
+
+        order = [queue.get(timeout=0) for _ in range(4)]
+        self.assertEqual(order, ['noisy0', 'quiet0', 'noisy1', None])
+        self.assertEqual(len(queue), 2)
+
+    def test_unlimited_key(self):
+        """Check that items with the key None aren't rate limited."""
+        queue = FairQueue(rate=0.01, burst=1)
+        for i in range(3):
+            queue.put(None, 'new%s' % i)
+        queue.put('noisy', 'noisy0')
+        queue.put('noisy', 'noisy1')
+
+        order = [queue.get(timeout=0) for _ in range(5)]
+        self.assertEqual(order, ['new0', 'noisy0', 'new1', 'new2', None])
+
+    def test_close_and_join(self):
+        """Check that workers finish the queue before stopping."""
+        queue = FairQueue()
+        done = []
+
+        def work():
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                done.append(item)
+                queue.task_done()
+
+        workers = [threading.Thread(target=work) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for i in range(20):
+            queue.put(i % 4, i)
+        queue.join()
+        self.assertEqual(sorted(done), list(range(20)))
+
+        queue.close()
+        for worker in workers:
+            worker.join(5)
+            self.assertFalse(worker.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
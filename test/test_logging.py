@@ -0,0 +1,76 @@
+"""This module contains test cases for setting up logging."""
+from __future__ import print_function
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import ssm
+
+
+class TestLogging(unittest.TestCase):
+    """Class used for testing set_up_logging."""
+
+    def setUp(self):
+        """Create a directory for the log file."""
+        self._tmp_dir = tempfile.mkdtemp(prefix='logging')
+        self._logfile = os.path.join(self._tmp_dir, 'ssm.log')
+        self._root_level = logging.getLogger().level
+
+    def tearDown(self):
+        """Stop logging to the file and remove it."""
+        ssm.stop_logging()
+        root = logging.getLogger()
+        root.removeHandler(ssm._queue_handler)
+        root.setLevel(self._root_level)
+        for handler in ssm._listener.handlers:
+            handler.close()
+        shutil.rmtree(self._tmp_dir)
+
+    def _read_log(self):
+        """Return the lines of the log file."""
+        with open(self._logfile) as logfile:
+            return logfile.read().splitlines()
+
+    def test_queued_logging(self):
+        """Check that records are written out by the background listener."""
+        ssm.set_up_logging(self._logfile, 'INFO', False)
+        self.assertEqual(ssm.log_streams(),
+                         [ssm._listener.handlers[0].stream])
+
+        log = logging.getLogger('ssm.test')
+        log.info('First.')
+        log.debug('Not written.')
+        # Stopping writes out everything queued.
+        ssm.stop_logging()
+        lines = self._read_log()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith('ssm.test - INFO - First.'))
+
+        # Records logged while stopped are kept until logging restarts.
+        log.warning('Second.')
+        self.assertEqual(len(self._read_log()), 1)
+        ssm.start_logging()
+        ssm.stop_logging()
+        self.assertTrue(self._read_log()[1].endswith('WARNING - Second.'))
+
+    def test_set_up_again(self):
+        """Check that setting up logging again replaces the old queue."""
+        ssm.set_up_logging(self._logfile, 'INFO', False)
+        old_handler = ssm._queue_handler
+        first_handlers = ssm._listener.handlers
+        ssm.set_up_logging(self._logfile, 'INFO', False)
+        self.assertFalse(old_handler in logging.getLogger().handlers)
+        # The old log file is closed, rather than left open.
+        for handler in first_handlers:
+            self.assertEqual(handler.stream, None)
+
+        logging.getLogger('ssm.test').info('Once.')
+        ssm.stop_logging()
+        self.assertEqual(len(self._read_log()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
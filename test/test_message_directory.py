@@ -104,6 +104,41 @@ class TestMessageDirectory(unittest.TestCase):
         self.message_directory.add("BAR")
         self.assertEqual(self.message_directory.count(), 2)
 
+    def test_count_external_changes(self):
+        """
+        Test the cached count notices files added and removed externally.
+
+        This test counts the files, changes the directory without using
+        the MessageDirectory and then checks the count is still correct.
+        """
+        self.message_directory.add("FOO")
+        self.assertEqual(self.message_directory.count(), 1)
+
+        handle, path = tempfile.mkstemp(dir=self.tmp_dir)
+        os.close(handle)
+        self.assertEqual(self.message_directory.count(), 2)
+
+        os.remove(path)
+        self.assertEqual(self.message_directory.count(), 1)
+
+    def test_is_empty(self):
+        """
+        Test the is_empty method of the MessageDirectory class.
+
+        This test checks an empty directory, one containing only a
+        subdirectory and one containing a message.
+        """
+        self.assertTrue(self.message_directory.is_empty())
+        # Directories inside the queue should be ignored.
+        tempfile.mkdtemp(prefix='extra_directory_', dir=self.tmp_dir)
+        self.assertTrue(self.message_directory.is_empty())
+
+        file_name = self.message_directory.add("FOO")
+        self.assertFalse(self.message_directory.is_empty())
+
+        self.message_directory.remove(file_name)
+        self.assertTrue(self.message_directory.is_empty())
+
     def test_lock(self):
         """
         Test the lock method of the MessageDirectory class.
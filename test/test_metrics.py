@@ -0,0 +1,75 @@
+"""This module contains test cases for the Metrics class."""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ssm.metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """Class used for testing the Metrics class."""
+
+    def test_render(self):
+        """Check that counters, gauges and histograms are rendered."""
+        metrics = Metrics()
+        metrics.inc('messages_sent')
+        metrics.inc('messages_sent', 2)
+        metrics.set_gauge('paused', 1)
+        metrics.observe('sign', 0.003)
+        metrics.observe('sign', 0.01)
+        metrics.observe('sign', 20)
+        with metrics.timer('verify'):
+            pass
+
+        self.assertEqual(metrics.counter('messages_sent'), 3)
+        self.assertEqual(metrics.stage_count('sign'), 3)
+        self.assertEqual(metrics.stage_count('verify'), 1)
+        self.assertEqual(metrics.stage_count('decrypt'), 0)
+
+        lines = metrics.render().splitlines()
+        for line in ('# TYPE ssm_messages_sent_total counter',
+                     'ssm_messages_sent_total 3',
+                     'ssm_paused 1',
+                     '# TYPE ssm_stage_duration_seconds histogram',
+                     'ssm_stage_duration_seconds_bucket'
+                     '{stage="sign",le="0.0025"} 0',
+                     'ssm_stage_duration_seconds_bucket'
+                     '{stage="sign",le="0.005"} 1',
+                     # Buckets include values equal to their bound.
+                     'ssm_stage_duration_seconds_bucket'
+                     '{stage="sign",le="0.01"} 2',
+                     'ssm_stage_duration_seconds_bucket'
+                     '{stage="sign",le="10"} 2',
+                     'ssm_stage_duration_seconds_bucket'
+                     '{stage="sign",le="+Inf"} 3',
+                     'ssm_stage_duration_seconds_count{stage="sign"} 3',
+                     'ssm_stage_duration_seconds_count{stage="verify"} 1'):
+            self.assertTrue(line in lines, line)
+        self.assertEqual(Metrics().render(), '')
+
+    def test_write_textfile(self):
+        """Check that the textfile is replaced with the current metrics."""
+        tmp_dir = tempfile.mkdtemp(prefix='metrics')
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'ssm.prom')
+
+        metrics = Metrics()
+        metrics.inc('messages_received')
+        metrics.write_textfile(path)
+        metrics.inc('messages_received')
+        metrics.write_textfile(path)
+
+        with open(path) as textfile:
+            self.assertEqual(textfile.read(), metrics.render())
+        # No temporary files are left behind.
+        self.assertEqual(os.listdir(tmp_dir), ['ssm.prom'])
+
+        # Failing to write is logged rather than raised.
+        metrics.write_textfile(os.path.join(tmp_dir, 'missing', 'ssm.prom'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+"""This module contains test cases for the SqliteQueue class."""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from ssm.sqlite_queue import SqliteQueue
+
+SCHEMA = {'body': 'string', 'signer': 'string', 'empaid': 'string?'}
+
+
+class TestSqliteQueue(unittest.TestCase):
+    """Class used for testing the SqliteQueue class."""
+
+    def setUp(self):
+        """Create a SqliteQueue in a temporary directory."""
+        self.tmp_dir = tempfile.mkdtemp(prefix='sqlite_queue_')
+        self.path = os.path.join(self.tmp_dir, 'incoming')
+        self.queue = SqliteQueue(self.path, schema=SCHEMA)
+
+    def tearDown(self):
+        """Close the queue and remove test directory and all contents."""
+        self.queue.close()
+        try:
+            shutil.rmtree(self.tmp_dir)
+        except OSError as error:
+            print('Error removing temporary directory %s' % self.tmp_dir)
+            print(error)
+
+    def test_add_and_get(self):
+        """Check that added messages can be read back."""
+        name = self.queue.add({'body': 'FOO', 'signer': '/CN=test'})
+        self.assertEqual(self.queue.count(), 1)
+        self.assertEqual(self.queue.get(name),
+                         {'body': 'FOO', 'signer': '/CN=test'})
+
+        # Another connection, such as a loader, should see the message.
+        other = SqliteQueue(self.path, schema=SCHEMA)
+        self.assertEqual(other.get(name)['body'], 'FOO')
+        other.close()
+
+    def test_other_thread(self):
+        """Check the queue can be used from a thread other than its own."""
+        errors = []
+
+        def add():
+            try:
+                self.queue.add({'body': 'FOO', 'signer': '/CN=test'})
+            except Exception as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=add)
+        thread.start()
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.queue.count(), 1)
+
+    def test_schema(self):
+        """Check that data not matching the schema is refused."""
+        self.assertRaises(ValueError, self.queue.add, {'body': 'FOO'})
+        self.assertRaises(ValueError, self.queue.add,
+                          {'body': 'FOO', 'signer': 'BAR', 'extra': 'BAZ'})
+
+    def test_schema_added_field(self):
+        """Check that fields added to the schema are added to the table."""
+        name = self.queue.add({'body': 'FOO', 'signer': '/CN=test'})
+        self.queue.close()
+        self.queue = SqliteQueue(self.path, schema=dict(SCHEMA,
+                                                        extra='string?'))
+        self.assertEqual(self.queue.get(name),
+                         {'body': 'FOO', 'signer': '/CN=test'})
+        name = self.queue.add({'body': 'BAR', 'signer': '/CN=test',
+                               'extra': 'x'})
+        self.assertEqual(self.queue.get(name)['extra'], 'x')
+
+    def test_add_batch(self):
+        """Check that a batch is added all together or not at all."""
+        names = self.queue.add_batch([
+            {'body': 'FOO', 'signer': 'A', 'empaid': '1'},
+            {'body': 'BAR', 'signer': 'B', 'empaid': '2'},
+        ])
+        self.assertEqual(len(names), 2)
+        self.assertEqual(self.queue.count(), 2)
+
+        self.assertRaises(ValueError, self.queue.add_batch, [
+            {'body': 'BAZ', 'signer': 'C'},
+            {'body': 'QUX'},
+        ])
+        self.assertEqual(self.queue.count(), 2)
+
+    def test_iterate_lock_and_remove(self):
+        """Check the messages can be consumed the same way as a dirq."""
+        added = [self.queue.add({'body': str(i), 'signer': 'A'})
+                 for i in range(5)]
+        # Use a small chunk size to check iteration over several chunks.
+        self.queue.ITER_CHUNK = 2
+        self.assertEqual(list(self.queue), added)
+
+        for name in self.queue:
+            self.assertTrue(self.queue.lock(name))
+            self.assertFalse(self.queue.lock(name))
+            self.queue.remove(name)
+
+        self.assertEqual(self.queue.count(), 0)
+        self.assertEqual(list(self.queue), [])
+
+    def test_unlock_and_purge(self):
+        """Check that locks are released by unlock and purge."""
+        name = self.queue.add({'body': 'FOO', 'signer': 'A'})
+        self.assertTrue(self.queue.lock(name))
+        self.assertTrue(self.queue.unlock(name))
+        self.assertFalse(self.queue.unlock(name, permissive=True))
+        self.assertRaises(OSError, self.queue.unlock, name)
+
+        self.assertTrue(self.queue.lock(name))
+        # Recent locks are left alone.
+        self.queue.purge()
+        self.assertFalse(self.queue.lock(name))
+        # Any lock is stale if maxlock is negative.
+        self.queue.purge(maxlock=-1)
+        self.assertTrue(self.queue.lock(name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,20 @@
 from __future__ import print_function
 
+import json
 import os
 import shutil
+import sys
 import tempfile
+import threading
+import time
 import unittest
-from subprocess import call
+import unittest.mock as mock
+from subprocess import call, check_call
 
+from ssm import crypto
+from ssm.duplicate_filter import DuplicateFilter
 from ssm.message_directory import MessageDirectory
+from ssm.sqlite_queue import SqliteQueue
 from ssm.ssm2 import Ssm2, Ssm2Exception
 
 
@@ -93,6 +101,694 @@ class TestSsm(unittest.TestCase):
         # Check that msg with ID and no real content doesn't raise exception.
         test_ssm.on_message({'empa-id': '012345'}, 'body')
 
+    def test_on_message_sqlite(self):
+        """Check that a receiver can use SQLite incoming and reject stores."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite')
+        self.assertTrue(isinstance(test_ssm._inqs[0], SqliteQueue))
+
+        test_ssm.on_message({'empa-id': '012345'}, 'Not signed or encrypted.')
+        self.assertEqual(test_ssm._rejectq.count(), 1)
+        name = next(iter(test_ssm._rejectq))
+        self.assertEqual(test_ssm._rejectq.get(name)['empaid'], '012345')
+
+    def test_on_message_batched(self):
+        """Check that batched messages are written and then acknowledged."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        write_batch_size=2, write_batch_delay=60)
+        test_ssm._conn = mock.Mock()
+
+        test_ssm.on_message({'empa-id': '1', 'ack': 'a1'}, 'Not signed.')
+        self.assertEqual(test_ssm._rejectq.count(), 0)
+        test_ssm._conn.ack.assert_not_called()
+
+        test_ssm.on_message({'empa-id': '2', 'ack': 'a2'}, 'Not signed.')
+        self.assertEqual(test_ssm._rejectq.count(), 2)
+        test_ssm._conn.ack.assert_has_calls([mock.call('a1'),
+                                             mock.call('a2')])
+
+        # Pings aren't written, but still need to be acknowledged.
+        test_ssm.on_message({'empa-id': 'ping', 'ack': 'a3'}, '')
+        test_ssm._conn.ack.assert_called_with('a3')
+
+        # A partial batch is only written once it has waited long enough.
+        test_ssm.on_message({'empa-id': '4', 'message-id': 'm4',
+                             'subscription': '1'}, 'Not signed.')
+        test_ssm.flush_writes(force=False)
+        self.assertEqual(test_ssm._rejectq.count(), 2)
+        test_ssm._write_batch_delay = 0
+        test_ssm.flush_writes(force=False)
+        self.assertEqual(test_ssm._rejectq.count(), 3)
+        test_ssm._conn.ack.assert_called_with('m4', '1')
+
+    def test_on_message_write_failed(self):
+        """Check that messages that can't be written are redelivered."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite', write_batch_size=2)
+        test_ssm._conn = mock.Mock()
+        test_ssm._rejectq.add_batch = mock.Mock(
+            side_effect=OSError('No space left on device')
+        )
+        test_ssm.on_message({'empa-id': '1', 'ack': 'a1'}, 'Not signed.')
+        test_ssm.on_message({'empa-id': '2', 'ack': 'a2'}, 'Not signed.')
+        test_ssm._conn.ack.assert_not_called()
+        test_ssm._conn.nack.assert_has_calls([mock.call('a1'),
+                                              mock.call('a2')])
+
+        # The same goes for workers, which write messages one at a time.
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite', workers=1)
+        test_ssm._conn = mock.Mock()
+        test_ssm._rejectq.add_batch = mock.Mock(
+            side_effect=OSError('No space left on device')
+        )
+        test_ssm.start_workers()
+        test_ssm.on_message({'empa-id': '3', 'ack': 'a3'}, 'Not signed.')
+        test_ssm.stop_workers()
+        test_ssm._conn.ack.assert_not_called()
+        test_ssm._conn.nack.assert_called_once_with('a3')
+
+    def test_on_message_duplicate(self):
+        """Check that duplicates of accepted messages are dropped."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen, dedup_size=10)
+        test_ssm._handle_msg = mock.Mock(return_value=('FOO', '/CN=a', None))
+
+        test_ssm.on_message({'empa-id': '1'}, 'Signed FOO.')
+        test_ssm.on_message({'empa-id': '1'}, 'Signed FOO again.')
+        self.assertEqual(test_ssm._inqs[0].count(), 1)
+        self.assertEqual(test_ssm.metrics.counter('messages_duplicate'), 1)
+
+        # Rejected messages aren't checked, so can't hide later good ones.
+        test_ssm._handle_msg.return_value = (None, None, 'Bad.')
+        test_ssm.on_message({'empa-id': '2'}, 'Bad FOO.')
+        test_ssm._handle_msg.return_value = ('FOO', '/CN=a', None)
+        test_ssm.on_message({'empa-id': '2'}, 'Signed FOO.')
+        self.assertEqual(test_ssm._inqs[0].count(), 2)
+
+    def test_on_message_after_daemonising(self):
+        """Check that messages are written once files have been closed.
+
+        Becoming a daemon closes any files the receiver opened when it was
+        created, so the SQLite queues and duplicate filter mustn't be opened
+        until they're used.
+        """
+        script = (
+            'import sys, unittest.mock as mock, daemon.daemon\n'
+            'from ssm.ssm2 import Ssm2\n'
+            'receiver = Ssm2([("not.a.broker", 123)], *sys.argv[1:4], '
+            'listen="/topic/test", path_type="sqlite", dedup_size=10)\n'
+            'daemon.daemon.close_all_open_files(exclude=[0, 1, 2])\n'
+            'receiver.handle_connect = mock.Mock()\n'
+            'receiver._conn = mock.Mock()\n'
+            'receiver._handle_msg = mock.Mock('
+            'return_value=("FOO", "/CN=a", None))\n'
+            'receiver.startup()\n'
+            'receiver.on_message({"empa-id": "1"}, "Signed FOO.")\n'
+            'receiver.on_message({"empa-id": "1"}, "Signed FOO.")\n'
+            'receiver.shutdown()\n'
+        )
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__)
+        ))
+        check_call([sys.executable, '-c', script, self._msgdir,
+                    TEST_CERT_FILE, self._key_path], env=env)
+        inq = SqliteQueue(os.path.join(self._msgdir, 'incoming'),
+                          Ssm2.QSCHEMA)
+        self.assertEqual(inq.count(), 1)
+        inq.close()
+
+    def test_on_message_duplicate_batched(self):
+        """Check that a message lost before its batch is written isn't lost.
+
+        It is redelivered after a crash, so mustn't be taken as a duplicate.
+        """
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen, dedup_size=10,
+                        path_type='sqlite', write_batch_size=2,
+                        write_batch_delay=60)
+        test_ssm._conn = mock.Mock()
+        test_ssm._handle_msg = mock.Mock(return_value=('FOO', '/CN=a', None))
+        test_ssm.on_message({'empa-id': '1', 'ack': 'a1'}, 'Signed FOO.')
+        # Crash without writing the batch, so the broker redelivers it.
+        test_ssm._dedup.close()
+
+        restarted = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                         self._key_path, listen=self._listen, dedup_size=10,
+                         path_type='sqlite', write_batch_size=2,
+                         write_batch_delay=60)
+        restarted._conn = mock.Mock()
+        restarted._handle_msg = test_ssm._handle_msg
+        restarted.on_message({'empa-id': '1', 'ack': 'a2'}, 'Signed FOO.')
+        restarted.flush_writes()
+        self.assertEqual(restarted._inqs[0].count(), 1)
+        self.assertEqual(restarted.metrics.counter('messages_duplicate'), 0)
+
+        # Once written, it is remembered.
+        restarted.on_message({'empa-id': '1', 'ack': 'a3'}, 'Signed FOO.')
+        restarted.flush_writes()
+        self.assertEqual(restarted._inqs[0].count(), 1)
+        self.assertEqual(restarted.metrics.counter('messages_duplicate'), 1)
+        restarted._conn.ack.assert_called_with('a3')
+
+        # The filter is closed on shutdown and opened again on startup.
+        restarted.shutdown()
+        self.assertEqual(restarted._dedup._connection, None)
+        restarted.handle_connect = mock.Mock()
+        restarted.startup()
+        self.assertTrue(restarted._dedup.is_duplicate(
+            DuplicateFilter.digest('1', '/CN=a', 'FOO')
+        ))
+
+    @mock.patch('ssm.ssm2.crypto.verify')
+    @mock.patch('ssm.ssm2.crypto.decrypt')
+    def test_on_message_junk(self, mock_decrypt, mock_verify):
+        """Check that junk is rejected without any crypto being done."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite')
+
+        test_ssm.on_message({'empa-id': '1'}, 'application/pkcs7-mime junk')
+        test_ssm.on_message({'empa-id': '2'}, b'Not ASCII \xff')
+        mock_decrypt.assert_not_called()
+        mock_verify.assert_not_called()
+
+        self.assertEqual(test_ssm._rejectq.count(), 2)
+        errors = sorted(test_ssm._rejectq.get(name)['error']
+                        for name in test_ssm._rejectq)
+        self.assertEqual(errors, ['Message is not ASCII text.',
+                                  'Message is not signed or encrypted.'])
+
+    def test_incoming_shards(self):
+        """Check that messages are spread across queues by signer."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite', incoming_shards=3)
+        self.assertTrue(os.path.isdir(os.path.join(self._msgdir,
+                                                   'incoming-2')))
+        test_ssm._handle_msg = mock.Mock()
+
+        signers = ['/CN=%s' % i for i in range(10)]
+        for signer in signers * 2:
+            test_ssm._handle_msg.return_value = ('FOO', signer, None)
+            test_ssm.on_message({'empa-id': '1'}, 'Signed FOO.')
+
+        # Each signer's messages are all in one queue.
+        found = []
+        for queue in test_ssm._inqs:
+            queue_signers = [queue.get(name)['signer'] for name in queue]
+            self.assertEqual(len(queue_signers), 2 * len(set(queue_signers)))
+            found.extend(queue_signers)
+        self.assertEqual(sorted(found), sorted(signers * 2))
+
+        self.assertRaises(Ssm2Exception, Ssm2, self._brokers, self._msgdir,
+                          TEST_CERT_FILE, self._key_path, listen=self._listen,
+                          incoming_shards=2, shard_key='body')
+
+    def test_workers(self):
+        """Check that workers verify and save messages, then stop."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite', workers=2)
+        test_ssm._conn = mock.Mock()
+        test_ssm._verify_msg = mock.Mock(return_value=('FOO', '/CN=a', None))
+        # Messages are checked and decrypted by the workers too.
+        checked_in = set()
+        check_msg = test_ssm._check_msg
+
+        def record_check(body):
+            checked_in.add(threading.current_thread().name)
+            return check_msg(body)
+
+        test_ssm._check_msg = record_check
+        test_ssm.start_workers()
+
+        signed = crypto.sign('FOO', TEST_CERT_FILE, self._key_path)
+        for i in range(5):
+            test_ssm.on_message({'empa-id': str(i), 'ack': 'a%s' % i},
+                                signed)
+        # Junk is rejected without being verified.
+        test_ssm.on_message({'empa-id': 'junk', 'ack': 'aj'}, 'Junk.')
+
+        test_ssm.stop_workers()
+        self.assertTrue(checked_in)
+        self.assertTrue(all(name.startswith('ssm-worker-')
+                            for name in checked_in))
+        self.assertEqual(test_ssm._inqs[0].count(), 5)
+        self.assertEqual(test_ssm._rejectq.count(), 1)
+        self.assertEqual(test_ssm._verify_msg.call_count, 5)
+        self.assertEqual(test_ssm._conn.ack.call_count, 6)
+
+        self.assertEqual(test_ssm.metrics.counter('messages_received'), 6)
+        self.assertEqual(test_ssm.metrics.counter('messages_accepted'), 5)
+        self.assertEqual(test_ssm.metrics.counter('messages_rejected'), 1)
+        self.assertEqual(test_ssm.metrics.stage_count('queue_write'), 6)
+
+    def test_status(self):
+        """Check that the status describes the receiver and its workers."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite', workers=2)
+        test_ssm._conn = mock.Mock()
+        test_ssm._verify_msg = mock.Mock(return_value=('FOO', '/CN=a', None))
+        test_ssm.set_dns(['/CN=a'])
+        test_ssm.start_workers()
+        signed = crypto.sign('FOO', TEST_CERT_FILE, self._key_path)
+        for i in range(3):
+            test_ssm.on_message({'empa-id': str(i), 'ack': 'a%s' % i},
+                                signed)
+        test_ssm.stop_workers()
+
+        status = test_ssm.status()
+        self.assertEqual(status['destinations'], [self._listen])
+        self.assertFalse(status['connected'])
+        self.assertEqual(status['messages']['received'], 3)
+        self.assertEqual(status['messages']['accepted'], 3)
+        self.assertTrue(status['messages']['per_second'] > 0)
+        self.assertEqual(status['queues']['pending_writes'], 0)
+        self.assertEqual(status['valid_dns']['count'], 1)
+        self.assertTrue(status['valid_dns']['loaded'] is not None)
+        self.assertEqual(status['workers']['count'], 2)
+        self.assertTrue(status['workers']['utilisation'] >= 0)
+        # Rates are since the last status.
+        self.assertEqual(test_ssm.status()['messages']['per_second'], 0)
+
+    def test_log_summary(self):
+        """Check that a summary replaces the lines logged per message."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite', summary_interval=60)
+        test_ssm._handle_msg = mock.Mock(return_value=('FOO', '/CN=a', None))
+
+        with self.assertLogs('ssm.ssm2', 'DEBUG') as logs:
+            test_ssm.on_message({'empa-id': '1'}, 'Signed FOO.')
+            test_ssm._handle_msg.return_value = (None, None, 'Bad.')
+            test_ssm.on_message({'empa-id': '2'}, 'Bad FOO.')
+            # Not logged until the interval has passed.
+            test_ssm.log_summary()
+            test_ssm.log_summary(force=True)
+        info = [record.getMessage() for record in logs.records
+                if record.levelname == 'INFO']
+        self.assertEqual(len(info), 1)
+        self.assertTrue(info[0].startswith('Received 2 messages in '))
+        self.assertTrue(info[0].endswith(
+            'seconds: 1 accepted, 1 rejected, 0 duplicates.'
+        ))
+
+        # Each summary only counts messages since the last one.
+        with self.assertLogs('ssm.ssm2', 'INFO') as logs:
+            test_ssm.log_summary(force=True)
+        self.assertTrue(' 0 accepted' in logs.output[0])
+
+    def test_timestamps(self):
+        """Check that send times are passed on, measured and saved."""
+        sender = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                      self._key_path, dest=self._dest)
+        sender._conn = mock.Mock()
+        sender._send_msg('FOO', 'abc', enqueued=1000.0)
+        headers = sender._conn.send.call_args[1]['headers']
+        self.assertEqual(headers['ssm-enqueued'], '1000.0')
+        self.assertTrue(float(headers['ssm-sent']) <= time.time())
+
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite')
+        test_ssm._handle_msg = mock.Mock(return_value=('FOO', '/CN=a', None))
+        test_ssm.on_message(headers, 'Signed FOO.')
+        # Messages from older senders don't have timestamps.
+        test_ssm.on_message({'empa-id': 'old'}, 'Signed FOO.')
+
+        saved = [test_ssm._inqs[0].get(name) for name in test_ssm._inqs[0]]
+        timestamps = json.loads(saved[0]['timestamps'])
+        self.assertEqual(timestamps['enqueued'], 1000.0)
+        self.assertEqual(timestamps['sent'], float(headers['ssm-sent']))
+        self.assertTrue(timestamps['sent'] <= timestamps['received']
+                        <= timestamps['saved'])
+        self.assertFalse('timestamps' in saved[1])
+
+        self.assertEqual(test_ssm.metrics.stage_count('transit'), 1)
+        self.assertEqual(test_ssm.metrics.stage_count('end_to_end'), 1)
+        self.assertTrue(test_ssm.metrics.stage_seconds('end_to_end') > 1000)
+
+    def test_binary_messages(self):
+        """Check that binary (DER) messages are sent and received as bytes."""
+        sender = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                      self._key_path, dest=self._dest,
+                      enc_cert=TEST_CERT_FILE, verify_enc_cert=False,
+                      binary=True)
+        sender._conn = mock.Mock()
+        sender._send_msg('FOO', 'abc')
+        sent = sender._conn.send.call_args[0][1]
+        self.assertTrue(isinstance(sent, bytes))
+        self.assertEqual(crypto.get_message_type(sent), crypto.ENCRYPTED)
+
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite')
+        test_ssm._verify_msg = mock.Mock(return_value=('FOO', '/CN=a', None))
+        test_ssm.on_message({'empa-id': 'abc'}, sent)
+        # The message was decrypted to the binary signed message.
+        signed = test_ssm._verify_msg.call_args[0][0]
+        self.assertEqual(crypto.get_message_type(signed), crypto.SIGNED)
+        self.assertEqual(test_ssm._inqs[0].count(), 1)
+
+        # Rejected binary messages are kept base64 encoded.
+        test_ssm.on_message({'empa-id': 'junk'}, b'0junk')
+        reject = test_ssm._rejectq.get(next(iter(test_ssm._rejectq)))
+        self.assertEqual(reject['body'], 'MGp1bms=')
+
+    def test_backpressure(self):
+        """Check that consuming pauses and resumes with the queue depth."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite', high_watermark=3,
+                        low_watermark=1)
+        test_ssm._conn = mock.Mock()
+        test_ssm._handle_msg = mock.Mock(return_value=('FOO', '/CN=a', None))
+
+        test_ssm.check_backpressure()
+        self.assertFalse(test_ssm.paused)
+        for i in range(3):
+            test_ssm.on_message({'empa-id': str(i)}, 'Signed FOO.')
+        test_ssm.check_backpressure()
+        self.assertTrue(test_ssm.paused)
+        test_ssm._conn.unsubscribe.assert_called_once_with(id=1)
+
+        # The queue isn't recounted until the recount interval has passed.
+        for name in list(test_ssm._inqs[0])[:2]:
+            test_ssm._inqs[0].remove(name)
+        test_ssm.check_backpressure()
+        self.assertTrue(test_ssm.paused)
+        test_ssm._next_recount = 0
+        test_ssm.check_backpressure()
+        self.assertFalse(test_ssm.paused)
+        test_ssm._conn.subscribe.assert_called_once_with(
+            destination=self._listen, id=1, ack='auto'
+        )
+
+        self.assertRaises(Ssm2Exception, Ssm2, self._brokers, self._msgdir,
+                          TEST_CERT_FILE, self._key_path, listen=self._listen,
+                          high_watermark=1, low_watermark=2)
+
+    def test_backpressure_workers(self):
+        """Check that messages are acknowledged before unsubscribing."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        path_type='sqlite', high_watermark=2,
+                        low_watermark=1, workers=1, write_batch_size=10)
+        calls = mock.Mock()
+        test_ssm._conn = calls.conn
+        test_ssm._work_queue.join = calls.join
+        test_ssm.flush_writes = calls.flush_writes
+        for i in range(2):
+            test_ssm._inqs[0].add({'body': 'FOO', 'signer': '/CN=a',
+                                   'empaid': str(i)})
+
+        test_ssm.check_backpressure()
+        self.assertTrue(test_ssm.paused)
+        self.assertEqual(calls.mock_calls, [mock.call.join(),
+                                            mock.call.flush_writes(),
+                                            mock.call.conn.unsubscribe(id=1)])
+
+    @mock.patch('ssm.ssm2.ArgoMessagingService')
+    def test_pull_msg_ams_batched(self, mock_ams_class):
+        """Check that AMS messages are written before they are acked."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        protocol=Ssm2.AMS_MESSAGING, write_batch_size=3)
+        messages = []
+        for i in range(3):
+            msg = mock.Mock()
+            msg.get_msgid.return_value = str(i)
+            msg.get_attr.return_value = {'empaid': str(i)}
+            msg.get_data.return_value = 'Not signed.'
+            messages.append(('ack%s' % i, msg))
+        mock_ams = mock_ams_class.return_value
+        mock_ams.pull_sub.return_value = messages
+
+        def check_written(*_args, **_kwargs):
+            self.assertEqual(test_ssm._rejectq.count(), 3)
+        mock_ams.ack_sub.side_effect = check_written
+
+        test_ssm.pull_msg_ams()
+        self.assertEqual(mock_ams.pull_sub.call_args[0][1], 3)
+        mock_ams.ack_sub.assert_called_once_with(
+            self._listen, ['ack0', 'ack1', 'ack2'], retry=3, timeout=10)
+
+    @mock.patch('ssm.ssm2.ArgoMessagingService')
+    def test_pull_msg_ams_workers(self, mock_ams_class):
+        """Check that a round of AMS messages is shared between workers."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen,
+                        protocol=Ssm2.AMS_MESSAGING, workers=4)
+        msg = mock.Mock()
+        msg.get_attr.return_value = {'empaid': '1'}
+        msg.get_data.return_value = 'Not signed.'
+        mock_ams = mock_ams_class.return_value
+        mock_ams.pull_sub.return_value = [('ack%s' % i, msg)
+                                          for i in range(4)]
+
+        test_ssm.start_workers()
+        test_ssm.pull_msg_ams()
+        test_ssm.stop_workers()
+        self.assertEqual(mock_ams.pull_sub.call_args[0][1], 4)
+        self.assertEqual(test_ssm._rejectq.count(), 4)
+        mock_ams.ack_sub.assert_called_once_with(
+            self._listen, ['ack0', 'ack1', 'ack2', 'ack3'], retry=3,
+            timeout=10)
+
+    @mock.patch('ssm.ssm2.ArgoMessagingService')
+    def test_pull_msg_ams_subscriptions(self, mock_ams_class):
+        """Check that each AMS subscription is pulled and acked in turn."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=['sub1', 'sub2'],
+                        protocol=Ssm2.AMS_MESSAGING)
+        msg = mock.Mock()
+        msg.get_attr.return_value = {'empaid': '1'}
+        msg.get_data.return_value = 'Not signed.'
+        mock_ams = mock_ams_class.return_value
+        mock_ams.pull_sub.side_effect = [[('ack1', msg)], [('ack2', msg)]]
+
+        test_ssm.pull_msg_ams()
+        self.assertEqual([call[0][0] for call
+                          in mock_ams.pull_sub.call_args_list],
+                         ['sub1', 'sub2'])
+        mock_ams.ack_sub.assert_has_calls([
+            mock.call('sub1', ['ack1'], retry=3, timeout=10),
+            mock.call('sub2', ['ack2'], retry=3, timeout=10)
+        ])
+
+    def test_subscribe_destinations(self):
+        """Check that a STOMP receiver subscribes to each destination."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=['/queue/a', '/queue/b'],
+                        write_batch_size=2)
+        test_ssm._conn = mock.Mock()
+        test_ssm._subscribe()
+        test_ssm._conn.subscribe.assert_has_calls([
+            mock.call(destination='/queue/a', id=1, ack='client-individual'),
+            mock.call(destination='/queue/b', id=2, ack='client-individual')
+        ])
+
+    def test_on_message_too_large(self):
+        """Check that oversized messages go straight to the reject queue."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, listen=self._listen, max_msg_size=10)
+        test_ssm._handle_msg = mock.Mock()
+
+        test_ssm.on_message({'empa-id': '012345'}, 'A' * 11)
+
+        test_ssm._handle_msg.assert_not_called()
+        self.assertEqual(test_ssm._inqs[0].count(), 0)
+        self.assertEqual(test_ssm._rejectq.count(), 1)
+
+    def test_send_all_too_large(self):
+        """Check that oversized messages are left in the outgoing queue."""
+        test_ssm = self._sending_ssm()
+        test_ssm._max_msg_size = 10
+
+        test_ssm._outq.add('A' * 11)
+        small_msgid = test_ssm._outq.add('A' * 10)
+        test_ssm.send_all()
+
+        # Only the small message should have been sent, read from its file.
+        self.assertEqual(test_ssm._send_msg.call_count, 1)
+        msg_file, msgid = test_ssm._send_msg.call_args[0]
+        self.assertEqual(msgid, small_msgid)
+        self.assertEqual(msg_file.name, test_ssm._outq.get_path(small_msgid))
+        self.assertEqual(test_ssm._outq.count(), 1)
+
+    def _sending_ssm(self):
+        """Return a directory based sender that doesn't really send."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, dest=self._dest, listen=None,
+                        path_type='directory')
+
+        def fake_send(_message, msgid, dest=None, enqueued=None):
+            # Simulate the broker acknowledging the message.
+            test_ssm._last_msg = msgid
+        test_ssm._send_msg = mock.Mock(side_effect=fake_send)
+        return test_ssm
+
+    def test_send_all_extra_queues(self):
+        """Check that each outgoing queue is sent to its destination."""
+        test_ssm = self._sending_ssm()
+        extra_path = os.path.join(self._tmp_dir, 'extra')
+        os.makedirs(extra_path)
+        # A dirq queue alongside the directory one.
+        test_ssm.add_outgoing(extra_path, '/queue/extra', path_type='dirq')
+        # Allow for file times being less precise than time.time().
+        added = time.time() - 1
+        test_ssm._outq.add('0123456789')
+        for _ in range(2):
+            test_ssm._outqs[1][0].add('0123456789')
+        self.assertTrue(test_ssm.has_msgs())
+
+        test_ssm.send_all(max_msgs=2)
+        self.assertEqual([call[1]['dest'] for call
+                          in test_ssm._send_msg.call_args_list],
+                         [self._dest, '/queue/extra'])
+        # The time each message was added, not locked, is sent with it.
+        for call in test_ssm._send_msg.call_args_list:
+            self.assertTrue(added <= call[1]['enqueued'] <= time.time())
+        outq = test_ssm._outqs[1][0]
+        msgid = next(iter(outq))
+        os.utime(os.path.join(extra_path, msgid), (1000, 1000))
+        self.assertEqual(outq.added_time(msgid), 1000)
+        self.assertEqual(outq.added_time('missing'), None)
+
+        test_ssm.send_all()
+        self.assertFalse(test_ssm.has_msgs())
+
+    def test_send_all_routes(self):
+        """Check that messages are sent to destinations by their type."""
+        test_ssm = self._sending_ssm()
+        test_ssm._routes = [('apel-cloud-message', '/queue/cloud'),
+                            ('apel-*-job-message', '/queue/jobs')]
+        test_ssm._outq.add('APEL-cloud-message: v0.4\nVMUUID: 1\n')
+        test_ssm.send_all()
+        test_ssm._outq.add('APEL-summary-job-message: v0.2\nSite: A\n')
+        test_ssm.send_all()
+        test_ssm._outq.add('APEL-sync-message: v0.1\nSite: A\n')
+        test_ssm.send_all()
+
+        self.assertEqual([call[1]['dest'] for call
+                          in test_ssm._send_msg.call_args_list],
+                         ['/queue/cloud', '/queue/jobs', self._dest])
+        self.assertEqual(test_ssm._route_cache['apel-sync-message'], None)
+
+    def test_route_leaves_file_at_start(self):
+        """Check that the whole message is still sent after routing."""
+        test_ssm = self._sending_ssm()
+        test_ssm._routes = [('*', '/queue/all')]
+        msg_path = os.path.join(self._tmp_dir, 'routed')
+        with open(msg_path, 'w') as msg:
+            msg.write('APEL-sync-message: v0.1\nSite: A\n')
+        with open(msg_path, 'rb') as msg_file:
+            self.assertEqual(test_ssm._route(msg_file, self._dest),
+                             '/queue/all')
+            self.assertEqual(msg_file.read(),
+                             b'APEL-sync-message: v0.1\nSite: A\n')
+
+    def test_send_all_routed(self):
+        """Check that routed messages are signed and sent whole."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, dest=self._dest, listen=None,
+                        path_type='directory',
+                        routes=[('apel-sync-message', '/queue/sync')])
+        sent = []
+
+        def fake_send(dest, message, headers):
+            sent.append((dest, message))
+            # Simulate the broker acknowledging the message.
+            test_ssm._last_msg = headers['receipt']
+        test_ssm._conn = mock.Mock()
+        test_ssm._conn.send.side_effect = fake_send
+        text = 'APEL-sync-message: v0.1\nSite: A\n' + 'x' * 10000
+        test_ssm._outq.add(text)
+
+        test_ssm.send_all()
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0][0], '/queue/sync')
+        # The message is signed in the clear, so its body can be seen.
+        self.assertEqual(crypto.get_message_type(sent[0][1]), crypto.SIGNED)
+        self.assertTrue('APEL-sync-message: v0.1' in sent[0][1])
+        self.assertTrue('x' * 10000 in sent[0][1])
+        self.assertEqual(test_ssm._outq.count(), 0)
+
+    def test_send_all_limits(self):
+        """Check that send_all stops when it reaches a per-run limit."""
+        test_ssm = self._sending_ssm()
+        for _ in range(5):
+            test_ssm._outq.add('0123456789')
+
+        test_ssm.send_all(max_msgs=2)
+        self.assertEqual(test_ssm._send_msg.call_count, 2)
+        self.assertEqual(test_ssm._outq.count(), 3)
+
+        test_ssm.send_all(max_bytes=25)
+        self.assertEqual(test_ssm._send_msg.call_count, 4)
+        self.assertEqual(test_ssm._outq.count(), 1)
+
+        test_ssm.send_all(max_time=0)
+        self.assertEqual(test_ssm._send_msg.call_count, 4)
+
+        test_ssm.send_all()
+        self.assertEqual(test_ssm._send_msg.call_count, 5)
+        self.assertEqual(test_ssm._outq.count(), 0)
+
+        # The queue is only counted to report what a limit left in it.
+        test_ssm._outq.add('0123456789')
+        with mock.patch.object(test_ssm._outq, 'count') as mock_count:
+            test_ssm.send_all()
+        mock_count.assert_not_called()
+        self.assertEqual(test_ssm._send_msg.call_count, 6)
+
+    def test_send_all_metrics(self):
+        """Check that sending records its stages and writes them out."""
+        test_ssm = self._sending_ssm()
+        for _ in range(3):
+            test_ssm._outq.add('0123456789')
+        test_ssm.send_all()
+
+        metrics = test_ssm.metrics
+        self.assertEqual(metrics.counter('messages_sent'), 3)
+        self.assertEqual(metrics.counter('bytes_sent'), 30)
+        self.assertEqual(metrics.stage_count('queue_read'), 3)
+        self.assertEqual(metrics.stage_count('receipt_wait'), 3)
+
+        metrics_path = os.path.join(self._tmp_dir, 'ssmsend.prom')
+        test_ssm.write_metrics(metrics_path)
+        with open(metrics_path) as metrics_file:
+            text = metrics_file.read()
+        self.assertTrue('ssm_messages_sent_total 3\n' in text)
+        self.assertTrue('ssm_connected 0\n' in text)
+
+    def test_send_msg_metrics(self):
+        """Check that signing, encrypting and publishing are timed."""
+        test_ssm = Ssm2(self._brokers, self._msgdir, TEST_CERT_FILE,
+                        self._key_path, dest=self._dest,
+                        enc_cert=TEST_CERT_FILE, verify_enc_cert=False)
+        test_ssm._conn = mock.Mock()
+        test_ssm._send_msg('FOO', 'abc')
+        for stage in ('sign', 'encrypt', 'publish'):
+            self.assertEqual(test_ssm.metrics.stage_count(stage), 1, stage)
+
+    def test_send_all_bytes_limit_first_message(self):
+        """Check that a message over the bytes limit is still sent alone."""
+        test_ssm = self._sending_ssm()
+        test_ssm._outq.add('0123456789')
+        test_ssm._outq.add('0123456789')
+
+        test_ssm.send_all(max_bytes=5)
+        self.assertEqual(test_ssm._send_msg.call_count, 1)
+        self.assertEqual(test_ssm._outq.count(), 1)
+
     def test_init_expired_cert(self):
         """Test right exception is thrown creating an SSM with expired cert."""
         expected_error = ('Certificate %s has expired or will expire '
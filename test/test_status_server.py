@@ -0,0 +1,103 @@
+"""This module contains test cases for the StatusServer class."""
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import unittest
+
+from ssm.status_server import StatusServer
+
+
+class TestStatusServer(unittest.TestCase):
+    """Class used for testing the StatusServer class."""
+
+    def setUp(self):
+        """Create a directory for the socket."""
+        self._tmp_dir = tempfile.mkdtemp(prefix='status')
+        self._path = os.path.join(self._tmp_dir, 'ssm.sock')
+
+    def tearDown(self):
+        """Remove the directory."""
+        shutil.rmtree(self._tmp_dir)
+
+    def _read_status(self):
+        """Connect to the socket and return what is sent, decoded."""
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self._path)
+            data = b''
+            while True:
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            client.close()
+        return json.loads(data.decode('utf-8'))
+
+    def test_serve_status(self):
+        """Check that each client is sent the current status."""
+        calls = []
+
+        def get_status():
+            calls.append(None)
+            return {'connected': True, 'requests': len(calls)}
+
+        server = StatusServer(self._path, get_status)
+        server.start()
+        try:
+            self.assertEqual(self._read_status(),
+                             {'connected': True, 'requests': 1})
+            self.assertEqual(self._read_status()['requests'], 2)
+        finally:
+            server.close()
+        self.assertFalse(os.path.exists(self._path))
+
+    def test_socket_mode(self):
+        """Check that only the owner can connect, whatever the umask."""
+        old_umask = os.umask(0)
+        try:
+            server = StatusServer(self._path, dict)
+            server.start()
+        finally:
+            os.umask(old_umask)
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(self._path).st_mode),
+                             0o600)
+        finally:
+            server.close()
+
+    def test_status_error(self):
+        """Check that an error getting the status is sent to the client."""
+        def get_status():
+            raise ValueError('Broken.')
+
+        server = StatusServer(self._path, get_status)
+        server.start()
+        try:
+            self.assertTrue('error' in self._read_status())
+        finally:
+            server.close()
+
+    def test_stale_socket(self):
+        """Check that a stale socket is replaced but other files aren't."""
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self._path)
+        stale.close()
+        server = StatusServer(self._path, dict)
+        server.start()
+        try:
+            self.assertEqual(self._read_status(), {})
+        finally:
+            server.close()
+
+        open(self._path, 'w').close()
+        self.assertRaises(OSError, StatusServer(self._path, dict).start)
+
+
+if __name__ == '__main__':
+    unittest.main()
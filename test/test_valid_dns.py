@@ -0,0 +1,82 @@
+"""This module contains test cases for the ValidDns and DnFileMonitor classes."""
+from __future__ import print_function
+
+import os
+import tempfile
+import unittest
+
+from ssm.valid_dns import DnFileMonitor, ValidDns
+
+
+class TestValidDns(unittest.TestCase):
+    """Class used for testing the ValidDns class."""
+
+    def test_exact(self):
+        """Check that DNs without wildcards must match exactly."""
+        dns = ValidDns(['/C=UK/O=eScience/CN=host.ac.uk'])
+        self.assertIn('/C=UK/O=eScience/CN=host.ac.uk', dns)
+        self.assertNotIn('/C=UK/O=eScience/CN=host.ac.uk2', dns)
+        self.assertNotIn('/C=UK/O=eScience/CN=hostXac.uk', dns)
+        self.assertEqual(len(dns), 1)
+
+    def test_empty(self):
+        """Check that an empty set matches nothing."""
+        self.assertNotIn('/C=UK/O=eScience/CN=host.ac.uk', ValidDns())
+
+    def test_patterns(self):
+        """Check that prefix and general wildcard patterns match."""
+        dns = ValidDns(['/C=UK/O=eScience/OU=CLRC/*',
+                        '/C=UK/O=eScience/OU=*/CN=apel.ac.uk',
+                        '/C=DE/O=GridGermany/CN=exact.de'])
+        self.assertEqual(len(dns), 3)
+
+        self.assertIn('/C=UK/O=eScience/OU=CLRC/L=RAL/CN=a.ac.uk', dns)
+        self.assertIn('/C=UK/O=eScience/OU=Oxford/CN=apel.ac.uk', dns)
+        self.assertIn('/C=DE/O=GridGermany/CN=exact.de', dns)
+
+        self.assertNotIn('/C=UK/O=eScience/OU=Oxford/CN=other.ac.uk', dns)
+        self.assertNotIn('/C=UK/O=eScience/OU=Oxford/CN=apelXac.uk', dns)
+        self.assertNotIn('/C=UK/O=eScience/OU=CLRC', dns)
+
+
+class TestDnFileMonitor(unittest.TestCase):
+    """Class used for testing the DnFileMonitor class."""
+
+    def setUp(self):
+        """Create a temporary DN file, last modified in the past."""
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        os.utime(self.path, (1000, 1000))
+
+    def tearDown(self):
+        """Remove the temporary DN file."""
+        os.remove(self.path)
+
+    def test_changed(self):
+        """Check that only changes to the file are reported."""
+        monitor = DnFileMonitor(self.path)
+        self.assertTrue(monitor.changed())
+        self.assertFalse(monitor.changed())
+
+        with open(self.path, 'w') as dn_file:
+            dn_file.write('/C=UK/CN=host\n')
+        os.utime(self.path, (2000, 2000))
+        self.assertTrue(monitor.changed())
+        self.assertFalse(monitor.changed())
+
+    def test_recent_change(self):
+        """Check that a just modified file is checked again."""
+        monitor = DnFileMonitor(self.path)
+        os.utime(self.path, None)
+        self.assertTrue(monitor.changed())
+        self.assertTrue(monitor.changed())
+
+    def test_missing_file(self):
+        """Check that a missing file counts as changed."""
+        monitor = DnFileMonitor(self.path + '.missing')
+        self.assertTrue(monitor.changed())
+        self.assertTrue(monitor.changed())
+
+
+if __name__ == '__main__':
+    unittest.main()